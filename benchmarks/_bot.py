@@ -0,0 +1,15 @@
+"""
+Loads google-calendar-telegram-bot.py as a module so benchmarks can call into it.
+The file name is not a valid module name, so it cannot be imported directly.
+"""
+import os
+import importlib.util
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'google-calendar-telegram-bot.py')
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location('tym_bot', BOT_PATH)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
@@ -0,0 +1,76 @@
+"""
+Compares the per-command cost of getting a Calendar service.
+
+Before: every command called get_google_credentials() (reads token.json) and build('calendar', 'v3', ...).
+After: every command calls get_calendar_client(), which loads credentials and builds the service once per process.
+
+Runs offline against a throwaway token.json, no Google request is made.
+
+Usage:
+    python benchmarks/bench_calendar_service.py [iterations]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import datetime
+import tempfile
+import statistics
+
+from _bot import load_bot
+
+
+def write_fake_token(directory):
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    token = {
+        "token": "fake-token",
+        "refresh_token": "fake-refresh-token",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "client_id": "fake-client-id",
+        "client_secret": "fake-client-secret",
+        "scopes": ["https://www.googleapis.com/auth/calendar.readonly"],
+        "expiry": expiry.isoformat() + "Z",
+    }
+    with open(os.path.join(directory, 'token.json'), 'w') as f:
+        json.dump(token, f)
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<40} mean {statistics.mean(timings) * 1000:8.3f} ms   p95 {p95 * 1000:8.3f} ms")
+
+
+async def main(iterations):
+    bot = load_bot()
+    bot.warm_up_imports()  # Keep import time out of both measurements
+
+    per_command = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        creds = bot.get_google_credentials()
+        bot.lazy_import('googleapiclient.discovery').build('calendar', 'v3', credentials=creds)
+        per_command.append(time.perf_counter() - start)
+
+    cached = []
+    first_start = time.perf_counter()
+    await bot.get_calendar_client()
+    first_call = time.perf_counter() - first_start
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await bot.get_calendar_client()
+        cached.append(time.perf_counter() - start)
+
+    report("get_google_credentials() + build()", per_command)
+    print(f"{'get_calendar_client() first call':<40} {first_call * 1000:8.3f} ms")
+    report("get_calendar_client() cached", cached)
+    print(f"Saving per command: {(statistics.mean(per_command) - statistics.mean(cached)) * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as directory:
+        write_fake_token(directory)
+        os.chdir(directory)
+        asyncio.run(main(iterations))
@@ -0,0 +1,183 @@
+"""
+Microbenchmark for event parsing on synthetic events.
+
+Before: get_formatted_events and calculate_payment each parsed the raw event dicts themselves,
+running remove_unsupported_tags, uncompiled regexes and repeated datetime.fromisoformat per event,
+and payroll was built as Python lists row by row.
+After: each event is parsed once by normalize_event, and rendering and the vectorized payroll
+engine (build_payroll_frame, summarize_payroll) consume the SessionRecords.
+
+The 'before' functions below are copies of the original implementations.
+
+Usage:
+    python benchmarks/bench_event_normalization.py [event_count] [repeats]
+"""
+import re
+import sys
+import time
+import datetime
+
+from _bot import load_bot
+from synthetic import generate_events
+
+bot = load_bot()
+
+
+def legacy_get_formatted_events(events):
+    formatted_events = {}
+    for event in events:
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        end = event['end'].get('dateTime', event['end'].get('date'))
+        summary = event.get('summary', 'Unnamed Event')
+        description = legacy_remove_unsupported_tags(event.get('description', ''))
+        match = re.search(r"Teacher:\s*(.*)", description)
+        teacher = match.group(1).strip() if match else ''
+        match = re.search(r'@(\w+)', description)
+        telegram_username = "@" + match.group(1) if match else ''
+
+        start_dt = datetime.datetime.fromisoformat(start)
+        end_dt = datetime.datetime.fromisoformat(end)
+
+        event_text = f"{summary} ({start_dt.strftime('%H%Mhrs').lower()} to {end_dt.strftime('%H%Mhrs').lower()})\n <b>Teacher: </b>{teacher}"
+
+        day_str = start_dt.strftime('%A %d %B %Y')
+        if day_str not in formatted_events:
+            formatted_events[day_str] = []
+        formatted_events[day_str].append(event_text)
+
+    return formatted_events
+
+
+def legacy_remove_unsupported_tags(message):
+    message = re.sub(r'<[/]?br>', ' ', message)
+    message = re.sub(r'<[/]?(ul|ol|br|span|b)>', '', message)
+    return message
+
+
+def legacy_calculate_payment(events, venue):
+    data = []
+    total_payments = {}
+
+    for event in events:
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        end = event['end'].get('dateTime', event['end'].get('date'))
+        summary = event.get('summary', 'Unnamed Event')
+        description = legacy_remove_unsupported_tags(event.get('description', ''))
+
+        match = re.search(r"Teacher:\s*([^(@]+)\s*(@\w+)(?:\s*\(([^@]+)\s*@(\w+)\s*(shadowing|substitute|substituting)\))?", description)
+        if match:
+            main_teacher_name = match.group(1).strip()
+            main_teacher_handle = match.group(2).strip().lower()
+            other_teacher_name = match.group(3).strip() if match.group(3) else None
+            other_teacher_handle = "@" + match.group(4).strip().lower() if match.group(4) else None
+            other_teacher_type = match.group(5).strip() if match.group(5) else None
+
+            if other_teacher_type and ('substitute' in other_teacher_type or 'substituting' in other_teacher_type):
+                teacher_handle = other_teacher_handle
+                teacher_name = other_teacher_name
+                teacher_rate = 25 if other_teacher_handle in bot.TEACHERS_25_HOURLY_RATE else 20
+                teacher_hours = (datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start)).total_seconds() / 3600
+                teacher_remarks = "Substitute"
+            else:
+                teacher_handle = main_teacher_handle
+                teacher_name = main_teacher_name
+                teacher_rate = 25 if main_teacher_handle in bot.TEACHERS_25_HOURLY_RATE else 20
+                teacher_hours = (datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start)).total_seconds() / 3600
+                teacher_remarks = ""
+
+            if "POSTPONED" in summary or "[POSTPONED]" in summary:
+                teacher_rate = 0
+                teacher_remarks = "Postponed"
+
+            teacher_amount = teacher_hours * teacher_rate
+
+            if teacher_handle not in total_payments:
+                total_payments[teacher_handle] = {"name": teacher_name, "amount": 0}
+            total_payments[teacher_handle]["amount"] += teacher_amount
+
+            data.append([
+                venue,
+                datetime.datetime.fromisoformat(start).strftime('%Y-%m-%d'),
+                datetime.datetime.fromisoformat(start).strftime('%A'),
+                summary,
+                datetime.datetime.fromisoformat(start).strftime('%H:%M'),
+                datetime.datetime.fromisoformat(end).strftime('%H:%M'),
+                teacher_hours,
+                teacher_name,
+                teacher_handle,
+                teacher_rate,
+                teacher_amount,
+                teacher_remarks
+            ])
+
+            if other_teacher_type and 'shadowing' in other_teacher_type:
+                shadowing_rate = 15
+                shadowing_hours = 1
+                shadowing_amount = shadowing_hours * shadowing_rate
+
+                if other_teacher_handle not in total_payments:
+                    total_payments[other_teacher_handle] = {"name": other_teacher_name, "amount": 0}
+                total_payments[other_teacher_handle]["amount"] += shadowing_amount
+
+                data.append([
+                    venue,
+                    datetime.datetime.fromisoformat(start).strftime('%Y-%m-%d'),
+                    datetime.datetime.fromisoformat(start).strftime('%A'),
+                    summary,
+                    datetime.datetime.fromisoformat(start).strftime('%H:%M'),
+                    datetime.datetime.fromisoformat(end).strftime('%H:%M'),
+                    shadowing_hours,
+                    other_teacher_name,
+                    other_teacher_handle,
+                    shadowing_rate,
+                    shadowing_amount,
+                    "Shadowing"
+                ])
+
+    return data, total_payments
+
+
+def legacy(events):
+    data, total_payments = legacy_calculate_payment(events, 'SOK-C')
+    bot.lazy_import('pandas').DataFrame(data, columns=bot.PAYMENT_SHEET_COLUMNS)  # The payment handler built this frame from the rows afterwards
+    return legacy_get_formatted_events(events), data, {handle: details["amount"] for handle, details in total_payments.items()}
+
+
+def normalized(events):
+    sessions = [bot.normalize_event(event) for event in events]
+    payroll = bot.build_payroll_frame([('SOK-C', sessions)])
+    teacher_totals, _ = bot.summarize_payroll(payroll)
+    return bot.get_formatted_events(sessions), payroll, teacher_totals
+
+
+def same_output(legacy_output, normalized_output):
+    formatted_events, data, totals = legacy_output
+    new_formatted_events, payroll, teacher_totals = normalized_output
+    new_totals = dict(zip(teacher_totals['Teacher Handle'], teacher_totals['Amount']))
+    return (
+        formatted_events == new_formatted_events
+        and data == payroll.astype(object).values.tolist()
+        and totals.keys() == new_totals.keys()
+        and all(abs(totals[handle] - new_totals[handle]) < 1e-9 for handle in totals)
+    )
+
+
+def best_of(func, events, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(events)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    for description_format in ('plain', 'html'):
+        events = generate_events(count, description_format=description_format)
+        assert same_output(legacy(events), normalized(events)), "normalized output differs from the original implementation"
+        before = best_of(legacy, events, repeats)
+        after = best_of(normalized, events, repeats)
+        print(f"{count} events, {description_format} descriptions: before {before * 1000:.1f} ms, after {after * 1000:.1f} ms, {before / after:.2f}x faster")
@@ -0,0 +1,243 @@
+"""
+Runs the bot end to end against local fakes of the Google Calendar API and the Telegram Bot API.
+
+Generates synthetic calendars and measures the rendering and payroll functions on their own, then the
+/schedule, /send, /edit, /paymentforall, /payrolltotals, /conflicts, /myschedule and /digest handlers
+driven through Application.process_update, the same way updates from Telegram are handled. For each it
+reports latency percentiles, the memory allocated by one run (tracemalloc) and the Google and Telegram
+calls made per run. Past payment periods are read from the payroll ledger after the first run.
+
+No credentials are needed: a throwaway token.json is written and both APIs are served locally.
+With --venues, a calendars.json with that many venues is written and the events are spread across them.
+Outgoing messages are not rate limited, so the fake Bot API answers at full speed.
+
+Usage:
+    python benchmarks/bench_handlers.py [--events 3000] [--iterations 30] [--description-format plain|html]
+                                        [--substitute-ratio 0.1] [--shadowing-ratio 0.1] [--cold] [--no-store]
+                                        [--no-ledger] [--venues 30]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+
+from fake_calendar import FakeCalendarServer
+from fake_telegram import FakeTelegramServer
+from synthetic import TEACHERS, generate_events
+from bench_calendar_service import write_fake_token
+
+USER_ID = 4242
+GROUPCHAT_ID = -1001000
+WEEK = '2025-05-01'
+PAYMENT_PERIOD = ('2025-05-01', '2025-05-31')
+
+
+def percentile(timings, share):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, max(0, round(len(timings) * share) - 1))]
+
+
+def report(label, timings, allocated, google_calls, google_round_trips, telegram_calls):
+    print(
+        f"{label:<34} p50 {percentile(timings, 0.5) * 1000:8.2f} ms  p95 {percentile(timings, 0.95) * 1000:8.2f} ms  "
+        f"p99 {percentile(timings, 0.99) * 1000:8.2f} ms  alloc {allocated / 1024:9.1f} KiB  "
+        f"google {google_calls:5.1f} calls {google_round_trips:5.1f} trips  telegram {telegram_calls:5.1f} calls"
+    )
+
+
+class Harness:
+    def __init__(self, bot, app, calendar, telegram, iterations, cold):
+        self.bot = bot
+        self.app = app
+        self.calendar = calendar
+        self.telegram = telegram
+        self.iterations = iterations
+        self.cold = cold
+        self.update_ids = iter(range(1, 10 ** 9))
+
+    def command(self, text):
+        from telegram import Update
+        update_id = next(self.update_ids)
+        command = text.split()[0]
+        return Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': USER_ID, 'type': 'private'},
+                'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Admin'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+            }
+        }, self.app.bot)
+
+    async def handle(self, text):
+        await self.app.process_update(self.command(text))
+
+    async def measure(self, label, run, before=None):
+        """
+        Time run over the configured iterations, then run it once more under tracemalloc.
+        """
+        timings, google_calls, google_round_trips, telegram_calls = [], 0, 0, 0
+        for _ in range(self.iterations):
+            if before is not None:
+                await before()
+            if self.cold:
+                self.bot.SCHEDULE_CACHE = self.bot.RenderedScheduleCache(self.bot.SCHEDULE_CACHE_TTL_SECONDS, self.bot.SCHEDULE_CACHE_MAX_ENTRIES)
+            self.calendar.reset_counters()
+            self.telegram.reset_counters()
+            start = time.perf_counter()
+            await run()
+            timings.append(time.perf_counter() - start)
+            google_calls += self.calendar.request_count
+            google_round_trips += self.calendar.round_trips
+            telegram_calls += sum(self.telegram.calls_by_method().values())
+
+        if before is not None:
+            await before()
+        tracemalloc.start()
+        await run()
+        _, allocated = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        report(label, timings, allocated, google_calls / self.iterations, google_round_trips / self.iterations, telegram_calls / self.iterations)
+
+
+async def main(args, directory):
+    from _bot import load_bot
+    calendar = FakeCalendarServer().start()
+    telegram = FakeTelegramServer().start()
+    calendar_config_path = os.path.join(directory, 'calendars.json')
+    if args.venues:
+        with open(calendar_config_path, 'w') as config_file:
+            json.dump([
+                {'key': f"V{index}", 'calendar_id': f"venue-{index}", 'venue': f"Venue {index}", 'title': f"Venue {index}"}
+                for index in range(1, args.venues + 1)
+            ], config_file)
+    os.environ.update({
+        'BOT_TOKEN': '123456:fake-token',
+        'TEST_GROUPCHAT_ID': str(GROUPCHAT_ID),
+        'SOK_C_CALENDAR_ID': 'sok-c',
+        'SOK_R_CALENDAR_ID': 'sok-r',
+        'LL_CALENDAR_ID': 'll',
+        'CALENDAR_CONFIG_PATH': calendar_config_path,
+        'CALENDAR_API_ROOT_URL': calendar.root_url,
+        'TELEGRAM_BASE_URL': telegram.base_url,
+        'TELEGRAM_RATE_LIMITED': 'false',
+        'EVENT_STORE_PATH': '' if args.no_store else os.path.join(directory, 'events.db'),
+        'EVENT_SYNC_LOOKBACK_DAYS': str((datetime.date.today() - datetime.date(2025, 1, 1)).days),
+        'MESSAGE_REGISTRY_PATH': os.path.join(directory, 'bot_state.db'),
+        'PAYROLL_LEDGER_PATH': '' if args.no_ledger else os.path.join(directory, 'payroll.db'),
+        'AUTO_REFRESH_INTERVAL_SECONDS': '0',
+        'PAYMENTS_ARCHIVE_ENABLED': 'false',
+        'REPORT_JOB_REUSE_SECONDS': '0',  # Every run builds the sheet instead of resending the last one
+    })
+    bot = load_bot()
+    bot.warm_up_imports()  # Keep import time out of the measurements
+
+    calendar_ids = [config[1] for config in bot.CALENDAR_CONFIGS]
+    events = generate_events(
+        args.events, substitute_ratio=args.substitute_ratio, shadowing_ratio=args.shadowing_ratio,
+        description_format=args.description_format
+    )
+    for index, event in enumerate(events):
+        # Keep the assigned ids, so the /edit run can change an existing event
+        events[index] = calendar.add_event(calendar_ids[index % len(calendar_ids)], event)
+    print(f"{args.events} events in {len(calendar_ids)} calendars, {args.description_format} descriptions, "
+          f"{args.iterations} iterations{', cold cache' if args.cold else ''}{', no event store' if args.no_store else ''}"
+          f"{', no payroll ledger' if args.no_ledger else ''}")
+
+    app = bot.build_application()
+    bot.register_handlers(app)
+    await app.initialize()
+    harness = Harness(bot, app, calendar, telegram, args.iterations, args.cold)
+
+    # Functions on their own, on one week of normalized sessions
+    client = await bot.get_calendar_client()
+    time_min, time_max = bot.get_fetch_window(WEEK)
+    results = await bot.fetch_all_calendar_events(bot.CALENDAR_CONFIGS, time_min, time_max, client)
+    sessions = [session for _, venue_sessions, _ in results for session in venue_sessions]
+    venue_sessions = [(config[2], venue_sessions) for config, venue_sessions, _ in results]
+
+    async def render():
+        bot.get_formatted_events(sessions)
+
+    async def payroll():
+        frame = bot.build_payroll_frame(venue_sessions)
+        bot.build_payment_sheet(frame, *bot.summarize_payroll(frame))
+
+    # Every event, as a term-length /conflicts check would see them
+    term_sessions = [
+        (config[2], [bot.normalize_event(event) for event in events[index::len(calendar_ids)]])
+        for index, config in enumerate(bot.CALENDAR_CONFIGS)
+    ]
+
+    async def conflicts():
+        bot.find_teacher_conflicts(term_sessions)
+
+    await harness.measure("get_formatted_events (1 week)", render)
+    await harness.measure("payroll (1 week)", payroll)
+    await harness.measure(f"find_teacher_conflicts ({args.events})", conflicts)
+
+    # Handlers end to end
+    await harness.measure("/schedule ALL", lambda: harness.handle(f"/schedule ALL {WEEK}"))
+    first_key = bot.CALENDAR_CONFIGS[0][0]
+    await harness.measure(f"/schedule {first_key}", lambda: harness.handle(f"/schedule {first_key} {WEEK}"))
+    await harness.measure("/send ALL", lambda: harness.handle(f"/send ALL {WEEK}"))
+
+    await harness.handle(f"/send ALL {WEEK}")
+    message_id = bot.LAST_SENT_MESSAGE_ID
+    changed_event = next(event for event in events if event['start']['dateTime'] >= '2025-05-03')
+    revisions = iter(range(1, 10 ** 9))
+
+    async def change_event():
+        calendar.add_event(calendar_ids[events.index(changed_event) % len(calendar_ids)],
+                           dict(changed_event, summary=f"{changed_event['summary']} rev {next(revisions)}"))
+
+    await harness.measure("/edit ALL, one event changed", lambda: harness.handle(f"/edit {message_id}"), before=change_event)
+    await harness.measure("/edit ALL, unchanged", lambda: harness.handle(f"/edit {message_id}"))
+
+    async def payment_sheet(report_format):
+        # The command only starts a background job, so wait until the sheet has been sent
+        await harness.handle(f"/paymentforall {' '.join(PAYMENT_PERIOD)} {report_format}")
+        await asyncio.gather(*(job.task for job in bot.REPORT_JOBS.jobs() if job.task is not None))
+
+    await harness.measure("/paymentforall 1 month xlsx", lambda: payment_sheet('xlsx'))
+    await harness.measure("/paymentforall 1 month csv", lambda: payment_sheet('csv'))
+    await harness.measure("/payrolltotals", lambda: harness.handle("/payrolltotals"))
+    await harness.measure("/conflicts 1 month", lambda: harness.handle(f"/conflicts {' '.join(PAYMENT_PERIOD)}"))
+    await harness.measure("/myschedule @teacher7", lambda: harness.handle(f"/myschedule @teacher7 {WEEK}"))
+
+    # Every synthetic teacher signed up for the digest, each with a private chat
+    for index, (_, handle) in enumerate(TEACHERS):
+        bot.get_teacher_chats().register(handle, USER_ID + 1 + index)
+    await harness.measure(f"/digest {len(TEACHERS)} teachers", lambda: harness.handle(f"/digest {WEEK}"))
+
+    await app.shutdown()
+    calendar.stop()
+    telegram.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=3000)
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--description-format', choices=['plain', 'html'], default='plain')
+    parser.add_argument('--substitute-ratio', type=float, default=0.1)
+    parser.add_argument('--shadowing-ratio', type=float, default=0.1)
+    parser.add_argument('--cold', action='store_true', help="Clear the rendered schedule cache before every run")
+    parser.add_argument('--no-store', action='store_true', help="Fetch from the Calendar API instead of the local event store")
+    parser.add_argument('--no-ledger', action='store_true', help="Build past payment sheets from the calendars instead of the payroll ledger")
+    parser.add_argument('--venues', type=int, default=0, help="Venues to configure in calendars.json, 0 for the three built-in ones")
+    args = parser.parse_args()
+
+    sys.stdout.reconfigure(line_buffering=True)
+    with tempfile.TemporaryDirectory() as directory:
+        write_fake_token(directory)
+        os.chdir(directory)
+        asyncio.run(main(args, directory))
@@ -0,0 +1,66 @@
+"""
+Measures how long importing the bot takes and how much memory the process uses, in fresh interpreters.
+
+- eager: every heavy dependency is imported up front, as the bot did before lazy imports
+- lazy: only the bot module is imported, heavy dependencies load on first use
+- lazy + warm up: the lazy import followed by warm_up_imports(), i.e. the state once the post-init warm up has run
+
+Usage:
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MEASURE = """
+import sys, json, time
+sys.path.insert(0, {benchmarks_dir!r})
+start = time.perf_counter()
+{eager_imports}
+from _bot import load_bot
+bot = load_bot()
+import_seconds = time.perf_counter() - start
+rss_after_import = int(open('/proc/self/statm').read().split()[1]) * {page_size}
+warm_up_seconds = None
+if {warm_up}:
+    start = time.perf_counter()
+    bot.warm_up_imports()
+    warm_up_seconds = time.perf_counter() - start
+rss_after_warm_up = int(open('/proc/self/statm').read().split()[1]) * {page_size}
+print(json.dumps([import_seconds, rss_after_import, warm_up_seconds, rss_after_warm_up]))
+"""
+
+EAGER_IMPORTS = """
+import numpy, pandas, xlsxwriter, httplib2, google_auth_httplib2, google.oauth2.credentials
+import google.auth.transport.requests, googleapiclient.discovery, googleapiclient.errors, google_auth_oauthlib.flow
+"""
+
+
+def measure(eager, warm_up):
+    code = MEASURE.format(
+        benchmarks_dir=BENCHMARKS_DIR, eager_imports=EAGER_IMPORTS if eager else '', warm_up=warm_up, page_size=os.sysconf('SC_PAGE_SIZE')
+    )
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(runs):
+    scenarios = [("eager", True, False), ("lazy", False, False), ("lazy + warm up", False, True)]
+    for label, eager, warm_up in scenarios:
+        results = [measure(eager, warm_up) for _ in range(runs)]
+        import_ms = statistics.median(result[0] for result in results) * 1000
+        rss_mb = statistics.median(result[1] for result in results) / 2 ** 20
+        line = f"{label:<16} import {import_ms:7.1f} ms   RSS after import {rss_mb:6.1f} MB"
+        if warm_up:
+            warm_up_ms = statistics.median(result[2] for result in results) * 1000
+            warm_rss_mb = statistics.median(result[3] for result in results) / 2 ** 20
+            line += f"   warm up {warm_up_ms:7.1f} ms   RSS after warm up {warm_rss_mb:6.1f} MB"
+        print(line)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,206 @@
+"""
+A local stand-in for the Google Calendar API events().list endpoint.
+
+Supports timeMin/timeMax windows, pagination with maxResults/pageToken, and incremental sync
+with syncToken/nextSyncToken including 410 Gone for expired tokens. Requests can also be sent
+together to the batch endpoint, /batch/calendar/v3, in the multipart/mixed batch format.
+Calendars added to failing_calendars answer 500, to check that one failure does not affect the others.
+Point the bot at it with CALENDAR_API_ROOT_URL=http://127.0.0.1:<port>/calendar/v3/
+
+Usage:
+    server = FakeCalendarServer()
+    server.start()
+    server.add_event('calendar-id', {...})
+    ...
+    server.stop()
+"""
+import re
+import json
+import datetime
+import threading
+import itertools
+import email.parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+EVENTS_PATH = re.compile(r'^/calendar/v3/calendars/([^/]+)/events$')
+BATCH_PATH = '/batch/calendar/v3'
+DEFAULT_MAX_RESULTS = 250
+
+
+def _parse_time(value):
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def _event_time(event_time):
+    return _parse_time(event_time.get('dateTime', event_time.get('date')))
+
+
+class FakeCalendarServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.calendars = {}
+        self.changes = []  # (version, calendar_id, event_id)
+        self.version = 0
+        self.expired_before = 0  # Sync tokens older than this version get 410 Gone
+        self.failing_calendars = set()  # Calendar ids whose requests get 500
+        self.request_count = 0  # events().list calls, also those inside a batch
+        self.round_trips = 0  # HTTP requests, a batch counts once
+        self.requests = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/calendar/v3/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_event(self, calendar_id, event):
+        """
+        Add or replace an event. A fresh id and etag are assigned when missing.
+        """
+        with self._lock:
+            event = dict(event)
+            event.setdefault('id', f"evt{next(self._ids)}")
+            event.setdefault('status', 'confirmed')
+            self.version += 1
+            event['etag'] = f'"{self.version}"'
+            self.calendars.setdefault(calendar_id, {})[event['id']] = event
+            self.changes.append((self.version, calendar_id, event['id']))
+            return event
+
+    def cancel_event(self, calendar_id, event_id):
+        with self._lock:
+            event = self.calendars[calendar_id][event_id]
+            event['status'] = 'cancelled'
+            self.version += 1
+            event['etag'] = f'"{self.version}"'
+            self.changes.append((self.version, calendar_id, event_id))
+
+    def expire_sync_tokens(self):
+        with self._lock:
+            # Tokens handed out from now on carry the new version and stay valid
+            self.version += 1
+            self.expired_before = self.version
+
+    def reset_counters(self):
+        with self._lock:
+            self.request_count = 0
+            self.round_trips = 0
+            self.requests = []
+
+    def list_events(self, calendar_id, params):
+        """
+        Build an events().list response, or return (status, error body) on failure.
+        """
+        with self._lock:
+            self.request_count += 1
+            self.requests.append((calendar_id, params))
+            if calendar_id in self.failing_calendars:
+                return 500, {'error': {'code': 500, 'message': 'Backend Error'}}
+            events = self.calendars.get(calendar_id, {})
+            sync_token = params.get('syncToken')
+            if sync_token:
+                since = int(sync_token[1:])
+                if since < self.expired_before:
+                    return 410, {'error': {'code': 410, 'message': 'Sync token is no longer valid, a full sync is required.'}}
+                changed_ids = {event_id for version, changed_calendar, event_id in self.changes if version > since and changed_calendar == calendar_id}
+                items = [events[event_id] for event_id in changed_ids]
+            else:
+                items = list(events.values())
+                if params.get('showDeleted') != 'true':
+                    items = [event for event in items if event['status'] != 'cancelled']
+                if 'timeMin' in params:
+                    time_min = _parse_time(params['timeMin'])
+                    items = [event for event in items if _event_time(event['end']) > time_min]
+                if 'timeMax' in params:
+                    time_max = _parse_time(params['timeMax'])
+                    items = [event for event in items if _event_time(event['start']) < time_max]
+            items.sort(key=lambda event: (_event_time(event['start']), event['id']))
+            current_version = self.version
+
+        max_results = int(params.get('maxResults', DEFAULT_MAX_RESULTS))
+        offset = int(params.get('pageToken', 0))
+        page = items[offset:offset + max_results]
+        response = {'kind': 'calendar#events', 'items': page}
+        if offset + max_results < len(items):
+            response['nextPageToken'] = str(offset + max_results)
+        else:
+            response['nextSyncToken'] = f"v{current_version}"
+        return 200, response
+
+    def handle_path(self, path):
+        url = urlparse(path)
+        match = EVENTS_PATH.match(url.path)
+        if not match:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return self.list_events(unquote(match.group(1)), params)
+
+    def handle_batch(self, content_type, body):
+        """
+        Answer a multipart/mixed batch with one application/http part per inner request.
+        """
+        message = email.parser.BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        boundary = 'batch_fake_calendar'
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().lstrip().split('\n', 1)[0].strip()
+            _, path, _ = request_line.split(' ', 2)
+            status, response = self.handle_path(path)
+            payload = json.dumps(response)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json; charset=UTF-8\r\n"
+                f"Content-Length: {len(payload.encode())}\r\n\r\n{payload}\r\n"
+            )
+        return f"multipart/mixed; boundary={boundary}", (''.join(parts) + f"--{boundary}--\r\n").encode()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.round_trips += 1
+                self._send(*server.handle_path(self.path))
+
+            def do_POST(self):
+                with server._lock:
+                    server.round_trips += 1
+                if urlparse(self.path).path != BATCH_PATH:
+                    self._send(404, {'error': {'code': 404, 'message': 'Not Found'}})
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type, payload = server.handle_batch(self.headers['Content-Type'], body)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,140 @@
+"""
+A local stand-in for the Telegram Bot API.
+
+Answers the methods the bot calls (getMe, sendMessage, editMessageText, sendDocument and the webhook
+and polling setup calls) with the minimal objects python-telegram-bot needs, and records every call.
+Point the bot at it with TELEGRAM_BASE_URL=http://127.0.0.1:<port>/bot
+
+Usage:
+    server = FakeTelegramServer()
+    server.start()
+    ...
+    server.calls_by_method()
+    server.stop()
+"""
+import json
+import time
+import threading
+import itertools
+import collections
+import email.parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_bot'}
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 128  # The bot opens up to TELEGRAM_CONNECTION_POOL_SIZE connections at once
+
+
+class FakeTelegramServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.calls = []  # (method, params)
+        self.messages = {}  # (chat id, message id) -> text
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = Server((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = []
+
+    def calls_by_method(self):
+        with self._lock:
+            return dict(collections.Counter(method for method, _ in self.calls))
+
+    def _message(self, chat_id, message_id, text=None):
+        chat_id = int(chat_id)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'},
+            'from': BOT_USER,
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    def call(self, method, params):
+        """
+        Build the result of a Bot API method, or return (status, error body) on failure.
+        """
+        with self._lock:
+            self.calls.append((method, params))
+            if method == 'getMe':
+                return 200, {'ok': True, 'result': BOT_USER}
+            if method == 'getUpdates':
+                return 200, {'ok': True, 'result': []}
+            if method in ('setWebhook', 'deleteWebhook'):
+                return 200, {'ok': True, 'result': True}
+            if method == 'sendMessage':
+                message_id = next(self._message_ids)
+                self.messages[(int(params['chat_id']), message_id)] = params.get('text')
+                return 200, {'ok': True, 'result': self._message(params['chat_id'], message_id, params.get('text'))}
+            if method == 'sendDocument':
+                message = self._message(params['chat_id'], next(self._message_ids))
+                message['document'] = {'file_id': 'fake-file', 'file_unique_id': 'fake-file'}
+                return 200, {'ok': True, 'result': message}
+            if method == 'editMessageText':
+                key = (int(params['chat_id']), int(params['message_id']))
+                if key not in self.messages:
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message to edit not found'}
+                if self.messages[key] == params.get('text'):
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message is not modified'}
+                self.messages[key] = params.get('text')
+                return 200, {'ok': True, 'result': self._message(key[0], key[1], params.get('text'))}
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = urlparse(self.path).path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self._send(*server.call(method, self._parse_params(body)))
+
+            def _parse_params(self, body):
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    message = email.parser.BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+                    params = {}
+                    for part in message.get_payload():
+                        name = part.get_param('name', header='content-disposition')
+                        if part.get_filename() is None:
+                            params[name] = part.get_payload(decode=True).decode()
+                        else:
+                            params[name] = len(part.get_payload(decode=True))  # Only the file size is kept
+                    return params
+                if content_type.startswith('application/json'):
+                    return json.loads(body or b'{}')
+                return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,71 @@
+"""
+Generates synthetic Google Calendar events in the format the bot reads.
+
+Descriptions follow the 'Teacher: Name @handle (Other Name @handle shadowing|substitute)' convention,
+optionally wrapped in the HTML tags Google Calendar adds.
+"""
+import random
+import datetime
+
+TEACHERS = [(f"Teacher {i}", f"@teacher{i}") for i in range(1, 41)] + [("Hoo Bird", "@hoobird")]
+COURSES = ["Scratch Junior", "Python Level 1", "Python Level 2", "Robotics Explorer", "App Inventor", "Minecraft Coding"]
+LESSON_STARTS = [9, 11, 14, 16, 18]
+
+
+def make_description(teacher, other=None, other_role=None, description_format='plain'):
+    name, handle = teacher
+    text = f"Teacher: {name} {handle}"
+    if other:
+        text += f" ({other[0]} {other[1]} {other_role})"
+    if description_format == 'html':
+        return f"<span>Module details</span><br><b>{text}</b><br><ul>Bring laptop</ul>"
+    return text
+
+
+def generate_events(count, start_date=datetime.date(2025, 5, 1), substitute_ratio=0.1, shadowing_ratio=0.1,
+                    postponed_ratio=0.05, description_format='plain', seed=0):
+    """
+    Generate count events spread over consecutive days from start_date, ordered by start time.
+
+    Args:
+        count (int): Number of events.
+        start_date (datetime.date): Day of the first event.
+        substitute_ratio (float): Share of events with a substitute teacher.
+        shadowing_ratio (float): Share of events with a shadowing teacher.
+        postponed_ratio (float): Share of events marked [POSTPONED].
+        description_format (str): 'plain' or 'html'.
+        seed (int): Random seed, so runs are repeatable.
+
+    Returns:
+        list: Events as the Calendar API returns them.
+    """
+    rng = random.Random(seed)
+    events = []
+    for i in range(count):
+        day = start_date + datetime.timedelta(days=i // len(LESSON_STARTS))
+        hour = LESSON_STARTS[i % len(LESSON_STARTS)]
+        start = datetime.datetime(day.year, day.month, day.day, hour, 0)
+        end = start + datetime.timedelta(hours=rng.choice([1, 1.5, 2]))
+
+        teacher = rng.choice(TEACHERS)
+        other, other_role = None, None
+        roll = rng.random()
+        if roll < substitute_ratio:
+            other, other_role = rng.choice(TEACHERS), rng.choice(["substitute", "substituting"])
+        elif roll < substitute_ratio + shadowing_ratio:
+            other, other_role = rng.choice(TEACHERS), "shadowing"
+
+        summary = rng.choice(COURSES)
+        if rng.random() < postponed_ratio:
+            summary = "[POSTPONED] " + summary
+
+        events.append({
+            'id': f"synthetic{i}",
+            'etag': f'"{seed}-{i}"',
+            'status': 'confirmed',
+            'summary': summary,
+            'description': make_description(teacher, other, other_role, description_format),
+            'start': {'dateTime': start.isoformat() + '+08:00'},
+            'end': {'dateTime': end.isoformat() + '+08:00'},
+        })
+    return events
@@ -1,42 +1,178 @@
 import os.path
 import re
 import os
+import io
 import csv
+import json
+import time
+import hashlib
+import asyncio
+import sqlite3
 import datetime
-import pandas as pd
+import functools
+import collections
+import threading
+import importlib
+import dataclasses
+import contextlib
+import urllib.parse
+import html
+import math
+import heapq
+import itertools
+import argparse
+import secrets
 
 from dotenv import load_dotenv
-from telegram import Update, Bot
+from telegram import Update
+from telegram.constants import ChatType
+from telegram.error import BadRequest, Forbidden
 from zoneinfo import ZoneInfo
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
+
+# pandas, numpy, xlsxwriter and the Google client libraries are imported on first use with lazy_import,
+# since most commands never need them and importing them slows down every restart
 
 #region environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 # GROUPCHAT_ID = os.getenv('GROUPCHAT_ID') # Use this for the actual group chat
 GROUPCHAT_ID = os.getenv('TEST_GROUPCHAT_ID') # Use this for a testing group chat
+# Several group chats can be given separated by commas, /send and /sendrm then post to each of them.
+# Numeric chat IDs are kept as int, others like '@channelusername' as they are
+GROUPCHAT_IDS = [
+    int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+    for chat_id in (part.strip() for part in (GROUPCHAT_ID or '').split(','))
+    if chat_id
+]
+
+# All handlers share the application's bot, whose HTTP connections are kept alive and reused
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv('TELEGRAM_CONNECTION_POOL_SIZE', 16))
+# Outgoing requests are throttled to Telegram's global and per-chat limits, a flood wait is retried this many times
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 3))
+# Users allowed to use /stats, separated by commas. Anyone may use it when empty
+ADMIN_USER_IDS = [int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()]
+# Serve the metrics in the Prometheus text format on this port, 0 to turn off
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_WINDOW_SIZE = int(os.getenv('METRICS_WINDOW_SIZE', 1024)) # Recent durations kept per command and stage for percentiles
+TELEGRAM_RATE_LIMITED = os.getenv('TELEGRAM_RATE_LIMITED', 'true').lower() == 'true' # Turn off only for a local fake Bot API
+# Point the bot at another Bot API server, e.g. a local fake one such as http://127.0.0.1:8081/bot
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL')
+# Number of updates handled at the same time, 1 handles them one after another
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 16))
 
+# How updates are received, 'polling' or 'webhook'. Overridden with --mode
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Webhook server settings, see run_webhook. WEBHOOK_URL is the public https URL Telegram posts updates to
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Telegram sends this in the X-Telegram-Bot-Api-Secret-Token header, other requests are rejected
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+
+# Venues are read from this JSON file, see load_calendar_registry. Without the file, the three venues of
+# DEFAULT_CALENDARS are used with the calendar IDs below
+CALENDAR_CONFIG_PATH = os.getenv('CALENDAR_CONFIG_PATH', 'calendars.json')
 # Rename constants to a different calendar ID if needed
 # This is based on specific use case where there are two calendars for vendor
 SOK_C_CALENDAR_ID = os.getenv('SOK_C_CALENDAR_ID')
 SOK_R_CALENDAR_ID = os.getenv('SOK_R_CALENDAR_ID')
 LL_CALENDAR_ID = os.getenv('LL_CALENDAR_ID')
+
+# Point the Calendar API at another server, e.g. a local fake endpoint such as http://127.0.0.1:8080/calendar/v3/
+CALENDAR_API_ROOT_URL = os.getenv('CALENDAR_API_ROOT_URL')
+# Batched requests go to the server's batch endpoint, which the discovery document always sets to Google's
+CALENDAR_API_BATCH_URL = os.getenv('CALENDAR_API_BATCH_URL') or (urllib.parse.urljoin(CALENDAR_API_ROOT_URL, '/batch/calendar/v3') if CALENDAR_API_ROOT_URL else None)
 #endregion
 
 #region environment constants
 PAYMENTS_EXCEL_FOLDER = "payments"
 TEACHERS_25_HOURLY_RATE = ["@hoobird"] # This list consists of telegram handles where the teacher's hourly rate is $25/hr instead of default $20/hr
+DEFAULT_HOURLY_RATE = 20
+SENIOR_HOURLY_RATE = 25
+SHADOWING_HOURLY_RATE = 15
+SHADOWING_HOURS = 1
+MAX_PAYMENT_PERIOD_DAYS = 400 # Longest period /paymentforall accepts, about a year
+REPORT_MAX_CONCURRENT_JOBS = int(os.getenv('REPORT_MAX_CONCURRENT_JOBS', 2)) # Payment sheets prepared at the same time, others wait their turn
+MIN_VENUE_CHANGE_MINUTES = int(os.getenv('MIN_VENUE_CHANGE_MINUTES', 30)) # /conflicts flags shorter breaks between sessions at different venues
+TELEGRAM_MESSAGE_LIMIT = 4096 # Longest text Telegram accepts in one message
+REPORT_JOB_REUSE_SECONDS = int(os.getenv('REPORT_JOB_REUSE_SECONDS', 300)) # A sheet sent this recently is sent again instead of rebuilt
+PAYMENTS_ARCHIVE_ENABLED = os.getenv('PAYMENTS_ARCHIVE_ENABLED', 'true').lower() == 'true' # Also save sent payment sheets in PAYMENTS_EXCEL_FOLDER
+XLSX_FORMAT = "xlsx"
+CSV_FORMAT = "csv"
+PARQUET_FORMAT = "parquet"
+REPORT_FORMATS = [XLSX_FORMAT, CSV_FORMAT, PARQUET_FORMAT]
+PAYMENT_SHEET_COLUMNS = [
+    'Venue', 'Date', 'Day', 'Course', 'Start Time', 'End Time', 'Number of hours',
+    'Teacher Name', 'Teacher Handle', 'Hourly Rate', 'Amount', 'Remarks'
+]
+PAYROLL_TEXT_COLUMNS = ['Venue', 'Date', 'Day', 'Course', 'Start Time', 'End Time', 'Teacher Name', 'Teacher Handle', 'Remarks']
+# Payroll of weeks that ended more than PAYROLL_FINALIZE_AFTER_DAYS ago is written once to this ledger and read back
+# instead of fetched again. Empty turns the ledger off
+PAYROLL_LEDGER_PATH = os.getenv('PAYROLL_LEDGER_PATH', 'payroll.db')
+PAYROLL_FINALIZE_AFTER_DAYS = int(os.getenv('PAYROLL_FINALIZE_AFTER_DAYS', 7))
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
-SOK_C_BRANCH_HEADER = "================ <b><u> Stars of Kovan Coding Classroom </u></b> ================\n\n"
-SOK_R_BRANCH_HEADER = "================ <b><u> Stars of Kovan Robotics Classroom </u></b> ================\n\n"
-LL_BRANCH_HEADER = "================ <b><u> 35 Lowland Branch </u></b> ================\n\n"
-SOK_C_KEY = "SOKC"
-SOK_R_KEY = "SOKR"
-LL_KEY = "LL"
+BRANCH_HEADER_TEMPLATE = "================ <b><u> {title} </u></b> ================\n\n"
+ALL_KEY = "ALL"
+
+# Calendars are fetched together with batched requests, so the all-venue commands need one round trip per page
+# The Calendar API accepts at most 50 requests in a batch
+CALENDAR_BATCH_MAX_REQUESTS = int(os.getenv('CALENDAR_BATCH_MAX_REQUESTS', 50))
+CALENDAR_FETCH_TIMEOUT_SECONDS = float(os.getenv('CALENDAR_FETCH_TIMEOUT_SECONDS', 20))
+
+# Google API calls are blocking, so they run on their own thread pool instead of the event loop
+GOOGLE_API_MAX_WORKERS = int(os.getenv('GOOGLE_API_MAX_WORKERS', 8))
+
+# Credentials are kept in memory and refreshed in the background this long before they expire
+CREDENTIALS_REFRESH_MARGIN_SECONDS = int(os.getenv('CREDENTIALS_REFRESH_MARGIN_SECONDS', 300))
+
+# Local copy of the calendars kept current with incremental sync. Set EVENT_STORE_PATH to an empty value to always query Google directly
+EVENT_STORE_PATH = os.getenv('EVENT_STORE_PATH', 'events.db')
+EVENT_SYNC_LOOKBACK_DAYS = int(os.getenv('EVENT_SYNC_LOOKBACK_DAYS', 90)) # How far back the event store keeps events
+
+# events().list is paged at the API maximum and only asks for the fields the bot reads
+EVENTS_LIST_PAGE_SIZE = 2500
+EVENTS_LIST_FIELDS = 'nextPageToken,nextSyncToken,items(id,etag,status,summary,description,start,end)'
+EVENT_STORE_PAGE_SIZE = 500
+
+# Rendered schedules are reused for repeat /schedule and /send of the same venue and week
+SCHEDULE_CACHE_TTL_SECONDS = int(os.getenv('SCHEDULE_CACHE_TTL_SECONDS', 300))
+SCHEDULE_CACHE_MAX_ENTRIES = int(os.getenv('SCHEDULE_CACHE_MAX_ENTRIES', 64))
+# Each day of a schedule is rendered once per version of its events, so re-rendering a week only formats the days that changed
+DAY_FRAGMENT_CACHE_MAX_ENTRIES = int(os.getenv('DAY_FRAGMENT_CACHE_MAX_ENTRIES', 2048))
+SCHEDULE_MESSAGE_LIMIT = 3900 # Longest schedule part, leaving room under TELEGRAM_MESSAGE_LIMIT for the edit timestamp
+
+# Schedules posted to group chats are re-rendered this often and edited only when they changed. 0 turns it off
+AUTO_REFRESH_INTERVAL_SECONDS = int(os.getenv('AUTO_REFRESH_INTERVAL_SECONDS', 900))
+
+# Every schedule posted to a group chat is recorded here, so it can be refreshed and bulk edited after a restart
+MESSAGE_REGISTRY_PATH = os.getenv('MESSAGE_REGISTRY_PATH', 'bot_state.db')
+EDIT_ALL_MAX_CONCURRENT = int(os.getenv('EDIT_ALL_MAX_CONCURRENT', 5))
+
+# Teachers who used /myschedule in a private chat are sent their lessons for the coming week on this day, e.g. 'sunday'.
+# Empty turns it off. The time is in UTC
+TEACHER_DIGEST_DAY = os.getenv('TEACHER_DIGEST_DAY', '').strip().lower()
+TEACHER_DIGEST_TIME = os.getenv('TEACHER_DIGEST_TIME', '10:00')
+WEEKDAY_NAMES = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday'] # In the day numbering of JobQueue.run_daily
+
+# Venues used when there is no CALENDAR_CONFIG_PATH file, in the same format as its entries
+DEFAULT_CALENDARS = [
+    {'key': 'SOKC', 'calendar_id': SOK_C_CALENDAR_ID, 'venue': 'SOK-C', 'title': 'Stars of Kovan Coding Classroom'},
+    {'key': 'SOKR', 'calendar_id': SOK_R_CALENDAR_ID, 'venue': 'SOK-R', 'title': 'Stars of Kovan Robotics Classroom'},
+    {'key': 'LL', 'calendar_id': LL_CALENDAR_ID, 'venue': 'LL', 'title': '35 Lowland Branch'},
+]
+
+# Every calendar in the event store is synced in the background this often, so commands read warm data. 0 turns it off.
+# A venue can set its own sync_interval_seconds in CALENDAR_CONFIG_PATH
+CALENDAR_SYNC_INTERVAL_SECONDS = int(os.getenv('CALENDAR_SYNC_INTERVAL_SECONDS', 0))
+CALENDAR_SYNC_WORKERS = int(os.getenv('CALENDAR_SYNC_WORKERS', 4)) # Calendars are split between this many background workers
+# Commands do not sync a calendar that was synced less than this long ago. 0 always syncs
+CALENDAR_SYNC_MAX_AGE_SECONDS = int(os.getenv('CALENDAR_SYNC_MAX_AGE_SECONDS', 0))
 REMINDER_MSG = """
 ====================================
 Please arrive 5-10 mins before lesson starts.
@@ -67,6 +203,122 @@ Please react to lesson reminder message above to acknowledge your classes
 """
 
 LAST_SENT_MESSAGE_ID = None
+MESSAGE_REGISTRY = None
+TEACHER_CHATS = None
+PAYROLL_LEDGER = None
+BACKGROUND_TASKS = set() # Keeps fire-and-forget tasks referenced until they finish
+
+# Modules imported in the background once the bot has started, so the first command using them does not wait.
+# google_auth_oauthlib is left out as it is only needed for the first-time OAuth flow
+WARM_UP_ON_START = os.getenv('WARM_UP_ON_START', 'true').lower() == 'true'
+WARM_UP_MODULES = [
+    'numpy', 'pandas', 'xlsxwriter', 'httplib2', 'google_auth_httplib2', 'google.oauth2.credentials',
+    'google.auth.transport.requests', 'googleapiclient.discovery', 'googleapiclient.errors'
+]
+GOOGLE_API_EXECUTOR = ThreadPoolExecutor(max_workers=GOOGLE_API_MAX_WORKERS, thread_name_prefix='google-api')
+CALENDAR_CLIENT = None
+CALENDAR_CLIENT_LOCK = asyncio.Lock()
+EVENT_STORE = None
+METRICS_SERVER = None
+CALENDAR_SYNC_LOCKS = {}
+CALENDAR_SYNCED_AT = {} # Calendar ID -> event loop time of its last successful sync
+CALENDAR_SYNC_WORKER_POOL = None
+#endregion
+
+#region Calendar Registry
+@dataclasses.dataclass(slots=True, frozen=True)
+class VenueRates:
+    """
+    Hourly rates paid for the sessions of one venue, see load_calendar_registry.
+    """
+    hourly_rate: float
+    senior_hourly_rate: float
+    senior_handles: frozenset # Telegram handles paid senior_hourly_rate
+
+def load_calendar_registry(path):
+    """
+    Load the venues from a JSON config file, or use DEFAULT_CALENDARS when the file does not exist.
+
+    The file is a list of venues in the order they are shown and merged. Each venue is an object with
+    'key' (used in commands, e.g. "SOKC"), 'calendar_id' or 'calendar_id_env' (an environment variable
+    holding the ID), 'venue' (the name in payment sheets, defaults to the key) and 'title' (shown in the
+    branch header) or 'header' (the whole header). Optional 'hourly_rate', 'senior_hourly_rate',
+    'senior_teachers' and 'sync_interval_seconds' override DEFAULT_HOURLY_RATE, SENIOR_HOURLY_RATE,
+    TEACHERS_25_HOURLY_RATE and CALENDAR_SYNC_INTERVAL_SECONDS for that venue.
+
+    Args:
+        path (str): The config file.
+
+    Returns:
+        tuple: (calendar configs, VenueRates by venue name, background sync interval by calendar ID). Calendar configs
+               are (calendar key, calendar id, venue name, branch header) tuples.
+
+    Raises:
+        ValueError: When the file has no venues, or a venue has no key or repeats a key or venue name.
+    """
+    entries = DEFAULT_CALENDARS
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as config_file:
+            entries = json.load(config_file)
+        print(f"Loaded {len(entries)} venues from {path}")
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must be a list of venues")
+
+    calendar_configs, venue_rates, sync_intervals = [], {}, {}
+    for entry in entries:
+        key = entry.get('key')
+        if not key or key == ALL_KEY:
+            raise ValueError(f"Venue {entry!r} needs a key other than {ALL_KEY}")
+        if any(config[0] == key for config in calendar_configs):
+            raise ValueError(f"Calendar key {key} is used by more than one venue")
+        venue = entry.get('venue', key)
+        if venue in venue_rates:
+            raise ValueError(f"Venue name {venue} is used by more than one venue")
+
+        calendar_id = entry['calendar_id'] if 'calendar_id' in entry else os.getenv(entry.get('calendar_id_env', ''))
+        header = entry.get('header') or BRANCH_HEADER_TEMPLATE.format(title=entry.get('title', venue))
+        calendar_configs.append((key, calendar_id, venue, header))
+        venue_rates[venue] = VenueRates(
+            entry.get('hourly_rate', DEFAULT_HOURLY_RATE),
+            entry.get('senior_hourly_rate', SENIOR_HOURLY_RATE),
+            # Session handles are lowercase, so '@HooBird' in the file still matches
+            frozenset(handle.lower() for handle in entry.get('senior_teachers', TEACHERS_25_HOURLY_RATE)),
+        )
+        interval = entry.get('sync_interval_seconds', CALENDAR_SYNC_INTERVAL_SECONDS)
+        if calendar_id and interval > 0:
+            # A calendar shared by several venues is synced at the shortest of their intervals
+            sync_intervals[calendar_id] = min(interval, sync_intervals.get(calendar_id, interval))
+    return calendar_configs, venue_rates, sync_intervals
+
+def get_venue_rates(venue):
+    """
+    Get the hourly rates of a venue, or the default rates for a venue that is no longer configured.
+
+    Args:
+        venue (str): A venue name of CALENDAR_CONFIGS.
+
+    Returns:
+        VenueRates: The venue's rates.
+    """
+    rates = VENUE_RATES.get(venue)
+    if rates is None:
+        rates = VenueRates(DEFAULT_HOURLY_RATE, SENIOR_HOURLY_RATE, frozenset(handle.lower() for handle in TEACHERS_25_HOURLY_RATE))
+    return rates
+
+# (calendar key, calendar id, venue name, branch header), in the order venues are shown and merged
+CALENDAR_CONFIGS, VENUE_RATES, CALENDAR_SYNC_INTERVALS = load_calendar_registry(CALENDAR_CONFIG_PATH)
+CALENDARS_BY_KEY = {config[0]: config for config in CALENDAR_CONFIGS}
+# Calendar ID -> venue name, a calendar shared by several venues is named after all of them, e.g. 'SOK-C / SOK-R'
+CALENDAR_VENUE_NAMES = {
+    calendar_id: " / ".join(config[2] for config in CALENDAR_CONFIGS if config[1] == calendar_id)
+    for calendar_id in dict.fromkeys(config[1] for config in CALENDAR_CONFIGS)
+}
+# The venues lessons are paid at, the first venue of each calendar, so a calendar shared by several venues is paid once
+PAYROLL_CALENDAR_CONFIGS = [
+    config for index, config in enumerate(CALENDAR_CONFIGS)
+    if all(other[1] != config[1] for other in CALENDAR_CONFIGS[:index])
+]
+DEFAULT_CALENDAR_KEY = CALENDAR_CONFIGS[0][0] # Used when a command names no venue or an unknown one
 #endregion
 
 #region Google Calendar Functions
@@ -80,6 +332,8 @@ def get_google_credentials():
     Returns:
         google.oauth2.credentials.Credentials | google.auth.external_account_authorized_user.Credentials: A valid Google API credentials object.
     """
+    Credentials = lazy_import('google.oauth2.credentials').Credentials
+    Request = lazy_import('google.auth.transport.requests').Request
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
@@ -87,515 +341,3764 @@ def get_google_credentials():
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials_tym.json', SCOPES)
+            flow = lazy_import('google_auth_oauthlib.flow').InstalledAppFlow.from_client_secrets_file('credentials_tym.json', SCOPES)
             creds = flow.run_local_server(port=0)
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
     return creds
 
-def get_formatted_events(events):
-    formatted_events = {}
-    for event in events:
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        end = event['end'].get('dateTime', event['end'].get('date'))
-        summary = event.get('summary', 'Unnamed Event')
-        description = remove_unsupported_tags(event.get('description', ''))
-        match = re.search(r"Teacher:\s*(.*)", description)
-        teacher = match.group(1).strip() if match else ''
-        match = re.search(r'@(\w+)', description)
-        telegram_username = "@" + match.group(1) if match else ''
+async def run_in_google_executor(func, *args, **kwargs):
+    """
+    Run a blocking Google API call on GOOGLE_API_EXECUTOR and await its result.
+
+    Args:
+        func (callable): The blocking function to run.
+        *args: Positional arguments for func.
+        **kwargs: Keyword arguments for func.
+
+    Returns:
+        Any: The return value of func.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(GOOGLE_API_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+class AsyncCalendarClient:
+    """
+    Async wrapper around the Google Calendar API.
+
+    Credential loading, service building and request execution all run on GOOGLE_API_EXECUTOR,
+    so a slow Google call never stops the bot from handling other updates.
+    httplib2 is not thread safe, so every executor thread keeps its own authorised http object.
+    A single client is shared by every command, see get_calendar_client.
+    """
+
+    def __init__(self, creds, service):
+        self.creds = creds
+        self.service = service
+        self._thread_local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._refresh_task = None
+
+    @classmethod
+    async def create(cls):
+        """
+        Load credentials and build the Calendar service without blocking the event loop.
+
+        The service is built from the discovery document bundled with googleapiclient,
+        so no discovery request is made.
+
+        Returns:
+            AsyncCalendarClient: A client ready to make requests.
+        """
+        with METRICS.timer('stage', 'credentials_load'):
+            creds = await run_in_google_executor(get_google_credentials)
+        client_options = {'api_endpoint': CALENDAR_API_ROOT_URL} if CALENDAR_API_ROOT_URL else None
+        with METRICS.timer('stage', 'service_build'):
+            service = await run_in_google_executor(
+                lazy_import('googleapiclient.discovery').build, 'calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False, client_options=client_options
+            )
+        return cls(creds, service)
+
+    def _refresh_credentials(self):
+        with self._refresh_lock:
+            self.creds.refresh(lazy_import('google.auth.transport.requests').Request())
+            with open('token.json', 'w') as token:
+                token.write(self.creds.to_json())
+
+    async def refresh_credentials(self):
+        """
+        Refresh the in-memory credentials and save them to token.json.
+        """
+        await run_in_google_executor(self._refresh_credentials)
+
+    def start_background_refresh(self):
+        """
+        Start a task that refreshes the credentials CREDENTIALS_REFRESH_MARGIN_SECONDS before they expire,
+        so requests never have to wait on a token refresh.
+        """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def _refresh_periodically(self):
+        while True:
+            if self.creds.expiry is None:
+                return
+            seconds_to_expiry = (self.creds.expiry - datetime.datetime.utcnow()).total_seconds()
+            await asyncio.sleep(max(seconds_to_expiry - CREDENTIALS_REFRESH_MARGIN_SECONDS, 0))
+            try:
+                await self.refresh_credentials()
+                print(f"Google credentials refreshed, next expiry at {self.creds.expiry}")
+            except Exception as e:
+                print(f"Failed to refresh Google credentials. Error: {str(e)}")
+                await asyncio.sleep(60)
+
+    def _get_thread_http(self):
+        http = getattr(self._thread_local, 'http', None)
+        if http is None:
+            http = lazy_import('google_auth_httplib2').AuthorizedHttp(self.creds, http=lazy_import('httplib2').Http())
+            self._thread_local.http = http
+        return http
+
+    def _execute(self, request):
+        METRICS.increment('google_requests')
+        with METRICS.timer('stage', 'google_request'):
+            return request.execute(http=self._get_thread_http())
+
+    async def execute(self, request):
+        """
+        Execute a googleapiclient request on GOOGLE_API_EXECUTOR.
+
+        Args:
+            request (HttpRequest): The request built from the service, e.g. service.events().list(...).
+
+        Returns:
+            dict: The decoded response.
+        """
+        return await run_in_google_executor(self._execute, request)
+
+    def _build_list_request(self, **kwargs):
+        kwargs.setdefault('maxResults', EVENTS_LIST_PAGE_SIZE)
+        kwargs.setdefault('fields', EVENTS_LIST_FIELDS)
+        request = self.service.events().list(**kwargs)
+        # Google only compresses responses for clients that ask for gzip and mention it in their user agent
+        request.headers['accept-encoding'] = 'gzip'
+        request.headers['user-agent'] = request.headers.get('user-agent', 'tym-telegram-bot') + ' (gzip)'
+        return request
+
+    async def list_events(self, **kwargs):
+        """
+        Call events().list with the given parameters without blocking the event loop.
 
-        start_dt = datetime.datetime.fromisoformat(start)
-        end_dt = datetime.datetime.fromisoformat(end)
+        Unless given, pages are requested at EVENTS_LIST_PAGE_SIZE with a partial response of
+        EVENTS_LIST_FIELDS, and the response is gzipped.
 
-        event_text = f"{summary} ({start_dt.strftime('%H%Mhrs').lower()} to {end_dt.strftime('%H%Mhrs').lower()})\n <b>Teacher: </b>{teacher}"
+        Returns:
+            dict: One page of the events list response.
+        """
+        return await self.execute(self._build_list_request(**kwargs))
 
-        day_str = start_dt.strftime('%A %d %B %Y')
-        if day_str not in formatted_events:
-            formatted_events[day_str] = []
-        formatted_events[day_str].append(event_text)
+    def _new_batch(self, callback):
+        if CALENDAR_API_BATCH_URL:
+            return lazy_import('googleapiclient.http').BatchHttpRequest(callback=callback, batch_uri=CALENDAR_API_BATCH_URL)
+        return self.service.new_batch_http_request(callback=callback)
 
-    return formatted_events
+    def _execute_batch(self, requests):
+        results = [None] * len(requests)
 
-async def fetch_calendar_events(calendar_id, input_date_str, creds, service, number_of_days=7):
+        def collect(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        for offset in range(0, len(requests), CALENDAR_BATCH_MAX_REQUESTS):
+            batch = self._new_batch(collect)
+            indexes = range(offset, min(offset + CALENDAR_BATCH_MAX_REQUESTS, len(requests)))
+            for index in indexes:
+                batch.add(requests[index], request_id=str(index))
+            METRICS.increment('google_batches')
+            METRICS.increment('google_batched_requests', len(indexes))
+            try:
+                with METRICS.timer('stage', 'google_batch'):
+                    batch.execute(http=self._get_thread_http())
+            except Exception as e:
+                # The whole batch failed, e.g. a network error, so every request in it failed
+                for index in indexes:
+                    results[index] = results[index] or (None, e)
+        return results
+
+    async def list_events_batch(self, params_list):
+        """
+        Call events().list for several parameter sets in one batched round trip, see list_events.
+
+        Args:
+            params_list (list): The events().list parameters of each request.
+
+        Returns:
+            list: A (response, error) tuple for each request, in the same order as params_list.
+                  error is None when the request succeeded, so one failing calendar does not affect the others.
+        """
+        if len(params_list) == 1:
+            # A batch of one only adds the multipart overhead
+            try:
+                return [(await self.list_events(**params_list[0]), None)]
+            except Exception as e:
+                return [(None, e)]
+        requests = [self._build_list_request(**params) for params in params_list]
+        return await run_in_google_executor(self._execute_batch, requests)
+
+async def get_calendar_client():
+    """
+    Get the process-wide AsyncCalendarClient, creating it on first use.
+
+    Credentials are read from token.json and the service is built only once per process,
+    instead of on every command.
+
+    Returns:
+        AsyncCalendarClient: The shared client.
+    """
+    global CALENDAR_CLIENT
+    if CALENDAR_CLIENT is None:
+        async with CALENDAR_CLIENT_LOCK:
+            if CALENDAR_CLIENT is None:
+                client = await AsyncCalendarClient.create()
+                client.start_background_refresh()
+                CALENDAR_CLIENT = client
+    return CALENDAR_CLIENT
+
+def get_formatted_events(sessions):
+    """
+    Group sessions by day into the lines shown in a schedule message.
+
+    Args:
+        sessions (list): SessionRecords ordered by start time.
+
+    Returns:
+        dict: Day heading, e.g. 'Friday 02 May 2025', to the list of formatted session lines for that day.
+    """
+    return {day_str: [format_session(session) for session in day_sessions] for day_str, day_sessions in group_sessions_by_day(sessions).items()}
+
+def format_session(session):
+    return f"{session.summary} ({session.start.strftime('%H%Mhrs').lower()} to {session.end.strftime('%H%Mhrs').lower()})\n <b>Teacher: </b>{session.teacher}"
+
+def group_sessions_by_day(sessions):
+    """
+    Group sessions by their day heading, e.g. 'Friday 02 May 2025', keeping their order.
+
+    Args:
+        sessions (list): SessionRecords ordered by start time.
+
+    Returns:
+        dict: Day heading to the SessionRecords of that day.
+    """
+    sessions_by_day = {}
+    for session in sessions:
+        sessions_by_day.setdefault(session.start.strftime('%A %d %B %Y'), []).append(session)
+    return sessions_by_day
+
+def get_fetch_window(input_date_str, number_of_days=7):
+    """
+    Get the time range covered by a schedule or payment command.
+
+    The window starts the day after input_date_str (or today) and spans number_of_days days.
+
+    Args:
+        input_date_str (str): The starting date, formatted as 'YYYY-MM-DD'. Defaults to today when None.
+        number_of_days (int, optional): Number of days in the window. Defaults to 7.
+
+    Returns:
+        tuple: (time_min, time_max) as naive UTC datetimes.
+    """
+    now = datetime.datetime.utcnow() if input_date_str is None else datetime.datetime.strptime(input_date_str, '%Y-%m-%d')
+    return now + datetime.timedelta(days=1), now + datetime.timedelta(days=number_of_days+1)
+
+async def stream_calendar_events(calendar_id, time_min, time_max, client):
+    """
+    Yield the events of a Google Calendar within a window, ordered by start time, as they arrive.
+
+    Events are read from the local event store after an incremental sync when the window is
+    covered by the store, otherwise every page of the Calendar API list is followed.
+    Only one page is held in memory at a time.
+
+    Args:
+        calendar_id (str): The ID of the Google Calendar.
+        time_min (datetime.datetime): Start of the window as a naive UTC datetime.
+        time_max (datetime.datetime): End of the window as a naive UTC datetime.
+        client (AsyncCalendarClient): Google Calendar API client.
+
+    Yields:
+        dict: Events in the same format as the Calendar API returns them.
+    """
+    store = get_event_store()
+    if store is not None and store.covers(calendar_id, time_min):
+        await sync_calendar(calendar_id, client)
+        async for event in read_stored_events(calendar_id, time_min, time_max):
+            yield event
+        return
+
+    page_token = None
+    while True:
+        events_result = await client.list_events(
+            calendarId=calendar_id, timeMin=time_min.isoformat() + 'Z', timeMax=time_max.isoformat() + 'Z',
+            singleEvents=True, orderBy='startTime', pageToken=page_token
+        )
+        for event in events_result.get('items', []):
+            yield event
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return
+
+async def read_stored_events(calendar_id, time_min, time_max):
+    """
+    Yield the stored events of a calendar within a window, ordered by start time, one page at a time.
+
+    Args:
+        calendar_id (str): The ID of the Google Calendar.
+        time_min (datetime.datetime): Start of the window as a naive UTC datetime.
+        time_max (datetime.datetime): End of the window as a naive UTC datetime.
+
+    Yields:
+        dict: Events in the same format as the Calendar API returns them.
+    """
+    store = get_event_store()
+    after = None
+    while True:
+        events, after = await run_in_google_executor(store.query_page, calendar_id, time_min, time_max, after)
+        for event in events:
+            yield event
+        if after is None:
+            return
+
+async def fetch_calendar_events(calendar_id, time_min, time_max, client):
     """
     Fetch events from a Google Calendar.
 
+    Each event is normalized into a SessionRecord as it arrives, so the raw event is parsed only once.
+
     Args:
         calendar_id (str): The ID of the Google Calendar.
-        input_date_str (str): The starting date for the event retrieval, formatted as 'YYYY-MM-DD'.
-        creds (Credentials): Google API credentials.
-        service (Resource): Google Calendar API service object.
+        time_min (datetime.datetime): Start of the window as a naive UTC datetime, see get_fetch_window.
+        time_max (datetime.datetime): End of the window as a naive UTC datetime.
+        client (AsyncCalendarClient): Google Calendar API client.
 
     Returns:
-        list: A list of events within the specified time range.
+        list: A list of SessionRecords within the specified time range.
     """
-    now = datetime.datetime.now(datetime.timezone.utc) if input_date_str is None else datetime.datetime.strptime(input_date_str, '%Y-%m-%d')
-    timeMin = (now + datetime.timedelta(days=1)).isoformat() + 'Z'
-    timeMax = (now + datetime.timedelta(days=number_of_days+1)).isoformat() + 'Z'
+    events = [normalize_event(event) async for event in stream_calendar_events(calendar_id, time_min, time_max, client)]
 
-    events_result = service.events().list(calendarId=calendar_id, timeMin=timeMin, timeMax=timeMax, singleEvents=True, orderBy='startTime').execute()
-    events = events_result.get('items', [])
     if not events:
         print('No upcoming events found.')
         return []
 
     return events
-#endregion
 
-#region Utility Functions
-def is_valid_date(input_date_str):
+async def fetch_all_calendar_events(calendar_configs, time_min, time_max, client):
     """
-    Validate the input date string.
+    Fetch events from several Google Calendars in as few round trips as possible.
+
+    The calendars covered by the event store are synced together, and the others are listed together,
+    each with batched Calendar API requests, so N calendars cost one round trip per page instead of N.
+    A single calendar is fetched with plain requests. Each phase is given CALENDAR_FETCH_TIMEOUT_SECONDS.
+    A calendar that fails does not affect the others. Concurrent calls for the same calendars and window
+    share one fetch, see CALENDAR_FETCH_FLIGHTS. The window is floored to the minute, so calls whose default
+    window starts at the current time (see get_fetch_window) share it too.
 
     Args:
-        input_date_str (str): Date string in the format 'YYYY-MM-DD'.
+        calendar_configs (list): Entries of CALENDAR_CONFIGS to fetch.
+        time_min (datetime.datetime): Start of the window as a naive UTC datetime, see get_fetch_window.
+        time_max (datetime.datetime): End of the window as a naive UTC datetime.
+        client (AsyncCalendarClient): Google Calendar API client.
 
     Returns:
-        bool: True if the input string is a valid date, False otherwise.
+        list: A list of (calendar config, sessions, error) tuples in the same order as calendar_configs.
+              error is None when the calendar was fetched successfully.
     """
-    try:
-        datetime.datetime.strptime(input_date_str, '%Y-%m-%d')
-        return True
-    except ValueError:
-        return False
+    calendar_ids = tuple(sorted({config[1] for config in calendar_configs}))
+    time_min = time_min.replace(second=0, microsecond=0)
+    time_max = time_max.replace(second=0, microsecond=0)
+    sessions_by_calendar, errors = await CALENDAR_FETCH_FLIGHTS.run(
+        (calendar_ids, time_min, time_max),
+        lambda: fetch_calendar_sessions(calendar_ids, time_min, time_max, client)
+    )
 
-def remove_unsupported_tags(message):
+    merged = []
+    for config in calendar_configs:
+        if config[1] in errors:
+            print(f"Failed to fetch events for {config[2]}. Error: {errors[config[1]]!r}")
+            merged.append((config, [], errors[config[1]]))
+        else:
+            if not sessions_by_calendar[config[1]]:
+                print(f"No upcoming events found for {config[2]}.")
+            merged.append((config, sessions_by_calendar[config[1]], None))
+    return merged
+
+async def fetch_calendar_sessions(calendar_ids, time_min, time_max, client):
     """
-    Remove unsupported HTML tags from a string.
+    Fetch the sessions of several calendars within a window, see fetch_all_calendar_events.
+
+    The result may be shared by several callers, so the session lists must not be changed.
 
     Args:
-        message (str): The string containing HTML tags.
+        calendar_ids (tuple): The IDs of the Google Calendars.
+        time_min (datetime.datetime): Start of the window as a naive UTC datetime.
+        time_max (datetime.datetime): End of the window as a naive UTC datetime.
+        client (AsyncCalendarClient): Google Calendar API client.
 
     Returns:
-        str: The string with unsupported HTML tags removed.
+        tuple: (sessions by calendar ID, error by calendar ID), each calendar is in exactly one of them.
     """
-    message = re.sub(r'<[/]?br>', ' ', message)
-    message = re.sub(r'<[/]?(ul|ol|br|span|b)>', '', message)
-    return message
-#endregion
+    sessions_by_calendar, errors = {}, {}
 
-#region Payments Functions
-def calculate_payment(events, venue):
+    if len(calendar_ids) == 1:
+        try:
+            sessions_by_calendar[calendar_ids[0]] = await asyncio.wait_for(
+                fetch_calendar_events(calendar_ids[0], time_min, time_max, client),
+                timeout=CALENDAR_FETCH_TIMEOUT_SECONDS
+            )
+        except Exception as e:
+            errors[calendar_ids[0]] = e
+    else:
+        store = get_event_store()
+        stored_ids = [calendar_id for calendar_id in calendar_ids if store is not None and store.covers(calendar_id, time_min)]
+        listed_ids = [calendar_id for calendar_id in calendar_ids if calendar_id not in stored_ids]
+
+        if stored_ids:
+            try:
+                sync_results = await asyncio.wait_for(sync_calendars(stored_ids, client), timeout=CALENDAR_FETCH_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError as e:
+                sync_results = {calendar_id: e for calendar_id in stored_ids}
+            for calendar_id in stored_ids:
+                if isinstance(sync_results[calendar_id], Exception):
+                    errors[calendar_id] = sync_results[calendar_id]
+                else:
+                    sessions_by_calendar[calendar_id] = [
+                        normalize_event(event) async for event in read_stored_events(calendar_id, time_min, time_max)
+                    ]
+
+        if listed_ids:
+            params_by_calendar = {
+                calendar_id: {
+                    'calendarId': calendar_id, 'timeMin': time_min.isoformat() + 'Z', 'timeMax': time_max.isoformat() + 'Z',
+                    'singleEvents': True, 'orderBy': 'startTime'
+                }
+                for calendar_id in listed_ids
+            }
+            listed_sessions = {calendar_id: [] for calendar_id in listed_ids}
+
+            async def normalize_page(calendar_id, items):
+                listed_sessions[calendar_id].extend(normalize_event(event) for event in items)
+
+            try:
+                pages = await asyncio.wait_for(list_events_pages(params_by_calendar, client, normalize_page), timeout=CALENDAR_FETCH_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError as e:
+                pages = {calendar_id: (None, e) for calendar_id in listed_ids}
+            for calendar_id, (_, error) in pages.items():
+                if error is not None:
+                    errors[calendar_id] = error
+                else:
+                    sessions_by_calendar[calendar_id] = listed_sessions[calendar_id]
+
+    return sessions_by_calendar, errors
+
+async def list_events_pages(params_by_calendar, client, on_page):
     """
-    Calculate payment for staff based on description from calendar events.
+    Follow every page of events().list for several calendars, with one batched request per round of pages.
+
+    Each page is handed to on_page as soon as its round arrives, so only the pages of one round are held in memory.
 
     Args:
-        events (list): List of events retrieved from the calendar.
-        venue (str): The venue name where the events occurred.
+        params_by_calendar (dict): Calendar ID to the events().list parameters for that calendar.
+        client (AsyncCalendarClient): Google Calendar API client.
+        on_page (callable): Coroutine function called with (calendar ID, the page's events) for every page received.
 
     Returns:
-        tuple: A tuple containing:
-            - data (list): List of payment data for individual events.
-            - total_payments (dict): Dictionary of total payments for each teacher.
-    """
-    data = []
-    total_payments = {}
-
-    for event in events:
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        end = event['end'].get('dateTime', event['end'].get('date'))
-        summary = event.get('summary', 'Unnamed Event')
-        description = remove_unsupported_tags(event.get('description', ''))
-
-        # Match main teacher and optionally shadowing or substitute teacher
-        # Need to change this based on event description
-        match = re.search(r"Teacher:\s*([^(@]+)\s*(@\w+)(?:\s*\(([^@]+)\s*@(\w+)\s*(shadowing|substitute|substituting)\))?", description)
-        if match:
-            main_teacher_name = match.group(1).strip()
-            main_teacher_handle = match.group(2).strip().lower()
-            other_teacher_name = match.group(3).strip() if match.group(3) else None
-            other_teacher_handle = "@" + match.group(4).strip().lower() if match.group(4) else None
-            other_teacher_type = match.group(5).strip() if match.group(5) else None
-
-            if other_teacher_type and ('substitute' in other_teacher_type or 'substituting' in other_teacher_type):
-                teacher_handle = other_teacher_handle
-                teacher_name = other_teacher_name
-                teacher_rate = 25 if other_teacher_handle in TEACHERS_25_HOURLY_RATE else 20
-                teacher_hours = (datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start)).total_seconds() / 3600
-                teacher_remarks = "Substitute"
+        dict: Calendar ID to (next sync token, error). error is None when every page was received, and the
+              sync token is the nextSyncToken of the last page, if it had one.
+    """
+    pending = {calendar_id: dict(params) for calendar_id, params in params_by_calendar.items()}
+    results = {}
+    while pending:
+        calendar_ids = list(pending)
+        responses = await client.list_events_batch([pending[calendar_id] for calendar_id in calendar_ids])
+        for calendar_id, (response, error) in zip(calendar_ids, responses):
+            if error is not None:
+                results[calendar_id] = (None, error)
+                del pending[calendar_id]
+                continue
+            await on_page(calendar_id, response.get('items', []))
+            if response.get('nextPageToken'):
+                pending[calendar_id]['pageToken'] = response['nextPageToken']
             else:
-                teacher_handle = main_teacher_handle
-                teacher_name = main_teacher_name
-                teacher_rate = 25 if main_teacher_handle in TEACHERS_25_HOURLY_RATE else 20
-                teacher_hours = (datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start)).total_seconds() / 3600
-                teacher_remarks = ""
-
-            if "POSTPONED" in summary or "[POSTPONED]" in summary:
-                teacher_rate = 0
-                teacher_remarks = "Postponed"
-
-            teacher_amount = teacher_hours * teacher_rate
-
-            # Add payment to the total payments dictionary
-            if teacher_handle not in total_payments:
-                total_payments[teacher_handle] = {"name": teacher_name, "amount": 0}
-            total_payments[teacher_handle]["amount"] += teacher_amount
-
-            data.append([
-                venue,
-                datetime.datetime.fromisoformat(start).strftime('%Y-%m-%d'),
-                datetime.datetime.fromisoformat(start).strftime('%A'),
-                summary,
-                datetime.datetime.fromisoformat(start).strftime('%H:%M'),
-                datetime.datetime.fromisoformat(end).strftime('%H:%M'),
-                teacher_hours,
-                teacher_name,
-                teacher_handle,
-                teacher_rate,
-                teacher_amount,
-                teacher_remarks
-            ])
-
-            # Add shadowing teacher row if present
-            if other_teacher_type and 'shadowing' in other_teacher_type:
-                shadowing_rate = 15
-                shadowing_hours = 1
-                shadowing_amount = shadowing_hours * shadowing_rate
-
-                # Add payment to the total payments dictionary for the shadowing teacher
-                if other_teacher_handle not in total_payments:
-                    total_payments[other_teacher_handle] = {"name": other_teacher_name, "amount": 0}
-                total_payments[other_teacher_handle]["amount"] += shadowing_amount
-
-                data.append([
-                    venue,
-                    datetime.datetime.fromisoformat(start).strftime('%Y-%m-%d'),
-                    datetime.datetime.fromisoformat(start).strftime('%A'),
-                    summary,
-                    datetime.datetime.fromisoformat(start).strftime('%H:%M'),
-                    datetime.datetime.fromisoformat(end).strftime('%H:%M'),
-                    shadowing_hours,
-                    other_teacher_name,
-                    other_teacher_handle,
-                    shadowing_rate,
-                    shadowing_amount,
-                    "Shadowing"
-                ])
-
-    return data, total_payments
+                results[calendar_id] = (response.get('nextSyncToken'), None)
+                del pending[calendar_id]
+    return results
+#endregion
 
-async def generate_payment_sheet_for_all_calendars(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+#region Event Store
+def to_utc_isoformat(event_time):
     """
-    Generates an excel file with payment details for staff based on Google Calendar description.
-    Sends excel file as a reply to user and also save the excel file in project root folder
+    Convert an event start or end to a UTC ISO string that sorts chronologically.
 
     Args:
-        update (Update): The Telegram Update object.
-        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+        event_time (dict): The event's 'start' or 'end' field.
 
     Returns:
-        None
+        str: The time in UTC, e.g. '2025-05-01T02:00:00+00:00'. All-day events are taken as UTC midnight.
     """
-    input_date_str = context.args[0] if len(context.args) > 0 else None
-    if input_date_str and not is_valid_date(input_date_str):
-        await update.message.reply_html("Date format is not valid.")
-        return
+    value = datetime.datetime.fromisoformat(event_time.get('dateTime', event_time.get('date')))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc).isoformat()
 
-    creds = get_google_credentials()
-    service = build('calendar', 'v3', credentials=creds)
+class CalendarEventStore:
+    """
+    Local SQLite copy of each calendar's events.
 
-    all_payment_data = []
-    total_payments = {}
+    The store is kept current with Calendar API incremental sync (see sync_calendar), so a repeated
+    command costs one small delta request instead of listing the whole window again.
+    Methods are blocking and are run on GOOGLE_API_EXECUTOR.
+    """
 
-    calendar_configs = [
-        (SOK_C_CALENDAR_ID, 'SOK-C'),
-        (SOK_R_CALENDAR_ID, 'SOK-R'),
-        (LL_CALENDAR_ID, 'LL'),
-    ]
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._sync_horizons = {}
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS events (
+                    calendar_id TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    start_utc TEXT NOT NULL,
+                    end_utc TEXT NOT NULL,
+                    etag TEXT,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (calendar_id, event_id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_by_start ON events (calendar_id, start_utc)")
+            has_handle_index = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'event_handles'").fetchone()
+            # Inverted index of the teacher handles in each event, so one teacher's sessions are found without reading every event
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS event_handles (
+                    handle TEXT NOT NULL,
+                    calendar_id TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    start_utc TEXT NOT NULL,
+                    end_utc TEXT NOT NULL,
+                    PRIMARY KEY (handle, start_utc, calendar_id, event_id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS event_handles_by_event ON event_handles (calendar_id, event_id)")
+            if not has_handle_index:
+                # Events stored before the index existed
+                for calendar_id, payload in self._conn.execute("SELECT calendar_id, payload FROM events").fetchall():
+                    self._index_handles(calendar_id, json.loads(payload))
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    calendar_id TEXT PRIMARY KEY,
+                    sync_token TEXT,
+                    horizon_utc TEXT NOT NULL,
+                    synced_at TEXT NOT NULL
+                )
+            """)
+            for calendar_id, horizon_utc in self._conn.execute("SELECT calendar_id, horizon_utc FROM sync_state WHERE sync_token IS NOT NULL"):
+                self._sync_horizons[calendar_id] = datetime.datetime.fromisoformat(horizon_utc)
 
-    for calendar_id, venue_name in calendar_configs:
-        events = await fetch_calendar_events(calendar_id, input_date_str, creds, service)
-        payment_data, totals = calculate_payment(events, venue=venue_name)
+    def covers(self, calendar_id, time_min):
+        """
+        Check whether a window starting at time_min can be served from the store.
 
-        if all_payment_data:
-            all_payment_data += [[''] * 11]  # Blank row between venues
-        all_payment_data += payment_data
+        A calendar that has never been synced is covered as long as time_min is within EVENT_SYNC_LOOKBACK_DAYS,
+        since its first sync starts from that horizon.
 
-        for teacher_handle, details in totals.items():
-            if teacher_handle in total_payments:
-                total_payments[teacher_handle]["amount"] += details["amount"]
-            else:
-                total_payments[teacher_handle] = details
+        Args:
+            calendar_id (str): The ID of the Google Calendar.
+            time_min (datetime.datetime): Start of the window as a naive UTC datetime.
 
-    # Append blank rows before summary
-    all_payment_data.append([''] * 12)
-    all_payment_data.append([''] * 12)
+        Returns:
+            bool: True if the window can be read from the store.
+        """
+        horizon = self._sync_horizons.get(calendar_id) or get_sync_horizon()
+        return time_min >= horizon
 
-    # Append total summary sorted by name
-    for teacher_handle, details in sorted(total_payments.items(), key=lambda item: item[1]["name"]):
-        all_payment_data.append(['', '', '', '', '', '', '', details["name"], teacher_handle, '', details["amount"], ''])
+    def get_sync_token(self, calendar_id):
+        with self._lock:
+            row = self._conn.execute("SELECT sync_token FROM sync_state WHERE calendar_id = ?", (calendar_id,)).fetchone()
+        return row[0] if row else None
 
-    df = pd.DataFrame(all_payment_data, columns=[
-        'Venue', 'Date', 'Day', 'Course', 'Start Time', 'End Time', 'Number of hours',
-        'Teacher Name', 'Teacher Handle', 'Hourly Rate', 'Amount', 'Remarks'
-    ])
+    def reset(self, calendar_id):
+        """
+        Drop every stored event and the sync token of a calendar, ready for a full sync.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM events WHERE calendar_id = ?", (calendar_id,))
+            self._conn.execute("DELETE FROM event_handles WHERE calendar_id = ?", (calendar_id,))
+            self._conn.execute("DELETE FROM sync_state WHERE calendar_id = ?", (calendar_id,))
+        self._sync_horizons.pop(calendar_id, None)
 
-    start_date = datetime.datetime.strptime(input_date_str, '%Y-%m-%d') if input_date_str else datetime.datetime.utcnow()
-    end_date = start_date + datetime.timedelta(days=7)
-    adjusted_end_date = start_date + datetime.timedelta(days=1)
-    file_name = f"Payment_{adjusted_end_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.xlsx"
+    def retain(self, calendar_ids):
+        """
+        Drop the events, handle index and sync token of every calendar not in calendar_ids,
+        e.g. a venue removed from the calendar config.
 
-    file_path = os.path.join(PAYMENTS_EXCEL_FOLDER, file_name)
-    df.to_excel(file_path, index=False)
+        Args:
+            calendar_ids (list): The IDs of the configured Google Calendars.
+        """
+        placeholders = ', '.join('?' * len(calendar_ids))
+        with self._lock, self._conn:
+            for table in ('events', 'event_handles', 'sync_state'):
+                self._conn.execute(f"DELETE FROM {table} WHERE calendar_id NOT IN ({placeholders})", tuple(calendar_ids))
+        for calendar_id in set(self._sync_horizons) - set(calendar_ids):
+            del self._sync_horizons[calendar_id]
 
-    # Send the generated file
-    bot = Bot(BOT_TOKEN)
-    try:
-        with open(file_path, 'rb') as file:
-            await bot.send_document(chat_id=update.message.chat_id, document=file, filename=file_name, caption="Payment sheet for all venues.")
-    except Exception as e:
-        await update.message.reply_html(f"Failed to send the payment sheet. Error: {str(e)}")
-        return
+    def apply_changes(self, calendar_id, events):
+        """
+        Upsert changed events and delete cancelled ones, updating the handle index of only those events.
 
-    await update.message.reply_text("Payment sheet for all venues has been sent.")
-    """
-    Generates an excel file with payment details for staff based on Google Calendar description.
-    Sends excel file as a reply to user and also save the excel file in project root folder
+        Args:
+            calendar_id (str): The ID of the Google Calendar.
+            events (list): Items from one page of an events().list response.
+        """
+        with self._lock, self._conn:
+            for event in events:
+                self._conn.execute("DELETE FROM event_handles WHERE calendar_id = ? AND event_id = ?", (calendar_id, event['id']))
+                if event.get('status') == 'cancelled':
+                    self._conn.execute("DELETE FROM events WHERE calendar_id = ? AND event_id = ?", (calendar_id, event['id']))
+                    continue
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO events (calendar_id, event_id, start_utc, end_utc, etag, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                    (calendar_id, event['id'], to_utc_isoformat(event['start']), to_utc_isoformat(event['end']), event.get('etag'), json.dumps(event))
+                )
+                self._index_handles(calendar_id, event)
 
-    Args:
-        update (Update): The Telegram Update object.
-        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+    def _index_handles(self, calendar_id, event):
+        session = normalize_event(event)
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO event_handles (handle, calendar_id, event_id, start_utc, end_utc) VALUES (?, ?, ?, ?, ?)",
+            [
+                (handle, calendar_id, event['id'], to_utc_isoformat(event['start']), to_utc_isoformat(event['end']))
+                for handle in get_session_handles(session)
+            ]
+        )
 
-    Returns:
-        None
-    """
-    input_date_str = context.args[0] if len(context.args) > 0 else None
-    if input_date_str and not is_valid_date(input_date_str):
-        await update.message.reply_html("Date format is not valid.")
-        return
+    def save_sync_token(self, calendar_id, sync_token, horizon):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state (calendar_id, sync_token, horizon_utc, synced_at) VALUES (?, ?, ?, ?)",
+                (calendar_id, sync_token, horizon.isoformat(), datetime.datetime.utcnow().isoformat())
+            )
+        self._sync_horizons[calendar_id] = horizon
 
-    creds = get_google_credentials()
-    service = build('calendar', 'v3', credentials=creds)
+    def get_horizon(self, calendar_id):
+        return self._sync_horizons.get(calendar_id)
 
-    # Fetch events for SOK
-    sok_events = await fetch_calendar_events(SOK_C_CALENDAR_ID, input_date_str, creds, service)
-    sok_payment_data, sok_totals = calculate_payment(sok_events, venue='SOK')
+    def query_page(self, calendar_id, time_min, time_max, after=None):
+        """
+        Get one page of the stored events overlapping a window, ordered by start time.
 
-    # Fetch events for LL
-    ll_events = await fetch_calendar_events(LL_CALENDAR_ID, input_date_str, creds, service)
-    ll_payment_data, ll_totals = calculate_payment(ll_events, venue='LL')
+        Args:
+            calendar_id (str): The ID of the Google Calendar.
+            time_min (datetime.datetime): Start of the window as a naive UTC datetime.
+            time_max (datetime.datetime): End of the window as a naive UTC datetime.
+            after (tuple, optional): The cursor returned with the previous page. Defaults to the first page.
 
-    # Combine data
-    payment_data = sok_payment_data + [['']*11] + ll_payment_data
+        Returns:
+            tuple: (events, cursor) where events are in the same format as the Calendar API returns them,
+                   and cursor is passed back for the next page, or None after the last page.
+        """
+        time_min = time_min.replace(tzinfo=datetime.timezone.utc).isoformat()
+        time_max = time_max.replace(tzinfo=datetime.timezone.utc).isoformat()
+        after_start, after_id = after or ('', '')
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT start_utc, event_id, payload FROM events
+                WHERE calendar_id = ? AND end_utc > ? AND start_utc < ? AND (start_utc, event_id) > (?, ?)
+                ORDER BY start_utc, event_id LIMIT ?
+                """,
+                (calendar_id, time_min, time_max, after_start, after_id, EVENT_STORE_PAGE_SIZE)
+            ).fetchall()
+        events = [json.loads(payload) for _, _, payload in rows]
+        cursor = (rows[-1][0], rows[-1][1]) if len(rows) == EVENT_STORE_PAGE_SIZE else None
+        return events, cursor
 
-    # Combine total payments
-    total_payments = sok_totals
-    for teacher_handle, details in ll_totals.items():
-        if teacher_handle in total_payments:
-            total_payments[teacher_handle]["amount"] += details["amount"]
-        else:
-            total_payments[teacher_handle] = details
+    def query_handles(self, handles, calendar_ids, time_min, time_max):
+        """
+        Get the stored events of some teacher handles overlapping a window, from the handle index.
 
-    # Append total payments summary to the data
-    payment_data.append(['', '', '', '', '', '', '', '', '', '', '', ''])  # Blank row for separation
-    payment_data.append(['', '', '', '', '', '', '', '', '', '', '', ''])
+        Only the index entries of those handles are read, so the cost grows with their sessions,
+        not with the number of stored events.
 
-    # for teacher_handle, details in total_payments.items():
-    #     payment_data.append(['', '', '', '', '', '', '', details["name"], teacher_handle, '', details["amount"], ''])
+        Args:
+            handles (list): Lowercase teacher handles, e.g. '@alice'.
+            calendar_ids (list): The IDs of the Google Calendars to read, so a calendar no longer configured is left out.
+            time_min (datetime.datetime): Start of the window as a naive UTC datetime.
+            time_max (datetime.datetime): End of the window as a naive UTC datetime.
 
-    for teacher_handle, details in sorted(total_payments.items(), key=lambda item: item[1]["name"]):
-        payment_data.append(['', '', '', '', '', '', '', details["name"], teacher_handle, '', details["amount"], ''])
+        Returns:
+            dict: Handle to (calendar ID, event) pairs ordered by start time, for the handles with any events.
+        """
+        time_min = time_min.replace(tzinfo=datetime.timezone.utc).isoformat()
+        time_max = time_max.replace(tzinfo=datetime.timezone.utc).isoformat()
+        events_by_handle = collections.defaultdict(list)
+        handles = sorted(set(handles))
+        for start in range(0, len(handles), EVENT_STORE_PAGE_SIZE):
+            chunk = handles[start:start + EVENT_STORE_PAGE_SIZE]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"""
+                    SELECT h.handle, h.calendar_id, e.payload FROM event_handles h
+                    JOIN events e ON e.calendar_id = h.calendar_id AND e.event_id = h.event_id
+                    WHERE h.handle IN ({', '.join('?' * len(chunk))}) AND h.calendar_id IN ({', '.join('?' * len(calendar_ids))})
+                    AND h.start_utc < ? AND h.end_utc > ?
+                    ORDER BY h.handle, h.start_utc, h.calendar_id, h.event_id
+                    """,
+                    (*chunk, *calendar_ids, time_max, time_min)
+                ).fetchall()
+            for handle, calendar_id, payload in rows:
+                events_by_handle[handle].append((calendar_id, json.loads(payload)))
+        return events_by_handle
 
-    df = pd.DataFrame(payment_data, columns=[
-        'Venue', 'Date', 'Day', 'Course', 'Start Time', 'End Time', 'Number of hours',
-        'Teacher Name', 'Teacher Handle', 'Hourly Rate', 'Amount', 'Remarks'
-    ])
+def get_event_store():
+    """
+    Get the process-wide CalendarEventStore, opening it on first use. Calendars no longer in the calendar config
+    are dropped from it on opening.
 
-    start_date = datetime.datetime.strptime(input_date_str, '%Y-%m-%d') if input_date_str else datetime.datetime.utcnow()
-    end_date = start_date + datetime.timedelta(days=7)
-    adjusted_end_date = start_date + datetime.timedelta(days=1)
-    file_name = f"Payment_{adjusted_end_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.xlsx"
+    Returns:
+        CalendarEventStore | None: The store, or None when EVENT_STORE_PATH is empty.
+    """
+    global EVENT_STORE
+    if EVENT_STORE is None and EVENT_STORE_PATH:
+        EVENT_STORE = CalendarEventStore(EVENT_STORE_PATH)
+        EVENT_STORE.retain(list(CALENDAR_VENUE_NAMES))
+    return EVENT_STORE
 
-    file_path = os.path.join(PAYMENTS_EXCEL_FOLDER, file_name)
-    df.to_excel(file_path, index=False)
+def get_sync_horizon():
+    """
+    Get the earliest time a full sync starts from, EVENT_SYNC_LOOKBACK_DAYS before today.
 
-     # Send the generated file
-    bot = Bot(BOT_TOKEN)
-    try:
-        with open(file_path, 'rb') as file:
-            await bot.send_document(chat_id=update.message.chat_id, document=file, filename=file_name, caption="Payment sheet for all venues.")
-    except Exception as e:
-        await update.message.reply_html(f"Failed to send the payment sheet. Error: {str(e)}")
-        return
+    Returns:
+        datetime.datetime: The horizon as a naive UTC datetime at midnight.
+    """
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - datetime.timedelta(days=EVENT_SYNC_LOOKBACK_DAYS)
 
-    # Notify about successful operation
-    await update.message.reply_text(f"Payment sheet for all venues has been sent.")
-#endregion
+def get_calendar_sync_lock(calendar_id):
+    if calendar_id not in CALENDAR_SYNC_LOCKS:
+        CALENDAR_SYNC_LOCKS[calendar_id] = asyncio.Lock()
+    return CALENDAR_SYNC_LOCKS[calendar_id]
 
-#region Telegram Bot Functions
-async def send_message(update, context, chat_id, is_reply=False):
+async def sync_calendars(calendar_ids, client, max_age_seconds=None):
     """
-    Pulls events from Google Calendar and sends the formatted message in the chat with event details
+    Bring the event store up to date with several Google Calendars at once.
+
+    Uses the stored sync token of each calendar for an incremental sync. Without a token, or when Google
+    answers 410 Gone because the token has expired, the calendar is cleared and fully synced from the horizon.
+    The calendars are listed together with batched requests, so they share one round trip per page.
+    When anything changed in a calendar, its cached schedules are invalidated. Calendars synced less than
+    max_age_seconds ago, e.g. by the background sync workers, are left as they are.
 
     Args:
-        update (Update): The Telegram Update object.
-        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
-        chat_id (int): The chat ID where the message will be sent.
-        is_reply (bool, optional): Whether the message is a reply to a user. Defaults to False.
+        calendar_ids (list): The IDs of the Google Calendars.
+        client (AsyncCalendarClient): Google Calendar API client.
+        max_age_seconds (float, optional): How old a sync may be and still be used. Defaults to CALENDAR_SYNC_MAX_AGE_SECONDS.
 
     Returns:
-        None
+        dict: Calendar ID to the number of changed events that were received, or the error that stopped its sync.
     """
-    calendar_key = context.args[0] if context.args else SOK_C_KEY
-
-    # Determine calendar ID and branch header based on the provided key
-    if calendar_key == SOK_C_KEY:
-        calendar_id = SOK_C_CALENDAR_ID
-        final_message = SOK_C_BRANCH_HEADER
-    elif calendar_key == SOK_R_KEY:
-        calendar_id = SOK_R_CALENDAR_ID
-        final_message = SOK_R_BRANCH_HEADER
-    elif calendar_key == LL_KEY:
-        calendar_id = LL_CALENDAR_ID
-        final_message = LL_BRANCH_HEADER
-    else:
-        calendar_id = SOK_C_CALENDAR_ID  # Default to SOK_C
-        final_message = SOK_C_BRANCH_HEADER
-
-    input_date_str = context.args[1] if len(context.args) > 1 else None
-    if input_date_str and not is_valid_date(input_date_str):
-        input_date_str = None
-        await update.message.reply_html("Date format is not valid, sending schedule for next 7 days starting from today instead.")
+    max_age_seconds = CALENDAR_SYNC_MAX_AGE_SECONDS if max_age_seconds is None else max_age_seconds
+    now = asyncio.get_running_loop().time()
+    fresh_ids = [
+        calendar_id for calendar_id in set(calendar_ids)
+        if max_age_seconds > 0 and now - CALENDAR_SYNCED_AT.get(calendar_id, -math.inf) < max_age_seconds
+    ]
+    calendar_ids = tuple(sorted(set(calendar_ids) - set(fresh_ids)))
+    if fresh_ids:
+        METRICS.increment('fresh_sync_skipped', len(fresh_ids))
+    if not calendar_ids:
+        return {calendar_id: 0 for calendar_id in fresh_ids}
 
-    creds = get_google_credentials()
-    service = build('calendar', 'v3', credentials=creds)
-    events = await fetch_calendar_events(calendar_id, input_date_str, creds, service)
+    async def sync_with_locks():
+        async with contextlib.AsyncExitStack() as stack:
+            # Always taken in the same order, so two overlapping syncs cannot wait on each other
+            for calendar_id in calendar_ids:
+                await stack.enter_async_context(get_calendar_sync_lock(calendar_id))
+            with METRICS.timer('stage', 'calendar_sync'):
+                return await sync_locked_calendars(calendar_ids, client)
 
-    formatted_events = get_formatted_events(events)
+    # A sync of the same calendars that is already running is joined instead of repeated
+    results = await CALENDAR_SYNC_FLIGHTS.run(calendar_ids, sync_with_locks)
+    return {**results, **{calendar_id: 0 for calendar_id in fresh_ids}}
 
-    if not formatted_events:
-        final_message += "\nNo lessons for this week at this venue.\n"
-    else:
-        for day, events in formatted_events.items():
-            final_message += f"<b><u>{day}</u></b>\n\n"
-            for i, event in enumerate(events):
-                final_message += f"{i+1}. {event}\n\n"
-            final_message += "\n"
+async def sync_locked_calendars(calendar_ids, client):
+    store = get_event_store()
+    params_by_calendar, horizons = {}, {}
+    for calendar_id in calendar_ids:
+        sync_token = await run_in_google_executor(store.get_sync_token, calendar_id)
+        if sync_token:
+            params_by_calendar[calendar_id] = {'calendarId': calendar_id, 'singleEvents': True, 'syncToken': sync_token}
+            horizons[calendar_id] = store.get_horizon(calendar_id)
+        else:
+            await run_in_google_executor(store.reset, calendar_id)
+            horizons[calendar_id] = get_sync_horizon()
+            params_by_calendar[calendar_id] = {
+                'calendarId': calendar_id, 'singleEvents': True, 'timeMin': horizons[calendar_id].isoformat() + 'Z', 'showDeleted': True
+            }
 
-    bot = Bot(BOT_TOKEN)
-    if is_reply:
-        sent_message = await update.message.reply_html(final_message)
-    else:
-        sent_message = await bot.send_message(chat_id=chat_id, text=final_message, parse_mode='HTML')
+    changed = collections.Counter()
 
-    global LAST_SENT_MESSAGE_ID
-    LAST_SENT_MESSAGE_ID = sent_message.message_id
+    async def apply_page(calendar_id, items):
+        # Written to the store as each page arrives. The sync token is only saved after the last page
+        await run_in_google_executor(store.apply_changes, calendar_id, items)
+        if items:
+            # Some event in the calendar has a new etag, so its rendered schedules may be out of date
+            SCHEDULE_CACHE.invalidate_calendar(calendar_id)
+        changed[calendar_id] += len(items)
 
-    user_chat_id = update.effective_user.id
-    await bot.send_message(chat_id=user_chat_id, text=f"Message ID: {sent_message.message_id}, Group Chat ID: {sent_message.chat_id}")
-    print(f"Message with message id {sent_message.message_id} sent to group chat id {sent_message.chat_id}")
+    results = {}
+    expired_ids = []
+    pages = await list_events_pages(params_by_calendar, client, apply_page)
+    for calendar_id, (next_sync_token, error) in pages.items():
+        if error is not None:
+            if getattr(getattr(error, 'resp', None), 'status', None) == 410 and 'syncToken' in params_by_calendar[calendar_id]:
+                print(f"Sync token for calendar {calendar_id} has expired, doing a full sync.")
+                await run_in_google_executor(store.reset, calendar_id)
+                expired_ids.append(calendar_id)
+            else:
+                results[calendar_id] = error
+            continue
 
+        await run_in_google_executor(store.save_sync_token, calendar_id, next_sync_token, horizons[calendar_id])
+        CALENDAR_SYNCED_AT[calendar_id] = asyncio.get_running_loop().time()
+        results[calendar_id] = changed[calendar_id]
 
+    if expired_ids:
+        results.update(await sync_locked_calendars(expired_ids, client))
+    return results
 
-async def edit_message_in_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def sync_calendar(calendar_id, client):
     """
-    Pulls events from Google Calendar and update the specified message in the chat with updated event details
+    Bring the event store up to date with one Google Calendar, see sync_calendars.
 
     Args:
-        update (Update): The Telegram Update object.
-        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+        calendar_id (str): The ID of the Google Calendar.
+        client (AsyncCalendarClient): Google Calendar API client.
 
     Returns:
-        None
+        int: The number of changed events that were received.
     """
-    message_id = context.args[0] if context.args else None
-    calendar_key = context.args[1] if len(context.args) > 1 else SOK_C_KEY
-    input_date_str = context.args[2] if len(context.args) > 2 and is_valid_date(context.args[2]) else None
+    result = (await sync_calendars([calendar_id], client))[calendar_id]
+    if isinstance(result, Exception):
+        raise result
+    return result
+#endregion
 
-    if message_id is None:
-        await update.message.reply_text("Message Id is empty.")
-        return
+#region Background Sync
+class CalendarSyncWorkers:
+    """
+    Keeps the event store warm by syncing every calendar in the background, see CALENDAR_SYNC_INTERVAL_SECONDS.
 
-    if calendar_key == SOK_C_KEY:
-        calendar_id = SOK_C_CALENDAR_ID
-        branch_header = SOK_C_BRANCH_HEADER
-    elif calendar_key == SOK_R_KEY:
-        calendar_id = SOK_R_CALENDAR_ID
-        branch_header = SOK_R_BRANCH_HEADER
-    elif calendar_key == LL_KEY:
-        calendar_id = LL_CALENDAR_ID
-        branch_header = LL_BRANCH_HEADER
-    else:
-        await update.message.reply_text("Invalid calendar key provided.")
-        return
+    Calendars are dealt round robin to at most CALENDAR_SYNC_WORKERS workers. Each worker waits for its next
+    due calendar and syncs every calendar due by then together, with one batched sync. The first sync of
+    each calendar is staggered across its interval, so dozens of calendars do not all reach Google at once.
+    """
 
-    creds = get_google_credentials()
-    service = build('calendar', 'v3', credentials=creds)
-    events = await fetch_calendar_events(calendar_id, input_date_str, creds, service)
+    def __init__(self, sync_intervals, worker_count):
+        self.sync_intervals = sync_intervals  # Calendar ID -> seconds between syncs
+        calendar_ids = list(sync_intervals)
+        worker_count = max(1, min(worker_count, len(calendar_ids)))
+        self.shards = [calendar_ids[index::worker_count] for index in range(worker_count)] if calendar_ids else []
+        self._tasks = []
 
-    # Get current date and time for the edit timestamp
-    edit_timestamp = datetime.datetime.now(ZoneInfo("Asia/Singapore")).strftime('%Y-%m-%d %H:%M:%S')
+    def start(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        position = {calendar_id: index for index, calendar_id in enumerate(self.sync_intervals)}
+        for shard in self.shards:
+            # (due time, calendar ID), the nth of N calendars is first due n/N of the way into its interval
+            due = [(now + self.sync_intervals[calendar_id] * position[calendar_id] / len(position), calendar_id) for calendar_id in shard]
+            heapq.heapify(due)
+            self._tasks.append(loop.create_task(self._run(due)))
+        print(f"Syncing {len(position)} calendars in the background with {len(self.shards)} workers")
 
-    new_text = f"<i>Message updated on {edit_timestamp}</i>\n\n"
-    new_text += branch_header
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
 
-    formatted_events = get_formatted_events(events)
+    async def _run(self, due):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(max(0, due[0][0] - loop.time()))
+            now = loop.time()
+            calendar_ids = []
+            while due and due[0][0] <= now:
+                calendar_ids.append(heapq.heappop(due)[1])
 
-    if not formatted_events:
-        new_text += "\nNo lessons for this week at this venue.\n"
-    else:
-        for day, events in formatted_events.items():
-            new_text += f"<b><u>{day}</u></b>\n\n"
-            for i, event in enumerate(events):
-                new_text += f"{i+1}. {event}\n\n"
-            new_text += "\n"
+            try:
+                client = await get_calendar_client()
+                results = await asyncio.wait_for(sync_calendars(calendar_ids, client, max_age_seconds=0), timeout=CALENDAR_FETCH_TIMEOUT_SECONDS)
+            except Exception as e:
+                results = {calendar_id: e for calendar_id in calendar_ids}
+            for calendar_id in calendar_ids:
+                if isinstance(results[calendar_id], Exception):
+                    METRICS.increment('background_sync_failed')
+                    print(f"Background sync of calendar {calendar_id} failed. Error: {results[calendar_id]!r}")
+                else:
+                    METRICS.increment('background_sync')
+                # Counted from the start of this round, so a slow sync does not push the next one back
+                heapq.heappush(due, (now + self.sync_intervals[calendar_id], calendar_id))
 
-    bot = Bot(BOT_TOKEN)
-    try:
-        # Editing the original message
-        await bot.edit_message_text(chat_id=GROUPCHAT_ID, message_id=message_id, text=new_text, parse_mode='HTML')
+async def start_calendar_sync_workers():
+    """
+    Start syncing every calendar with a sync interval in the background, when the event store is on.
+    """
+    global CALENDAR_SYNC_WORKER_POOL
+    if CALENDAR_SYNC_WORKER_POOL is not None or not CALENDAR_SYNC_INTERVALS or get_event_store() is None:
+        return
+    # Without a token the OAuth flow needs a person, so background syncs would wait on it
+    if not os.path.exists('token.json'):
+        print("Background calendar sync needs token.json, run a command once to sign in")
+        return
+    CALENDAR_SYNC_WORKER_POOL = CalendarSyncWorkers(CALENDAR_SYNC_INTERVALS, CALENDAR_SYNC_WORKERS)
+    CALENDAR_SYNC_WORKER_POOL.start()
+#endregion
 
-        # Sending a reply to the edited message indicating that it was updated
-        notification_message = f"🔄 Schedule updated at {edit_timestamp}.\n Please review the changes."
-        await bot.send_message(chat_id=GROUPCHAT_ID, text=notification_message, reply_to_message_id=message_id, parse_mode='HTML')
+#region Schedule Cache
+class RenderedScheduleCache:
+    """
+    TTL and LRU cache of rendered schedule bodies, keyed by (calendar id, window start, window length).
+    The branch header is left out, so venues sharing a calendar share the entry and keep their own header.
 
-        await update.message.reply_html("Message has been edited successfully\n" + new_text)
-        print(f"Message for message id {message_id} edited successfully")
-    except Exception as e:
-        await update.message.reply_html(f"Failed to edit message for message id {message_id}. Error: {str(e)}")
-        print(f"Failed to edit message for message id {message_id}. Error: {str(e)}")
+    Entries expire after ttl_seconds, the least recently used entry is evicted past max_entries, and
+    sync_calendar invalidates a calendar's entries whenever the sync reports changed events.
+    Only used from the event loop, so it needs no locking.
+    """
 
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
 
+    def get(self, key):
+        """
+        Get a cached schedule.
 
-async def send_reminder_message(update, context, chat_id, is_reply=False):
-    bot = Bot(BOT_TOKEN)
-    sent_message = await bot.send_message(chat_id=chat_id, text=REMINDER_MSG, parse_mode='HTML')
-    user_chat_id = update.effective_user.id
-    await bot.send_message(chat_id=user_chat_id, text=f"Message ID: {sent_message.message_id}, Group Chat ID: {sent_message.chat_id}")
+        Args:
+            key (tuple): Key from get_schedule_cache_key.
 
+        Returns:
+            str | None: The rendered schedule, or None when it is not cached or has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
 
-async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    help_message = '''
-    *__Bot Commands Help__*\n\n
-        /schedule `<calendar> <date>` \- Sends a schedule to you\. If no date is provided, it sends the upcoming schedule for a week from today\. If a date in YYYY\-MM\-DD format is provided, it sends the schedule for a week from that date\.\n\n
-        /send `<calendar> <date>` \- Sends the schedule to the teacher's chat group\. Without a date, it sends the upcoming schedule for a week from today\. With a date in YYYY\-MM\-DD format, it sends the schedule for a week from that date\. The bot replies with the message\_id for future edits\.\n\n
-        /edit `<message_id> <calendar> <date>` \- Edits a previously sent message in the teacher's chat group\. You need to provide the message\_id\. Optionally, you can provide a date in YYYY\-MM\-DD format to specify the schedule week\.\n\n
-        /payment `<calendar> <date>` \- Generates an Excel sheet with payment details for the given date range.\n\n
-        *Note*\: Replace `<calendar>` with 'SOK' or 'LL', `<date>` with your desired date in YYYY\-MM\-DD format and `<message_id>` with the actual message ID\.
-    '''
+    def put(self, key, text):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
 
-    await update.message.reply_text(help_message, parse_mode='MarkdownV2')
+    def invalidate_calendar(self, calendar_id):
+        """
+        Drop every cached schedule of a calendar.
 
-async def reply_with_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_message(update, context, None, is_reply=True)
+        Args:
+            calendar_id (str): The ID of the Google Calendar.
+        """
+        for key in [key for key in self._entries if key[0] == calendar_id]:
+            del self._entries[key]
+            self.invalidations += 1
 
-async def send_schedule_to_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_message(update, context, GROUPCHAT_ID)
+    def stats(self):
+        """
+        Returns:
+            dict: Hit, miss, eviction and invalidation counters and the number of cached entries.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self._entries),
+        }
 
-async def send_reminder_message_to_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_reminder_message(update, context, GROUPCHAT_ID)
-#endregion
+def get_schedule_cache_key(calendar_id, time_min, time_max):
+    """
+    Get the cache key of a schedule window.
 
-if __name__ == "__main__":
-    print('starting bot')
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("schedule", reply_with_schedule))
-    app.add_handler(CommandHandler("send", send_schedule_to_groupchat))
-    app.add_handler(CommandHandler("sendrm", send_reminder_message_to_groupchat))
-    app.add_handler(CommandHandler("edit", edit_message_in_groupchat))
-    app.add_handler(CommandHandler("helpme", show_help))
-    app.add_handler(CommandHandler("paymentforall", generate_payment_sheet_for_all_calendars))
-    print("polling")
-    app.run_polling(poll_interval=3)
+    The window start is taken by day, so the default window (which starts at the current time) is
+    reused for up to SCHEDULE_CACHE_TTL_SECONDS while it slides.
+
+    Args:
+        calendar_id (str): The ID of the Google Calendar.
+        time_min (datetime.datetime): Start of the window.
+        time_max (datetime.datetime): End of the window.
+
+    Returns:
+        tuple: (calendar id, window start date, window length in days).
+    """
+    return calendar_id, time_min.date().isoformat(), (time_max - time_min).days
+
+class DayFragmentCache:
+    """
+    LRU cache of the rendered HTML of one schedule day, keyed by the day and the (event id, etag) of each
+    of its lessons in order, see render_day_fragment.
+
+    A changed event gets a new etag and so a new key, so entries never need to be invalidated; old versions
+    are simply evicted past max_entries. Only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        fragment = self._entries.get(key)
+        if fragment is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return fragment
+
+    def put(self, key, fragment):
+        self._entries[key] = fragment
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries)}
+
+SCHEDULE_CACHE = RenderedScheduleCache(SCHEDULE_CACHE_TTL_SECONDS, SCHEDULE_CACHE_MAX_ENTRIES)
+DAY_FRAGMENT_CACHE = DayFragmentCache(DAY_FRAGMENT_CACHE_MAX_ENTRIES)
+#endregion
+
+#region Metrics
+class MetricsRegistry:
+    """
+    In-process registry of timings and counters.
+
+    Timings are kept per kind ('command' or 'stage') and name, as running totals plus the last
+    METRICS_WINDOW_SIZE durations for percentiles. Recording one is a clock read and a deque append,
+    so the registry can stay on in production. Percentiles are only computed when read.
+    """
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self._timings = {}  # (kind, name) -> [count, total seconds, deque of recent seconds]
+        self._counters = collections.Counter()
+        # Google requests are recorded from GOOGLE_API_EXECUTOR threads
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def observe(self, kind, name, seconds):
+        with self._lock:
+            timing = self._timings.get((kind, name))
+            if timing is None:
+                timing = self._timings[(kind, name)] = [0, 0.0, collections.deque(maxlen=self.window_size)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2].append(seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        """
+        Time the body of a with block, also when it awaits or raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, name, time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Get the count, total and percentiles of every timing.
+
+        Returns:
+            list: (kind, name, count, total seconds, p50 seconds, p95 seconds) tuples ordered by kind and name.
+        """
+        with self._lock:
+            timings = [(key, count, total, list(recent)) for key, (count, total, recent) in self._timings.items()]
+        rows = []
+        for (kind, name), count, total, recent in sorted(timings):
+            recent = sorted(recent)
+            rows.append((kind, name, count, total, get_percentile(recent, 0.5), get_percentile(recent, 0.95)))
+        return rows
+
+    def counters(self):
+        with self._lock:
+            return dict(sorted(self._counters.items()))
+
+    def render_prometheus(self):
+        """
+        Render every timing as a summary and every counter as a counter in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        lines = [
+            "# HELP tym_bot_duration_seconds Time spent per command and per stage.",
+            "# TYPE tym_bot_duration_seconds summary",
+        ]
+        for kind, name, count, total, p50, p95 in self.summary():
+            labels = f'kind="{kind}",name="{name}"'
+            lines.append(f'tym_bot_duration_seconds{{{labels},quantile="0.5"}} {p50:.6f}')
+            lines.append(f'tym_bot_duration_seconds{{{labels},quantile="0.95"}} {p95:.6f}')
+            lines.append(f'tym_bot_duration_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'tym_bot_duration_seconds_count{{{labels}}} {count}')
+        lines += ["# HELP tym_bot_events_total Calls and cache lookups.", "# TYPE tym_bot_events_total counter"]
+        counters = self.counters()
+        for name, value in {f"schedule_cache_{key}": value for key, value in SCHEDULE_CACHE.stats().items() if key != 'entries'}.items():
+            counters[name] = value
+        for name, value in {f"day_fragment_cache_{key}": value for key, value in DAY_FRAGMENT_CACHE.stats().items() if key != 'entries'}.items():
+            counters[name] = value
+        for name, value in counters.items():
+            lines.append(f'tym_bot_events_total{{name="{name}"}} {value}')
+        lines += ["# TYPE tym_bot_uptime_seconds gauge", f"tym_bot_uptime_seconds {time.time() - self.started_at:.0f}"]
+        return '\n'.join(lines) + '\n'
+
+def get_percentile(sorted_values, share):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(len(sorted_values) * share) - 1)]
+
+def timed_command(name, handler):
+    """
+    Wrap a command handler so its duration and failures are recorded in METRICS.
+
+    Args:
+        name (str): The command name, e.g. 'schedule'.
+        handler (callable): The async command handler.
+
+    Returns:
+        callable: The wrapped handler.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        METRICS.increment(f"command_{name}")
+        try:
+            with METRICS.timer('command', name):
+                return await handler(update, context)
+        except Exception:
+            METRICS.increment(f"command_{name}_failed")
+            raise
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records the time and count of every Bot API call in METRICS, per method.
+    """
+
+    async def do_request(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        METRICS.increment(f"telegram_{method}")
+        with METRICS.timer('stage', f"telegram_{method}"):
+            return await super().do_request(url, *args, **kwargs)
+
+async def serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            body, status = METRICS.render_prometheus().encode(), '200 OK'
+        else:
+            body, status = b'Not Found\n', '404 Not Found'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """
+    Serve METRICS in the Prometheus text format on METRICS_HOST:METRICS_PORT/metrics, when METRICS_PORT is set.
+    """
+    global METRICS_SERVER
+    if not METRICS_PORT or METRICS_SERVER is not None:
+        return
+    METRICS_SERVER = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+    print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+METRICS = MetricsRegistry(METRICS_WINDOW_SIZE)
+#endregion
+
+#region Request Coalescing
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one in-flight task.
+
+    The first caller of a key starts the task, and callers that arrive while it runs await the same task
+    and get the same result or exception. Each caller awaits the task through asyncio.shield, so a caller
+    that is cancelled, e.g. by a timeout, does not cancel the work the other callers are waiting on.
+    The key is forgotten as soon as the task finishes, so later calls start fresh.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._tasks = {}
+
+    async def run(self, key, coroutine_function):
+        """
+        Run coroutine_function() for key, or join the call already running for it.
+
+        Args:
+            key (Hashable): Identifies calls that can share a result.
+            coroutine_function (callable): Returns the coroutine to run when no call is in flight.
+
+        Returns:
+            Any: The result of the shared call.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(coroutine_function())
+            self._tasks[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        else:
+            METRICS.increment(f"coalesced_{self.name}")
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved, in case every caller was cancelled before it was raised
+            task.exception()
+
+    def in_flight(self):
+        return len(self._tasks)
+
+CALENDAR_FETCH_FLIGHTS = SingleFlight('fetch')
+CALENDAR_SYNC_FLIGHTS = SingleFlight('sync')
+#endregion
+
+#region Session Records
+LINE_BREAK_TAG_PATTERN = re.compile(r'<[/]?br>')
+UNSUPPORTED_TAG_PATTERN = re.compile(r'<[/]?(ul|ol|br|span|b)>')
+TEACHER_PATTERN = re.compile(r"Teacher:\s*(.*)")
+# Match main teacher and optionally shadowing or substitute teacher
+# Need to change this based on event description
+TEACHER_PAYMENT_PATTERN = re.compile(r"Teacher:\s*([^(@]+)\s*(@\w+)(?:\s*\(([^@]+)\s*@(\w+)\s*(shadowing|substitute|substituting)\))?")
+
+SUBSTITUTE_ROLE = "substitute"
+SHADOWING_ROLE = "shadowing"
+
+@dataclasses.dataclass(slots=True)
+class SessionRecord:
+    """
+    A calendar event parsed once into the fields used by schedule rendering and payroll.
+
+    teacher is the text after 'Teacher:' shown in schedules. The teacher_name/teacher_handle and
+    other_teacher_* fields come from the payment pattern and are None when the description does
+    not match it, in which case the session is left out of payroll.
+    """
+    event_id: str
+    etag: str
+    summary: str
+    start: datetime.datetime
+    end: datetime.datetime
+    hours: float
+    teacher: str
+    teacher_name: str = None
+    teacher_handle: str = None
+    other_teacher_name: str = None
+    other_teacher_handle: str = None
+    role: str = None
+    postponed: bool = False
+
+def get_session_handles(session):
+    """
+    Get the lowercase handles of every teacher booked into a session, including a substitute or shadowing teacher.
+
+    Args:
+        session (SessionRecord): The session.
+
+    Returns:
+        set: The handles, empty for a postponed session or one without handles.
+    """
+    if session.postponed:
+        return set()
+    return {handle.lower() for handle in (session.teacher_handle, session.other_teacher_handle) if handle}
+
+def normalize_event(event):
+    """
+    Parse a Google Calendar event into a SessionRecord.
+
+    Args:
+        event (dict): An event in the format the Calendar API returns.
+
+    Returns:
+        SessionRecord: The parsed session.
+    """
+    start = datetime.datetime.fromisoformat(event['start'].get('dateTime', event['start'].get('date')))
+    end = datetime.datetime.fromisoformat(event['end'].get('dateTime', event['end'].get('date')))
+    summary = event.get('summary', 'Unnamed Event')
+    description = remove_unsupported_tags(event.get('description', ''))
+
+    match = TEACHER_PATTERN.search(description)
+    session = SessionRecord(
+        event_id=event.get('id'),
+        etag=event.get('etag'),
+        summary=summary,
+        start=start,
+        end=end,
+        hours=(end - start).total_seconds() / 3600,
+        teacher=match.group(1).strip() if match else '',
+        postponed="POSTPONED" in summary,
+    )
+
+    match = TEACHER_PAYMENT_PATTERN.search(description)
+    if match:
+        session.teacher_name = match.group(1).strip()
+        session.teacher_handle = match.group(2).strip().lower()
+        if match.group(5):
+            session.other_teacher_name = match.group(3).strip()
+            session.other_teacher_handle = "@" + match.group(4).strip().lower()
+            session.role = SHADOWING_ROLE if match.group(5) == SHADOWING_ROLE else SUBSTITUTE_ROLE
+    return session
+#endregion
+
+#region Utility Functions
+@functools.cache
+def lazy_import(module_name):
+    """
+    Import a module the first time it is needed.
+
+    Args:
+        module_name (str): The module to import, e.g. 'pandas'.
+
+    Returns:
+        module: The imported module.
+    """
+    return importlib.import_module(module_name)
+
+def warm_up_imports():
+    """
+    Import WARM_UP_MODULES ahead of the first command that needs them.
+    """
+    for module_name in WARM_UP_MODULES:
+        lazy_import(module_name)
+
+def is_valid_date(input_date_str):
+    """
+    Validate the input date string.
+
+    Args:
+        input_date_str (str): Date string in the format 'YYYY-MM-DD'.
+
+    Returns:
+        bool: True if the input string is a valid date, False otherwise.
+    """
+    try:
+        datetime.datetime.strptime(input_date_str, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+def remove_unsupported_tags(message):
+    """
+    Remove unsupported HTML tags from a string.
+
+    Args:
+        message (str): The string containing HTML tags.
+
+    Returns:
+        str: The string with unsupported HTML tags removed.
+    """
+    message = LINE_BREAK_TAG_PATTERN.sub(' ', message)
+    message = UNSUPPORTED_TAG_PATTERN.sub('', message)
+    return message
+
+def get_calendar_config(calendar_key):
+    """
+    Look up the calendar config for a calendar key.
+
+    Args:
+        calendar_key (str): One of the keys in CALENDAR_CONFIGS, e.g. 'SOKC'.
+
+    Returns:
+        tuple | None: The matching entry of CALENDAR_CONFIGS, or None if the key is unknown.
+    """
+    return CALENDARS_BY_KEY.get(calendar_key)
+
+def format_schedule(branch_header, sessions):
+    """
+    Build the HTML schedule message for one venue, joining the fragment of each day once.
+
+    Args:
+        branch_header (str): The branch header shown above the schedule.
+        sessions (list): List of SessionRecords retrieved from the calendar.
+
+    Returns:
+        str: The formatted schedule.
+    """
+    sessions_by_day = group_sessions_by_day(sessions)
+    if not sessions_by_day:
+        return branch_header + "\nNo lessons for this week at this venue.\n"
+    return "".join([branch_header, *(render_day_fragment(day_str, day_sessions) for day_str, day_sessions in sessions_by_day.items())])
+
+def render_day_fragment(day_str, sessions):
+    """
+    Render one day of a schedule, or take it from DAY_FRAGMENT_CACHE when none of its lessons changed.
+
+    Args:
+        day_str (str): The day heading, e.g. 'Friday 02 May 2025'.
+        sessions (list): The SessionRecords of that day, ordered by start time.
+
+    Returns:
+        str: The day heading and its numbered lessons.
+    """
+    # Events without an etag cannot be told apart from a changed version of themselves, so they are not cached
+    key = (day_str, tuple((session.event_id, session.etag) for session in sessions))
+    cacheable = all(session.etag for session in sessions)
+    fragment = DAY_FRAGMENT_CACHE.get(key) if cacheable else None
+    if fragment is None:
+        fragment = "".join([
+            f"<b><u>{day_str}</u></b>\n\n",
+            *(f"{index}. {format_session(session)}\n\n" for index, session in enumerate(sessions, start=1)),
+            "\n",
+        ])
+        if cacheable:
+            DAY_FRAGMENT_CACHE.put(key, fragment)
+    return fragment
+
+def split_schedule_message(schedule, limit=SCHEDULE_MESSAGE_LIMIT):
+    """
+    Split a rendered schedule into message-sized parts at day boundaries.
+
+    A part that starts in the middle of a venue repeats that venue's branch header. A single day longer
+    than a message is split between lines, as is a message without day headings. A single line longer
+    than a message is split by split_html_line.
+
+    Args:
+        schedule (str): A schedule from build_schedule_message, optionally with text before it, or another HTML message.
+        limit (int, optional): Longest part. Defaults to SCHEDULE_MESSAGE_LIMIT.
+
+    Returns:
+        list: The parts, just [schedule] when it fits in one message.
+    """
+    if len(schedule) <= limit:
+        return [schedule]
+
+    # Blocks of (branch header to repeat before the block, block text). Each day and branch header starts a block
+    blocks = []
+    branch_header = ""
+    for line in schedule.splitlines(keepends=True):
+        if line.startswith('================'):
+            branch_header = line + "\n"
+            blocks.append(["", line])
+        elif DAY_HEADING_PATTERN.match(line.rstrip('\n')) or not blocks:
+            blocks.append([branch_header, line])
+        else:
+            blocks[-1][1] += line
+
+    parts, current = [], ""
+    for repeated_header, block in blocks:
+        pieces = [block] if len(repeated_header) + len(block) <= limit else block.splitlines(keepends=True)
+        for piece in pieces:
+            if current and len(current) + len(piece) > limit:
+                parts.append(current)
+                current = repeated_header
+            if len(current) + len(piece) > limit:
+                # A single line longer than a message
+                first, *middle, piece = split_html_line(piece, limit - len(current), limit)
+                parts.append(current + first)
+                parts.extend(middle)
+                current = ""
+            current += piece
+    if current:
+        parts.append(current)
+    return parts
+
+# A tag, an entity, a run of text, or a stray '<' or '&'
+HTML_TOKEN_PATTERN = re.compile(r'<[^>]*>|&#?\w+;|[^<&]+|[<&]')
+
+def split_html_line(line, first_limit, limit):
+    """
+    Split an HTML line that does not fit in one message, never inside a tag or an entity.
+
+    Tags still open at a cut are closed at the end of the piece and opened again at the start of the
+    next one, so every piece is valid HTML on its own.
+
+    Args:
+        line (str): The line, with its tags balanced.
+        first_limit (int): Longest first piece, the room left in the current part.
+        limit (int): Longest of the other pieces.
+
+    Returns:
+        list: The pieces, at least two.
+    """
+    pieces, piece, open_tags = [], "", []
+
+    def closing(tags):
+        return "".join(f"</{name}>" for _, name in reversed(tags))
+
+    def reopening(tags):
+        return "".join(opening for opening, _ in tags)
+
+    for token in HTML_TOKEN_PATTERN.findall(line):
+        tag = re.match(r'<(/?)([a-zA-Z][\w-]*)', token)
+        if tag is None:
+            tags_after = open_tags
+        elif tag.group(1):
+            tags_after = open_tags[:-1] if open_tags and open_tags[-1][1] == tag.group(2) else open_tags
+        else:
+            tags_after = open_tags + [(token, tag.group(2))]
+        while token:
+            piece_limit = limit if pieces else first_limit
+            if len(piece) + len(token) + len(closing(tags_after)) <= piece_limit:
+                piece, token, open_tags = piece + token, "", tags_after
+                continue
+            is_new_piece = piece == reopening(open_tags)
+            if len(token) == 1 or token[0] not in '<&':
+                # Text is cut between characters, leaving room to close the open tags
+                cut = piece_limit - len(piece) - len(closing(open_tags))
+                cut = max(cut, 1) if is_new_piece else cut
+                if cut > 0:
+                    piece, token = piece + token[:cut], token[cut:]
+            elif is_new_piece:
+                # A tag or entity that does not fit in a message even on its own
+                piece, token, open_tags = piece + token, "", tags_after
+                continue
+            pieces.append(piece + closing(open_tags))
+            piece = reopening(open_tags)
+    pieces.append(piece + closing(open_tags))
+    return pieces
+
+async def send_html_parts(send, text):
+    """
+    Send an HTML text that may not fit in one message, in parts split by split_schedule_message.
+
+    Args:
+        send (callable): Coroutine function sending one HTML part, e.g. update.message.reply_html.
+        text (str): The whole text.
+
+    Returns:
+        list: The sent messages.
+    """
+    return [await send(part) for part in split_schedule_message(text)]
+
+async def build_schedule_message(calendar_key, input_date_str, client, use_cache=True):
+    """
+    Fetch and format the schedule for one venue, or for every venue when calendar_key is ALL_KEY.
+
+    Venues found in SCHEDULE_CACHE are not fetched again, so a repeat preview makes no Google call.
+
+    Args:
+        calendar_key (str): A key in CALENDAR_CONFIGS or ALL_KEY.
+        input_date_str (str): The starting date for the schedule, formatted as 'YYYY-MM-DD'.
+        client (AsyncCalendarClient): Google Calendar API client.
+        use_cache (bool, optional): Whether a cached schedule may be used. The result is cached either way. Defaults to True.
+
+    Returns:
+        str: The formatted schedule.
+    """
+    time_min, time_max = get_fetch_window(input_date_str)
+    calendar_configs = get_calendar_configs(calendar_key)
+    venue_messages = await render_venue_schedules(calendar_configs, time_min, time_max, client, use_cache)
+    # Headers are added here, as the cached bodies are shared by venues with the same calendar
+    return "".join(config[3] + venue_messages[config[0]] for config in calendar_configs)
+
+def get_calendar_configs(calendar_key):
+    """
+    Get the venues a schedule message shows.
+
+    Args:
+        calendar_key (str): A key in CALENDAR_CONFIGS or ALL_KEY.
+
+    Returns:
+        list: Entries of CALENDAR_CONFIGS.
+    """
+    return CALENDAR_CONFIGS if calendar_key == ALL_KEY else [get_calendar_config(calendar_key)]
+
+async def render_venue_schedules(calendar_configs, time_min, time_max, client, use_cache=True):
+    """
+    Render the schedule body of each venue, without its branch header, fetching the venues that are not cached together.
+
+    Args:
+        calendar_configs (list): Entries of CALENDAR_CONFIGS.
+        time_min (datetime.datetime): Start of the window, see get_fetch_window.
+        time_max (datetime.datetime): End of the window.
+        client (AsyncCalendarClient): Google Calendar API client.
+        use_cache (bool, optional): Whether cached bodies may be used. The results are cached either way. Defaults to True.
+
+    Returns:
+        dict: Calendar key to its schedule body.
+    """
+    venue_messages = {}
+    configs_to_fetch = []
+    for config in calendar_configs:
+        cached_message = SCHEDULE_CACHE.get(get_schedule_cache_key(config[1], time_min, time_max)) if use_cache else None
+        if cached_message is None:
+            configs_to_fetch.append(config)
+        else:
+            venue_messages[config[0]] = cached_message
+
+    if configs_to_fetch:
+        with METRICS.timer('stage', 'calendar_fetch'):
+            results = await fetch_all_calendar_events(configs_to_fetch, time_min, time_max, client)
+        for (key, calendar_id, _, _), sessions, error in results:
+            if error is not None:
+                venue_messages[key] = "\nCould not load the schedule for this venue.\n\n"
+            else:
+                with METRICS.timer('stage', 'render'):
+                    venue_messages[key] = format_schedule("", sessions)
+                SCHEDULE_CACHE.put(get_schedule_cache_key(calendar_id, time_min, time_max), venue_messages[key])
+    return venue_messages
+#endregion
+
+#region Payments Functions
+def get_payment_period(start_date_str=None, end_date_str=None):
+    """
+    Get the time range covered by a payment sheet.
+
+    With only a start date (or none), the period is the usual 7-day schedule window after it.
+    With both dates, the period runs from the start of start_date_str to the end of end_date_str.
+
+    Args:
+        start_date_str (str, optional): Date formatted as 'YYYY-MM-DD'.
+        end_date_str (str, optional): Last day of the period, formatted as 'YYYY-MM-DD'.
+
+    Returns:
+        tuple: (time_min, time_max) as naive UTC datetimes.
+    """
+    if end_date_str is None:
+        return get_fetch_window(start_date_str)
+    time_min = datetime.datetime.strptime(start_date_str, '%Y-%m-%d')
+    time_max = datetime.datetime.strptime(end_date_str, '%Y-%m-%d') + datetime.timedelta(days=1)
+    return time_min, time_max
+
+def format_distinct(keys, format_key):
+    """
+    Format a column by formatting each distinct key once.
+
+    Sessions share a handful of dates and start times, so this is much cheaper than strftime per row.
+
+    Args:
+        keys (pandas.Series): The values to format.
+        format_key (callable): Formats one value.
+
+    Returns:
+        numpy.ndarray: The formatted strings, one per key.
+    """
+    pd = lazy_import('pandas')
+    np = lazy_import('numpy')
+    codes, uniques = pd.factorize(keys)
+    labels = np.array([format_key(key) for key in uniques], dtype=object)
+    return labels[codes]
+
+def format_minutes(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def build_payroll_frame(venue_sessions):
+    """
+    Build one columnar DataFrame with a row per payable session.
+
+    Sessions are copied into the frame in a single pass, and the payable teacher, rates, amounts
+    and remarks are then computed with vectorized operations. Substitute sessions are paid to the
+    substitute, postponed sessions are paid at 0 and every shadowing teacher gets an extra row right
+    after the session's main row. Sessions whose description does not name a teacher handle are skipped.
+
+    String columns are categorical, so memory use grows by roughly 80 bytes per row plus one copy of
+    each distinct venue, course, teacher, date and time.
+
+    Args:
+        venue_sessions (list): (venue name, list of SessionRecords) pairs, in the order venues appear on the sheet.
+
+    Returns:
+        pandas.DataFrame: Rows in venue then session order, with the columns of PAYMENT_SHEET_COLUMNS.
+    """
+    pd = lazy_import('pandas')
+    np = lazy_import('numpy')
+    # Times are shown as the wall clock time of the event, as in the calendar
+    sessions = pd.DataFrame.from_records(
+        [
+            (
+                venue, session.start.replace(tzinfo=None), session.end.replace(tzinfo=None), session.summary, session.hours,
+                session.teacher_name, session.teacher_handle, session.other_teacher_name, session.other_teacher_handle,
+                session.role, session.postponed
+            )
+            for venue, venue_session_list in venue_sessions
+            for session in venue_session_list
+            if session.teacher_handle is not None
+        ],
+        columns=[
+            'venue', 'start', 'end', 'course', 'hours', 'teacher_name', 'teacher_handle',
+            'other_teacher_name', 'other_teacher_handle', 'role', 'postponed'
+        ]
+    )
+    sessions['start'] = pd.to_datetime(sessions['start'])
+    sessions['end'] = pd.to_datetime(sessions['end'])
+    substitute = sessions['role'].eq(SUBSTITUTE_ROLE).to_numpy()
+    shadowing = sessions['role'].eq(SHADOWING_ROLE).to_numpy()
+    postponed = sessions['postponed'].to_numpy(dtype=bool)
+
+    main_handles = sessions['teacher_handle'].where(~substitute, sessions['other_teacher_handle'])
+    # Rates can differ per venue, so seniority is looked up by (venue, handle)
+    venue_rates = {venue: get_venue_rates(venue) for venue in sessions['venue'].unique()}
+    senior = pd.MultiIndex.from_arrays([sessions['venue'], main_handles]).isin(
+        [(venue, handle) for venue, rates in venue_rates.items() for handle in rates.senior_handles]
+    )
+    main_rates = np.where(
+        senior,
+        sessions['venue'].map({venue: rates.senior_hourly_rate for venue, rates in venue_rates.items()}),
+        sessions['venue'].map({venue: rates.hourly_rate for venue, rates in venue_rates.items()}),
+    )
+    main_rows = pd.DataFrame({
+        'order': np.arange(len(sessions)) * 2,
+        'session': np.arange(len(sessions)),
+        'Number of hours': sessions['hours'],
+        'Teacher Name': sessions['teacher_name'].where(~substitute, sessions['other_teacher_name']),
+        'Teacher Handle': main_handles,
+        'Hourly Rate': np.where(postponed, 0, main_rates),
+        'Remarks': np.where(postponed, 'Postponed', np.where(substitute, 'Substitute', '')),
+    })
+
+    shadowing_sessions = sessions[shadowing]
+    shadowing_rows = pd.DataFrame({
+        'order': shadowing_sessions.index.to_numpy() * 2 + 1,
+        'session': shadowing_sessions.index.to_numpy(),
+        'Number of hours': SHADOWING_HOURS,
+        'Teacher Name': shadowing_sessions['other_teacher_name'],
+        'Teacher Handle': shadowing_sessions['other_teacher_handle'],
+        'Hourly Rate': SHADOWING_HOURLY_RATE,
+        'Remarks': 'Shadowing',
+    })
+
+    payroll = pd.concat([main_rows, shadowing_rows], ignore_index=True).sort_values('order', kind='stable')
+    session_of_row = payroll['session'].to_numpy()
+    starts = sessions['start'].take(session_of_row)
+    ends = sessions['end'].take(session_of_row)
+    dates = starts.dt.normalize()
+    payroll['Venue'] = sessions['venue'].take(session_of_row).to_numpy()
+    payroll['Date'] = format_distinct(dates, lambda date: date.strftime('%Y-%m-%d'))
+    payroll['Day'] = format_distinct(dates, lambda date: date.strftime('%A'))
+    payroll['Course'] = sessions['course'].take(session_of_row).to_numpy()
+    payroll['Start Time'] = format_distinct(starts.dt.hour * 60 + starts.dt.minute, format_minutes)
+    payroll['End Time'] = format_distinct(ends.dt.hour * 60 + ends.dt.minute, format_minutes)
+    payroll['Amount'] = payroll['Number of hours'] * payroll['Hourly Rate']
+
+    payroll = payroll[PAYMENT_SHEET_COLUMNS].reset_index(drop=True)
+    for column in PAYROLL_TEXT_COLUMNS:
+        payroll[column] = payroll[column].astype('category')
+    return payroll
+
+def summarize_payroll(payroll):
+    """
+    Total the payroll per teacher and per venue.
+
+    Args:
+        payroll (pandas.DataFrame): The frame returned by build_payroll_frame.
+
+    Returns:
+        tuple: A tuple containing:
+            - teacher_totals (pandas.DataFrame): 'Teacher Name', 'Teacher Handle' and 'Amount' per handle, sorted by name.
+            - venue_totals (pandas.DataFrame): 'Venue' and 'Amount' per venue, in sheet order.
+    """
+    teacher_totals = (
+        payroll.groupby('Teacher Handle', observed=True, sort=False)
+        .agg(**{'Teacher Name': ('Teacher Name', 'first'), 'Amount': ('Amount', 'sum')})
+        .reset_index()
+    )
+    teacher_totals['Teacher Name'] = teacher_totals['Teacher Name'].astype(str)
+    teacher_totals = teacher_totals.sort_values('Teacher Name', kind='stable').reset_index(drop=True)
+
+    venue_totals = payroll.groupby('Venue', observed=True, sort=False)['Amount'].sum().reset_index()
+    return teacher_totals, venue_totals
+
+def build_payment_sheet(payroll, teacher_totals, venue_totals):
+    """
+    Lay out the payment sheet: the sessions of each venue separated by a blank row, then two blank rows,
+    the totals per teacher sorted by name, a blank row and the totals per venue.
+
+    Args:
+        payroll (pandas.DataFrame): The frame returned by build_payroll_frame.
+        teacher_totals (pandas.DataFrame): Totals per teacher from summarize_payroll.
+        venue_totals (pandas.DataFrame): Totals per venue from summarize_payroll.
+
+    Returns:
+        pandas.DataFrame: The sheet with the columns of PAYMENT_SHEET_COLUMNS.
+    """
+    pd = lazy_import('pandas')
+    def blank_rows(count):
+        return pd.DataFrame([[''] * len(PAYMENT_SHEET_COLUMNS)] * count, columns=PAYMENT_SHEET_COLUMNS)
+
+    sessions = payroll.astype(object)
+    blocks = []
+    for _, venue_rows in sessions.groupby(payroll['Venue'], observed=True, sort=False):
+        if blocks:
+            blocks.append(blank_rows(1))  # Blank row between venues
+        blocks.append(venue_rows)
+
+    blocks.append(blank_rows(2))
+    blocks.append(teacher_totals.reindex(columns=PAYMENT_SHEET_COLUMNS, fill_value=''))
+    blocks.append(blank_rows(1))
+    blocks.append(venue_totals.reindex(columns=PAYMENT_SHEET_COLUMNS, fill_value=''))
+    return pd.concat(blocks, ignore_index=True)
+
+def write_xlsx_report(sheet, buffer):
+    """
+    Write a sheet to an xlsx file with xlsxwriter in constant memory mode, which flushes each row
+    as soon as it is written instead of keeping the whole workbook in memory.
+
+    Args:
+        sheet (pandas.DataFrame): The sheet to write.
+        buffer (io.BytesIO): Where the file is written.
+    """
+    xlsxwriter = lazy_import('xlsxwriter')
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({'bold': True})
+    worksheet.write_row(0, 0, list(sheet.columns), header_format)
+    for row_index, row in enumerate(sheet.astype(object).itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_index, 0, row)
+    workbook.close()
+
+def write_report(sheet, payroll, report_format):
+    """
+    Write a payment report into memory.
+
+    xlsx and CSV contain the payment sheet as laid out by build_payment_sheet. Parquet needs a column
+    to hold a single type, so it contains the typed payroll rows without the blank rows and totals.
+
+    Args:
+        sheet (pandas.DataFrame): The sheet from build_payment_sheet.
+        payroll (pandas.DataFrame): The frame from build_payroll_frame.
+        report_format (str): One of REPORT_FORMATS.
+
+    Returns:
+        bytes: The report file.
+    """
+    buffer = io.BytesIO()
+    if report_format == XLSX_FORMAT:
+        write_xlsx_report(sheet, buffer)
+    elif report_format == CSV_FORMAT:
+        sheet.to_csv(buffer, index=False, encoding='utf-8')
+    elif report_format == PARQUET_FORMAT:
+        payroll.to_parquet(buffer, index=False)
+    else:
+        raise ValueError(f"Unsupported report format: {report_format}")
+    return buffer.getvalue()
+
+def archive_report(file_name, report):
+    """
+    Save a copy of a sent report in PAYMENTS_EXCEL_FOLDER.
+
+    Args:
+        file_name (str): Name of the report file.
+        report (bytes): The report file.
+    """
+    os.makedirs(PAYMENTS_EXCEL_FOLDER, exist_ok=True)
+    with open(os.path.join(PAYMENTS_EXCEL_FOLDER, file_name), 'wb') as file:
+        file.write(report)
+
+def run_in_background(coroutine):
+    """
+    Run a coroutine without waiting for it, logging any error.
+
+    Args:
+        coroutine (Coroutine): The coroutine to run.
+    """
+    async def log_errors():
+        try:
+            await coroutine
+        except Exception as e:
+            print(f"Background task failed. Error: {str(e)}")
+
+    task = asyncio.create_task(log_errors())
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+async def generate_payment_sheet_for_all_calendars(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Generates a payment sheet for staff based on Google Calendar description.
+    The command is answered right away with a progress message, and the sheet is prepared and sent by a
+    background job, see ReportJobManager. A copy is saved in PAYMENTS_EXCEL_FOLDER when PAYMENTS_ARCHIVE_ENABLED is set.
+
+    Usage: /paymentforall [date] for the 7 days after date, or /paymentforall <start date> <end date> for a month or term.
+    Add csv or parquet at the end for a smaller file than the default xlsx.
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    args = list(context.args)
+    report_format = args.pop().lower() if args and args[-1].lower() in REPORT_FORMATS else XLSX_FORMAT
+    start_date_str = args[0] if len(args) > 0 else None
+    end_date_str = args[1] if len(args) > 1 else None
+    if any(date_str and not is_valid_date(date_str) for date_str in (start_date_str, end_date_str)):
+        await update.message.reply_html("Date format is not valid.")
+        return
+
+    time_min, time_max = get_payment_period(start_date_str, end_date_str)
+    period_days = (time_max - time_min).days
+    if period_days < 1 or period_days > MAX_PAYMENT_PERIOD_DAYS:
+        await update.message.reply_html(f"The end date must be after the start date and the period at most {MAX_PAYMENT_PERIOD_DAYS} days.")
+        return
+
+    await REPORT_JOBS.submit(context.bot, update.message.chat_id, time_min, time_max, report_format)
+
+async def cancel_payment_sheets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    count = await REPORT_JOBS.cancel(context.bot, update.message.chat_id)
+    if count:
+        await update.message.reply_text(f"Cancelled {count} payment sheet{'s' if count > 1 else ''}.")
+    else:
+        await update.message.reply_text("No payment sheet is being prepared for this chat.")
+#endregion
+
+#region Payroll Ledger
+# Column of payroll_ledger holding each payment sheet column
+PAYROLL_LEDGER_COLUMNS = {
+    'Venue': 'venue', 'Date': 'date', 'Day': 'day', 'Course': 'course', 'Start Time': 'start_time', 'End Time': 'end_time',
+    'Number of hours': 'hours', 'Teacher Name': 'teacher_name', 'Teacher Handle': 'teacher_handle',
+    'Hourly Rate': 'hourly_rate', 'Amount': 'amount', 'Remarks': 'remarks',
+}
+
+class PayrollLedger:
+    """
+    Append-only SQLite ledger of the payroll rows of finalized weeks, see get_ledger_cutoff.
+
+    Weeks run Monday to Sunday by the date of the lesson. Each week of each venue is written once, in the
+    same transaction as its row in payroll_weeks, and never changed afterwards, so a past payment sheet is
+    read back exactly as it was paid. Rows are indexed by week and venue, by teacher handle and by date.
+    Methods are blocking and are run in a thread.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS payroll_weeks (
+                    week_start TEXT NOT NULL,
+                    venue TEXT NOT NULL,
+                    finalized_at TEXT NOT NULL,
+                    PRIMARY KEY (week_start, venue)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS payroll_ledger (
+                    week_start TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    venue TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    course TEXT NOT NULL,
+                    start_time TEXT NOT NULL,
+                    end_time TEXT NOT NULL,
+                    hours REAL NOT NULL,
+                    teacher_name TEXT,
+                    teacher_handle TEXT,
+                    hourly_rate NUMERIC NOT NULL,
+                    amount REAL NOT NULL,
+                    remarks TEXT NOT NULL,
+                    PRIMARY KEY (week_start, venue, position)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS payroll_ledger_by_handle ON payroll_ledger (teacher_handle, date)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS payroll_ledger_by_date ON payroll_ledger (date)")
+
+    def get_missing_weeks(self, week_starts, venue_names):
+        """
+        Args:
+            week_starts (list): Mondays of the weeks to check, in order.
+            venue_names (list): The venues to check.
+
+        Returns:
+            list: (week start, venue name) pairs that are not in the ledger yet, in week order.
+        """
+        with self._lock:
+            finalized = set(self._conn.execute(
+                "SELECT week_start, venue FROM payroll_weeks WHERE week_start >= ? AND week_start <= ?",
+                (week_starts[0].isoformat(), week_starts[-1].isoformat())
+            ))
+        return [
+            (week_start, venue_name) for week_start in week_starts for venue_name in venue_names
+            if (week_start.isoformat(), venue_name) not in finalized
+        ]
+
+    def append_week(self, week_start, venue_name, payroll):
+        """
+        Write the payroll of one finalized week of one venue. A week already in the ledger is left as it is.
+
+        Args:
+            week_start (datetime.date): Monday of the week.
+            venue_name (str): The venue.
+            payroll (pandas.DataFrame): The week's rows from build_payroll_frame, in sheet order.
+
+        Returns:
+            bool: True if the week was written, False if it was already in the ledger.
+        """
+        rows = [
+            (week_start.isoformat(), position, *row)
+            for position, row in enumerate(payroll[PAYMENT_SHEET_COLUMNS].astype(object).itertuples(index=False, name=None))
+        ]
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO payroll_weeks (week_start, venue, finalized_at) VALUES (?, ?, ?)",
+                        (week_start.isoformat(), venue_name, datetime.datetime.utcnow().isoformat())
+                    )
+                    self._conn.executemany(
+                        f"INSERT INTO payroll_ledger (week_start, position, {', '.join(PAYROLL_LEDGER_COLUMNS.values())}) "
+                        f"VALUES ({', '.join('?' * (len(PAYROLL_LEDGER_COLUMNS) + 2))})",
+                        rows
+                    )
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def read_payroll(self, start_date, end_date):
+        """
+        Read the payroll rows of the lessons from start_date up to end_date.
+
+        Args:
+            start_date (datetime.date): First day.
+            end_date (datetime.date): Day after the last day.
+
+        Returns:
+            pandas.DataFrame: Rows with the columns of PAYMENT_SHEET_COLUMNS, each venue's rows in lesson order.
+        """
+        pd = lazy_import('pandas')
+        with self._lock:
+            payroll = pd.read_sql_query(
+                f"""
+                SELECT {', '.join(PAYROLL_LEDGER_COLUMNS.values())} FROM payroll_ledger
+                WHERE week_start >= ? AND week_start < ? AND date >= ? AND date < ?
+                ORDER BY week_start, venue, position
+                """,
+                self._conn,
+                params=(get_week_start(start_date).isoformat(), end_date.isoformat(), start_date.isoformat(), end_date.isoformat())
+            )
+        payroll.columns = list(PAYROLL_LEDGER_COLUMNS)
+        # As build_payroll_frame makes them, e.g. a week of only shadowing rows would otherwise read back whole hours as int
+        return payroll.astype({'Number of hours': float, 'Amount': float})
+
+    def get_teacher_totals(self, year_start, quarter_start, month_start, end_date, handle=None):
+        """
+        Total every teacher's pay for the month, quarter and year up to end_date, in one indexed aggregate query.
+
+        Args:
+            year_start (datetime.date): First day of the year.
+            quarter_start (datetime.date): First day of the quarter.
+            month_start (datetime.date): First day of the month.
+            end_date (datetime.date): Day after the last day counted.
+            handle (str, optional): Only this teacher handle.
+
+        Returns:
+            dict: Teacher handle to [teacher name, month total, quarter total, year total].
+        """
+        query = """
+            SELECT teacher_handle, MAX(teacher_name),
+                   SUM(CASE WHEN date >= ? THEN amount ELSE 0 END),
+                   SUM(CASE WHEN date >= ? THEN amount ELSE 0 END),
+                   SUM(amount)
+            FROM payroll_ledger WHERE date >= ? AND date < ?
+        """
+        params = [month_start.isoformat(), quarter_start.isoformat(), year_start.isoformat(), end_date.isoformat()]
+        if handle is not None:
+            query += " AND teacher_handle = ?"
+            params.append(handle)
+        with self._lock:
+            rows = self._conn.execute(query + " GROUP BY teacher_handle", params).fetchall()
+        return {row[0]: list(row[1:]) for row in rows}
+
+def get_payroll_ledger():
+    """
+    Get the process-wide PayrollLedger, opening it on first use.
+
+    Returns:
+        PayrollLedger | None: The ledger, or None when PAYROLL_LEDGER_PATH is empty.
+    """
+    global PAYROLL_LEDGER
+    if PAYROLL_LEDGER is None and PAYROLL_LEDGER_PATH:
+        PAYROLL_LEDGER = PayrollLedger(PAYROLL_LEDGER_PATH)
+    return PAYROLL_LEDGER
+
+def get_week_start(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+def get_ledger_cutoff():
+    """
+    Get the Monday of the first week that is not finalized yet.
+
+    A week is finalized once more than PAYROLL_FINALIZE_AFTER_DAYS have passed since its Sunday, so late
+    changes in the calendar still reach its payroll.
+
+    Returns:
+        datetime.date: The Monday.
+    """
+    return get_week_start(datetime.datetime.utcnow().date() - datetime.timedelta(days=PAYROLL_FINALIZE_AFTER_DAYS))
+
+async def finalize_payroll_weeks(start_date, end_date, client):
+    """
+    Make sure every finalized week overlapping a period is in the ledger, fetching only the missing ones.
+
+    The missing weeks of all venues are fetched together in one window, so filling in a whole term costs
+    one fetch, and each week of each venue is then appended with its own payroll.
+
+    Args:
+        start_date (datetime.date): First day of the period.
+        end_date (datetime.date): Day after the last day of the period.
+        client (AsyncCalendarClient): Google Calendar API client.
+
+    Returns:
+        tuple: (the day the ledger part of the period ends, which is start_date when none of it is finalized,
+                names of the venues whose missing weeks could not be fetched).
+    """
+    ledger = get_payroll_ledger()
+    ledger_end = min(end_date, get_ledger_cutoff())
+    if ledger is None or ledger_end <= start_date:
+        return start_date, []
+
+    week_starts = [get_week_start(start_date)]
+    while week_starts[-1] + datetime.timedelta(days=7) < ledger_end:
+        week_starts.append(week_starts[-1] + datetime.timedelta(days=7))
+    missing = await asyncio.to_thread(ledger.get_missing_weeks, week_starts, [config[2] for config in PAYROLL_CALENDAR_CONFIGS])
+    if not missing:
+        return ledger_end, []
+
+    # Lessons are put in weeks by their own date, so the window in UTC has a day of margin on each side
+    missing_venues = {venue_name for _, venue_name in missing}
+    time_min = datetime.datetime.combine(missing[0][0] - datetime.timedelta(days=1), datetime.time())
+    time_max = datetime.datetime.combine(missing[-1][0] + datetime.timedelta(days=8), datetime.time())
+    with METRICS.timer('stage', 'ledger_fetch'):
+        results = await fetch_all_calendar_events(
+            [config for config in PAYROLL_CALENDAR_CONFIGS if config[2] in missing_venues], time_min, time_max, client
+        )
+
+    failed_venues = []
+    sessions_by_week = collections.defaultdict(list)
+    for (_, _, venue_name, _), sessions, error in results:
+        if error is not None:
+            failed_venues.append(venue_name)
+            continue
+        for session in sessions:
+            sessions_by_week[(get_week_start(session.start.date()), venue_name)].append(session)
+
+    def append_weeks():
+        with METRICS.timer('stage', 'ledger_append'):
+            for week_start, venue_name in missing:
+                if venue_name not in failed_venues:
+                    payroll = build_payroll_frame([(venue_name, sessions_by_week[(week_start, venue_name)])])
+                    ledger.append_week(week_start, venue_name, payroll)
+
+    await asyncio.to_thread(append_weeks)
+    return ledger_end, failed_venues
+
+def combine_payroll_frames(frames):
+    """
+    Join payroll frames into one, with each venue's rows together in CALENDAR_CONFIGS order, and in frame
+    order within a venue.
+
+    Args:
+        frames (list): Frames with the columns of PAYMENT_SHEET_COLUMNS, e.g. from the ledger and build_payroll_frame.
+
+    Returns:
+        pandas.DataFrame: The joined frame.
+    """
+    pd = lazy_import('pandas')
+    # An empty frame has no numeric dtypes, and joining it would turn e.g. Hourly Rate into float in the sheet
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    payroll = pd.concat([frame.astype({column: object for column in PAYROLL_TEXT_COLUMNS}) for frame in frames], ignore_index=True)
+    venue_order = payroll['Venue'].map({config[2]: index for index, config in enumerate(CALENDAR_CONFIGS)}).fillna(len(CALENDAR_CONFIGS))
+    payroll = payroll.iloc[venue_order.to_numpy().argsort(kind='stable')].reset_index(drop=True)
+    payroll['Amount'] = payroll['Amount'].astype(float)
+    for column in PAYROLL_TEXT_COLUMNS:
+        payroll[column] = payroll[column].astype('category')
+    return payroll
+
+def add_payroll_totals(totals, payroll, quarter_start, month_start, handle=None):
+    """
+    Add payroll rows to teacher totals from PayrollLedger.get_teacher_totals.
+
+    Args:
+        totals (dict): Teacher handle to [teacher name, month total, quarter total, year total], updated in place.
+        payroll (pandas.DataFrame): Rows from build_payroll_frame, all in the current year.
+        quarter_start (datetime.date): First day of the quarter.
+        month_start (datetime.date): First day of the month.
+        handle (str, optional): Only this teacher handle.
+    """
+    columns = payroll[['Teacher Handle', 'Teacher Name', 'Date', 'Amount']].astype(object)
+    for teacher_handle, teacher_name, date_str, amount in columns.itertuples(index=False, name=None):
+        if handle is not None and teacher_handle != handle:
+            continue
+        total = totals.setdefault(teacher_handle, [teacher_name, 0, 0, 0])
+        if date_str >= month_start.isoformat():
+            total[1] += amount
+        if date_str >= quarter_start.isoformat():
+            total[2] += amount
+        total[3] += amount
+
+def format_payroll_totals(totals, year_start, quarter_start, month_start, today):
+    """
+    Build the HTML reply of /payrolltotals, with every teacher. Send it with send_html_parts, as it may not fit in one message.
+
+    Args:
+        totals (dict): Teacher handle to [teacher name, month total, quarter total, year total].
+        year_start (datetime.date): First day of the year.
+        quarter_start (datetime.date): First day of the quarter.
+        month_start (datetime.date): First day of the month.
+        today (datetime.date): The last day counted.
+
+    Returns:
+        str: The message.
+    """
+    header = (f"<b>Pay to date on {today.strftime('%d %b %Y')}</b>\n"
+              f"<i>Month from {month_start.strftime('%d %b')}, quarter from {quarter_start.strftime('%d %b')}, "
+              f"year from {year_start.strftime('%d %b')}</i>\n\n")
+    if not totals:
+        return header + "No payroll this year."
+
+    rows = sorted(totals.items(), key=lambda item: (str(item[1][0]), item[0]))
+    lines = [
+        f"{html.escape(str(teacher_name))} {teacher_handle}: month ${month_total:,.2f}, quarter ${quarter_total:,.2f}, year ${year_total:,.2f}"
+        for teacher_handle, (teacher_name, month_total, quarter_total, year_total) in rows
+    ]
+    return header + "\n".join(lines)
+
+async def show_payroll_totals(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Replies with every teacher's pay for the month, quarter and year to date, or one teacher's.
+
+    Finalized weeks are totalled in the payroll ledger with one indexed query, and only the weeks since
+    then are fetched from the calendars.
+
+    Usage: /payrolltotals [@handle]
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    handle = context.args[0].lower() if context.args else None
+    if handle is not None and not handle.startswith('@'):
+        await update.message.reply_html("Usage: /payrolltotals [@handle]")
+        return
+    ledger = get_payroll_ledger()
+    if ledger is None:
+        await update.message.reply_html("The payroll ledger is turned off, set PAYROLL_LEDGER_PATH to use /payrolltotals.")
+        return
+
+    today = datetime.datetime.utcnow().date()
+    end_date = today + datetime.timedelta(days=1)
+    year_start = today.replace(month=1, day=1)
+    quarter_start = today.replace(month=3 * ((today.month - 1) // 3) + 1, day=1)
+    month_start = today.replace(day=1)
+
+    client = await get_calendar_client()
+    ledger_end, failed_venues = await finalize_payroll_weeks(year_start, end_date, client)
+    totals = {}
+    if not failed_venues:
+        totals = await asyncio.to_thread(ledger.get_teacher_totals, year_start, quarter_start, month_start, ledger_end, handle)
+        # Lessons since the last finalized week, with a day of margin as in finalize_payroll_weeks
+        time_min = datetime.datetime.combine(max(year_start, ledger_end - datetime.timedelta(days=1)), datetime.time())
+        results = await fetch_all_calendar_events(PAYROLL_CALENDAR_CONFIGS, time_min, datetime.datetime.combine(end_date, datetime.time()), client)
+        failed_venues = [config[2] for config, _, error in results if error is not None]
+        venue_sessions = [
+            (config[2], [session for session in sessions if ledger_end <= session.start.date() < end_date])
+            for config, sessions, _ in results
+        ]
+        payroll = await asyncio.to_thread(build_payroll_frame, venue_sessions)
+        add_payroll_totals(totals, payroll, quarter_start, month_start, handle)
+
+    if failed_venues:
+        await update.message.reply_html(f"Could not load {', '.join(failed_venues)}, so the totals were not counted.")
+        return
+    await send_html_parts(update.message.reply_html, format_payroll_totals(totals, year_start, quarter_start, month_start, today))
+#endregion
+
+#region Report Jobs
+@dataclasses.dataclass(slots=True)
+class ReportJob:
+    """
+    A payment sheet being prepared or recently sent, see ReportJobManager.
+    """
+    key: tuple
+    file_name: str
+    chat_ids: list
+    progress_chat_id: int
+    progress_message_id: int = None
+    task: asyncio.Task = None
+    status: str = 'queued' # queued, running, done, failed or cancelled
+    venues: dict = None # Venue name to its number of lessons, or the error that stopped its fetch
+    stage: str = "Queued"
+    report: bytes = None
+    file_id: str = None
+    finished_at: float = None
+
+class ReportJobManager:
+    """
+    Prepares payment sheets in the background, at most REPORT_MAX_CONCURRENT_JOBS at a time.
+
+    Each job posts one progress message and edits it at each stage: reading finalized weeks, fetching
+    lessons, building the sheet and sending it. The venues are fetched in one batch, so their lesson
+    counts all appear together when the fetch stage ends, not one venue at a time. The file goes to every chat that asked for it. A request for a period that is
+    still being prepared joins that job. A request for a period sent in the last REPORT_JOB_REUSE_SECONDS
+    gets the same file again, by its Telegram file id, so nothing is fetched or uploaded twice.
+    """
+
+    def __init__(self, max_concurrent_jobs, reuse_seconds):
+        self.reuse_seconds = reuse_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrent_jobs)
+        self._jobs = {}
+
+    def jobs(self):
+        return list(self._jobs.values())
+
+    async def submit(self, bot, chat_id, time_min, time_max, report_format):
+        """
+        Start a payment sheet job, or join or reuse one for the same period and format.
+
+        Jobs are keyed by the dates of the period, since the default period starts at the current time and
+        would otherwise never match an earlier request.
+
+        Args:
+            bot (Bot): The bot used to post progress and send the file.
+            chat_id (int): The chat that asked for the sheet.
+            time_min (datetime.datetime): Start of the period as a naive UTC datetime, see get_payment_period.
+            time_max (datetime.datetime): End of the period as a naive UTC datetime.
+            report_format (str): One of REPORT_FORMATS.
+
+        Returns:
+            ReportJob: The job that will deliver the sheet.
+        """
+        key = (time_min.date(), time_max.date(), report_format)
+        self._forget_finished()
+        job = self._jobs.get(key)
+        if job is not None and job.status in ('queued', 'running'):
+            METRICS.increment('report_jobs_joined')
+            if chat_id not in job.chat_ids:
+                job.chat_ids.append(chat_id)
+            await bot.send_message(chat_id=chat_id, text=f"{job.file_name} is already being prepared, it will be sent here when ready.")
+            return job
+        if job is not None and job.status == 'done':
+            METRICS.increment('report_jobs_reused')
+            await self._deliver(bot, job, [chat_id])
+            return job
+
+        last_day = time_max - datetime.timedelta(days=1)
+        file_name = f"Payment_{time_min.strftime('%Y-%m-%d')}_{last_day.strftime('%Y-%m-%d')}.{report_format}"
+        job = ReportJob(key=key, file_name=file_name, chat_ids=[chat_id], progress_chat_id=chat_id, venues={config[2]: None for config in PAYROLL_CALENDAR_CONFIGS})
+        self._jobs[key] = job
+        METRICS.increment('report_jobs_started')
+        try:
+            progress_message = await bot.send_message(chat_id=chat_id, text=self._progress_text(job))
+        except Exception:
+            # Without this, later requests for the period would join a job that never runs
+            job.status, job.finished_at = 'failed', time.monotonic()
+            self._jobs.pop(key, None)
+            raise
+        job.progress_message_id = progress_message.message_id
+        if job.status == 'cancelled':
+            # Every chat stopped waiting while the progress message was being posted
+            return job
+
+        job.task = asyncio.create_task(self._run(bot, job, time_min, time_max, report_format))
+        BACKGROUND_TASKS.add(job.task)
+        job.task.add_done_callback(BACKGROUND_TASKS.discard)
+        return job
+
+    async def cancel(self, bot, chat_id):
+        """
+        Stop waiting for the jobs a chat asked for. A job that no other chat is waiting for is cancelled.
+
+        Args:
+            bot (Bot): The bot used to update the progress messages.
+            chat_id (int): The chat that asked for the jobs.
+
+        Returns:
+            int: The number of jobs the chat stopped waiting for.
+        """
+        count = 0
+        for job in self.jobs():
+            if job.status in ('queued', 'running') and chat_id in job.chat_ids:
+                job.chat_ids.remove(chat_id)
+                if not job.chat_ids:
+                    # A job still waiting for a worker never gets to handle its cancellation, so it is marked here.
+                    # Its task is not created yet while the progress message is being posted
+                    if job.task is not None:
+                        job.task.cancel()
+                    await self._mark_cancelled(bot, job)
+                count += 1
+        return count
+
+    async def _run(self, bot, job, time_min, time_max, report_format):
+        try:
+            async with self._semaphore:
+                job.status = 'running'
+                client = await get_calendar_client()
+                start_date, end_date = time_min.date(), time_max.date()
+                ledger_end = start_date
+                ledger_payroll = None
+                ledger_lessons = {}
+                if get_ledger_cutoff() > start_date and get_payroll_ledger() is not None:
+                    await self._set_stage(bot, job, "Reading finalized weeks")
+                    ledger_end, failed_venues = await finalize_payroll_weeks(start_date, end_date, client)
+                    if failed_venues:
+                        raise RuntimeError(f"Failed to fetch events for {', '.join(failed_venues)}. Payment sheet was not generated.")
+                    ledger_payroll = await asyncio.to_thread(get_payroll_ledger().read_payroll, start_date, ledger_end)
+                    ledger_lessons = ledger_payroll.loc[ledger_payroll['Remarks'] != 'Shadowing', 'Venue'].value_counts().to_dict()
+                    for venue_name in job.venues:
+                        job.venues[venue_name] = ledger_lessons.get(venue_name, 0)
+
+                results = []
+                if ledger_end < end_date:
+                    await self._set_stage(bot, job, "Fetching lessons")
+                    # After the finalized weeks, with a day of margin as in finalize_payroll_weeks
+                    fetch_min = time_min if ledger_end == start_date else datetime.datetime.combine(ledger_end - datetime.timedelta(days=1), datetime.time())
+
+                    # Every venue in one batched fetch, so the progress message shows all venues' results at once
+                    with METRICS.timer('stage', 'calendar_fetch'):
+                        fetched = await fetch_all_calendar_events(PAYROLL_CALENDAR_CONFIGS, fetch_min, time_max, client)
+                    for config, sessions, error in fetched:
+                        if ledger_end > start_date:
+                            sessions = [session for session in sessions if session.start.date() >= ledger_end]
+                        job.venues[config[2]] = error if error is not None else ledger_lessons.get(config[2], 0) + len(sessions)
+                        results.append((config, sessions, error))
+                    await self._update_progress(bot, job)
+
+                    failed_venues = [config[2] for config, _, error in results if error is not None]
+                    if failed_venues:
+                        raise RuntimeError(f"Failed to fetch events for {', '.join(failed_venues)}. Payment sheet was not generated.")
+
+                await self._set_stage(bot, job, "Building the payment sheet")
+                venue_sessions = [(venue_name, sessions) for (_, _, venue_name, _), sessions, _ in results]
+                # Building and writing the sheet is CPU bound, so it runs off the event loop
+                job.report = await asyncio.to_thread(build_report, venue_sessions, report_format, ledger_payroll)
+                if PAYMENTS_ARCHIVE_ENABLED:
+                    run_in_background(asyncio.to_thread(archive_report, job.file_name, job.report))
+
+                await self._set_stage(bot, job, "Sending")
+                await self._deliver(bot, job, list(job.chat_ids))
+                job.status, job.finished_at = 'done', time.monotonic()
+                await self._set_stage(bot, job, "Sent")
+        except asyncio.CancelledError:
+            await self._mark_cancelled(bot, job)
+            raise
+        except Exception as e:
+            job.status, job.finished_at = 'failed', time.monotonic()
+            print(f"Payment sheet job {job.file_name} failed. Error: {str(e)}")
+            await self._set_stage(bot, job, f"Failed. Error: {str(e)}")
+
+    async def _deliver(self, bot, job, chat_ids):
+        for chat_id in chat_ids:
+            try:
+                message = await bot.send_document(
+                    chat_id=chat_id, document=job.file_id or job.report, filename=job.file_name, caption="Payment sheet for all venues."
+                )
+            except Exception as e:
+                print(f"Failed to send {job.file_name} to chat id {chat_id}. Error: {str(e)}")
+                await bot.send_message(chat_id=chat_id, text=f"Failed to send the payment sheet. Error: {str(e)}")
+                continue
+            if job.file_id is None and message.document is not None:
+                # Telegram keeps the upload, so later sends only pass its id and the bytes can be dropped
+                job.file_id, job.report = message.document.file_id, None
+
+    async def _mark_cancelled(self, bot, job):
+        if job.status != 'cancelled':
+            job.status, job.finished_at = 'cancelled', time.monotonic()
+            await self._set_stage(bot, job, "Cancelled")
+
+    async def _set_stage(self, bot, job, stage):
+        job.stage = stage
+        await self._update_progress(bot, job)
+
+    async def _update_progress(self, bot, job):
+        try:
+            await bot.edit_message_text(chat_id=job.progress_chat_id, message_id=job.progress_message_id, text=self._progress_text(job))
+        except Exception as e:
+            # Progress is only informational, the job goes on without it
+            if 'not modified' not in str(e).lower():
+                print(f"Failed to update the progress of {job.file_name}. Error: {str(e)}")
+
+    @staticmethod
+    def _progress_text(job):
+        lines = [f"Payment sheet {job.file_name}"]
+        for venue_name, result in job.venues.items():
+            if result is None:
+                lines.append(f"⏳ {venue_name}")
+            elif isinstance(result, Exception):
+                lines.append(f"❌ {venue_name}")
+            else:
+                lines.append(f"✅ {venue_name}: {result} lessons")
+        lines.append(job.stage)
+        return '\n'.join(lines)
+
+    def _forget_finished(self):
+        now = time.monotonic()
+        for key, job in list(self._jobs.items()):
+            if job.status in ('failed', 'cancelled') or (job.status == 'done' and now - job.finished_at > self.reuse_seconds):
+                del self._jobs[key]
+
+def build_report(venue_sessions, report_format, ledger_payroll=None):
+    """
+    Build the payroll and write the payment sheet.
+
+    Args:
+        venue_sessions (list): (venue name, sessions) pairs in venue order.
+        report_format (str): One of REPORT_FORMATS.
+        ledger_payroll (pandas.DataFrame, optional): Payroll of the earlier, finalized part of the period from the ledger.
+
+    Returns:
+        bytes: The report file.
+    """
+    with METRICS.timer('stage', 'payroll'):
+        payroll = build_payroll_frame(venue_sessions)
+        if ledger_payroll is not None:
+            payroll = combine_payroll_frames([ledger_payroll, payroll])
+        teacher_totals, venue_totals = summarize_payroll(payroll)
+        sheet = build_payment_sheet(payroll, teacher_totals, venue_totals)
+    with METRICS.timer('stage', f"report_export_{report_format}"):
+        return write_report(sheet, payroll, report_format)
+
+REPORT_JOBS = ReportJobManager(REPORT_MAX_CONCURRENT_JOBS, REPORT_JOB_REUSE_SECONDS)
+#endregion
+
+#region Teacher Conflicts
+@dataclasses.dataclass(slots=True)
+class Booking:
+    """
+    One teacher handle booked into one session, see find_teacher_conflicts.
+    """
+    start: datetime.datetime
+    end: datetime.datetime
+    venue_name: str
+    session: SessionRecord
+
+def get_bookings_by_handle(venue_sessions):
+    """
+    Group the sessions every teacher handle is booked into, including substitutes and shadowing teachers.
+    Postponed sessions and sessions without a handle are left out.
+
+    Args:
+        venue_sessions (list): (venue name, sessions) pairs.
+
+    Returns:
+        dict: Teacher handle to its Bookings ordered by start time.
+    """
+    bookings_by_handle = collections.defaultdict(list)
+    for venue_name, sessions in venue_sessions:
+        for session in sessions:
+            for handle in get_session_handles(session):
+                bookings_by_handle[handle].append(Booking(session.start, session.end, venue_name, session))
+    for bookings in bookings_by_handle.values():
+        bookings.sort(key=lambda booking: (booking.start, booking.end))
+    return bookings_by_handle
+
+def get_calendar_venue_sessions(results):
+    """
+    Get the sessions of every calendar that was fetched, once per calendar.
+
+    A calendar shared by several venues is listed once, under all of their names, so its sessions are
+    not taken for bookings at two different venues.
+
+    Args:
+        results (list): (calendar config, sessions, error) tuples from fetch_all_calendar_events.
+
+    Returns:
+        list: (venue name, sessions) pairs, see CALENDAR_VENUE_NAMES.
+    """
+    venue_sessions = {}
+    for config, sessions, error in results:
+        if error is None:
+            venue_sessions[config[1]] = (CALENDAR_VENUE_NAMES.get(config[1], config[2]), sessions)
+    return list(venue_sessions.values())
+
+def find_teacher_conflicts(venue_sessions, min_gap_minutes=MIN_VENUE_CHANGE_MINUTES):
+    """
+    Find teachers booked into overlapping sessions at different venues, or into sessions at different
+    venues with less than min_gap_minutes between them to travel.
+
+    Each handle's bookings are swept in start order with a heap of the bookings still running, so the
+    whole check is O(n log n + conflicts) however long the window is.
+
+    Args:
+        venue_sessions (list): (venue name, sessions) pairs, e.g. from fetch_all_calendar_events.
+        min_gap_minutes (int, optional): Shortest break between sessions at different venues. Defaults to MIN_VENUE_CHANGE_MINUTES.
+
+    Returns:
+        list: (kind, handle, earlier Booking, later Booking, gap in minutes) tuples ordered by start time,
+              where kind is 'overlap' or 'short gap' and the gap of an overlap is negative.
+    """
+    min_gap = datetime.timedelta(minutes=min_gap_minutes)
+    conflicts = []
+    for handle, bookings in get_bookings_by_handle(venue_sessions).items():
+        running = [] # Heap of (end, index) of the bookings that have not ended yet
+        latest = None # The booking that ended last before the current one started
+        for index, booking in enumerate(bookings):
+            while running and running[0][0] <= booking.start:
+                ended = bookings[heapq.heappop(running)[1]]
+                if latest is None or ended.end > latest.end:
+                    latest = ended
+            for _, running_index in running:
+                other = bookings[running_index]
+                if other.venue_name != booking.venue_name:
+                    conflicts.append(('overlap', handle, other, booking, -(other.end - booking.start).total_seconds() / 60))
+            if not running and latest is not None and latest.venue_name != booking.venue_name and booking.start - latest.end < min_gap:
+                conflicts.append(('short gap', handle, latest, booking, (booking.start - latest.end).total_seconds() / 60))
+            heapq.heappush(running, (booking.end, index))
+    conflicts.sort(key=lambda conflict: (conflict[3].start, conflict[1]))
+    return conflicts
+
+def format_booking(booking):
+    return (f"{booking.venue_name} {remove_unsupported_tags(booking.session.summary)} "
+            f"({booking.start.strftime('%a %d %b %H%M').lower()} to {booking.end.strftime('%H%Mhrs').lower()})")
+
+def format_conflicts(conflicts, time_min, time_max):
+    """
+    Build the HTML reply of /conflicts, with every conflict. Send it with send_html_parts, as it may not fit in one message.
+
+    Args:
+        conflicts (list): The result of find_teacher_conflicts.
+        time_min (datetime.datetime): Start of the checked period.
+        time_max (datetime.datetime): End of the checked period.
+
+    Returns:
+        str: The message.
+    """
+    last_day = time_max - datetime.timedelta(days=1)
+    header = f"<b>Teacher conflicts from {time_min.strftime('%d %b %Y')} to {last_day.strftime('%d %b %Y')}</b>\n\n"
+    if not conflicts:
+        return header + "No teacher is double booked across venues."
+
+    lines = []
+    for kind, handle, earlier, later, gap_minutes in conflicts:
+        if kind == 'overlap':
+            lines.append(f"❗ {handle} overlaps by {-gap_minutes:.0f} min: {format_booking(earlier)} and {format_booking(later)}")
+        else:
+            lines.append(f"⚠️ {handle} has {gap_minutes:.0f} min to change venue: {format_booking(earlier)} then {format_booking(later)}")
+    return header + "\n\n".join(lines)
+
+async def show_teacher_conflicts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Replies with the teachers booked into overlapping sessions at different venues, or with too little time between them.
+
+    Usage: /conflicts [date] for the 7 days after date, or /conflicts <start date> <end date> for a month or term.
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    start_date_str = context.args[0] if len(context.args) > 0 else None
+    end_date_str = context.args[1] if len(context.args) > 1 else None
+    if any(date_str and not is_valid_date(date_str) for date_str in (start_date_str, end_date_str)):
+        await update.message.reply_html("Date format is not valid.")
+        return
+
+    time_min, time_max = get_payment_period(start_date_str, end_date_str)
+    period_days = (time_max - time_min).days
+    if period_days < 1 or period_days > MAX_PAYMENT_PERIOD_DAYS:
+        await update.message.reply_html(f"The end date must be after the start date and the period at most {MAX_PAYMENT_PERIOD_DAYS} days.")
+        return
+
+    client = await get_calendar_client()
+    results = await fetch_all_calendar_events(CALENDAR_CONFIGS, time_min, time_max, client)
+    with METRICS.timer('stage', 'conflicts'):
+        conflicts = find_teacher_conflicts(get_calendar_venue_sessions(results))
+
+    message = format_conflicts(conflicts, time_min, time_max)
+    failed_venues = [config[2] for config, _, error in results if error is not None]
+    if failed_venues:
+        message += f"\n\n<i>Could not check {', '.join(failed_venues)}.</i>"
+    await send_html_parts(update.message.reply_html, message)
+#endregion
+
+#region Teacher Schedules
+class TeacherChatRegistry:
+    """
+    SQLite registry of the private chat each teacher handle uses with the bot, so the weekly digest
+    can be sent to them. A teacher is added when they use /myschedule in a private chat. Rows are
+    tiny, so the methods are called directly from the event loop.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS teacher_chats (
+                    handle TEXT PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+
+    def register(self, handle, chat_id):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO teacher_chats VALUES (?, ?, ?)",
+                (handle.lower(), int(chat_id), datetime.datetime.utcnow().isoformat())
+            )
+
+    def list(self):
+        """
+        Returns:
+            dict: Teacher handle to the chat ID of its private chat with the bot.
+        """
+        return dict(self._conn.execute("SELECT handle, chat_id FROM teacher_chats ORDER BY handle"))
+
+    def remove(self, handle):
+        with self._conn:
+            self._conn.execute("DELETE FROM teacher_chats WHERE handle = ?", (handle.lower(),))
+
+def get_teacher_chats():
+    """
+    Get the process-wide TeacherChatRegistry, opening it on first use. It shares MESSAGE_REGISTRY_PATH.
+
+    Returns:
+        TeacherChatRegistry: The registry.
+    """
+    global TEACHER_CHATS
+    if TEACHER_CHATS is None:
+        TEACHER_CHATS = TeacherChatRegistry(MESSAGE_REGISTRY_PATH)
+    return TEACHER_CHATS
+
+async def fetch_teacher_bookings(handles, time_min, time_max, client):
+    """
+    Get the sessions some teachers are booked into at every venue within a window.
+
+    When the event store covers the window, the calendars are synced together, which keeps the store's
+    handle index current, and the teachers' sessions are then read from that index in one query, so the
+    cost grows with their sessions rather than with every event in the window. Otherwise every venue is
+    fetched and its sessions grouped by handle.
+
+    Args:
+        handles (list): Teacher handles, e.g. '@alice'.
+        time_min (datetime.datetime): Start of the window as a naive UTC datetime, see get_fetch_window.
+        time_max (datetime.datetime): End of the window as a naive UTC datetime.
+        client (AsyncCalendarClient): Google Calendar API client.
+
+    Returns:
+        tuple: (handle to its Bookings ordered by start time, names of the venues that could not be loaded).
+               Handles without sessions are left out.
+    """
+    handles = {handle.lower() for handle in handles}
+    store = get_event_store()
+    calendar_ids = list(CALENDAR_VENUE_NAMES)
+
+    if store is None or not all(store.covers(calendar_id, time_min) for calendar_id in calendar_ids):
+        results = await fetch_all_calendar_events(CALENDAR_CONFIGS, time_min, time_max, client)
+        bookings_by_handle = get_bookings_by_handle(get_calendar_venue_sessions(results))
+        failed_venues = [config[2] for config, _, error in results if error is not None]
+        return {handle: bookings_by_handle[handle] for handle in handles if handle in bookings_by_handle}, failed_venues
+
+    try:
+        sync_results = await asyncio.wait_for(sync_calendars(calendar_ids, client), timeout=CALENDAR_FETCH_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError as e:
+        sync_results = {calendar_id: e for calendar_id in calendar_ids}
+    failed_ids = {calendar_id for calendar_id, result in sync_results.items() if isinstance(result, Exception)}
+    for calendar_id in failed_ids:
+        print(f"Failed to sync calendar {calendar_id}. Error: {sync_results[calendar_id]!r}")
+
+    with METRICS.timer('stage', 'handle_lookup'):
+        events_by_handle = await run_in_google_executor(store.query_handles, handles, calendar_ids, time_min, time_max)
+    bookings_by_handle = {}
+    for handle, events in events_by_handle.items():
+        bookings = []
+        for calendar_id, event in events:
+            if calendar_id not in failed_ids:
+                session = normalize_event(event)
+                bookings.append(Booking(session.start, session.end, CALENDAR_VENUE_NAMES[calendar_id], session))
+        if bookings:
+            bookings_by_handle[handle] = bookings
+    return bookings_by_handle, [CALENDAR_VENUE_NAMES[calendar_id] for calendar_id in calendar_ids if calendar_id in failed_ids]
+
+def format_teacher_schedule(handle, bookings, time_min, time_max):
+    """
+    Build the HTML message with all of one teacher's lessons, grouped by day. Send it with send_html_parts,
+    which splits a long one between days.
+
+    Args:
+        handle (str): The teacher handle, e.g. '@alice'.
+        bookings (list): The teacher's Bookings ordered by start time.
+        time_min (datetime.datetime): Start of the window.
+        time_max (datetime.datetime): End of the window.
+
+    Returns:
+        str: The message.
+    """
+    last_day = time_max - datetime.timedelta(days=1)
+    header = f"<b>Lessons for {handle} from {time_min.strftime('%d %b %Y')} to {last_day.strftime('%d %b %Y')}</b>\n\n"
+    if not bookings:
+        return header + "No lessons in this period."
+
+    message = header
+    day_str, day_count = None, 0
+    for booking in bookings:
+        session = booking.session
+        line = f"{session.summary} ({session.start.strftime('%H%Mhrs').lower()} to {session.end.strftime('%H%Mhrs').lower()})\n <b>Venue: </b>{booking.venue_name}"
+        if session.role == SUBSTITUTE_ROLE:
+            line += f" (substituting for {session.teacher_name})" if handle == session.other_teacher_handle else f" ({session.other_teacher_name} substituting)"
+        elif session.role == SHADOWING_ROLE:
+            line += f" (shadowing {session.teacher_name})" if handle == session.other_teacher_handle else f" ({session.other_teacher_name} shadowing)"
+        day_heading = ""
+        if session.start.strftime('%A %d %B %Y') != day_str:
+            day_str, day_count = session.start.strftime('%A %d %B %Y'), 0
+            day_heading = ("\n" if message != header else "") + f"<b><u>{day_str}</u></b>\n\n"
+        day_count += 1
+        message += f"{day_heading}{day_count}. {line}\n\n"
+    return message
+
+async def show_my_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Replies with one teacher's lessons at every venue for a week.
+
+    Usage: /myschedule [@handle] [date]. Without a handle, the sender's Telegram username is used, and when
+    sent in a private chat, the chat is remembered for the weekly digest.
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    handle, input_date_str = None, None
+    for arg in context.args:
+        if arg.startswith('@'):
+            handle = arg.lower()
+        elif is_valid_date(arg):
+            input_date_str = arg
+        else:
+            await update.message.reply_html("Usage: /myschedule [@handle] [date], with the date in YYYY-MM-DD format.")
+            return
+
+    if handle is None:
+        if not update.effective_user.username:
+            await update.message.reply_html("You have no Telegram username, so give the teacher handle, e.g. /myschedule @alice.")
+            return
+        handle = '@' + update.effective_user.username.lower()
+        if update.effective_chat.type == ChatType.PRIVATE:
+            get_teacher_chats().register(handle, update.effective_chat.id)
+
+    time_min, time_max = get_fetch_window(input_date_str)
+    client = await get_calendar_client()
+    bookings_by_handle, failed_venues = await fetch_teacher_bookings([handle], time_min, time_max, client)
+
+    message = format_teacher_schedule(handle, bookings_by_handle.get(handle, []), time_min, time_max)
+    if failed_venues:
+        message += f"\n\n<i>Could not load {', '.join(failed_venues)}.</i>"
+    await send_html_parts(update.message.reply_html, message)
+
+async def send_teacher_digests(bot, input_date_str, client):
+    """
+    Send every teacher in the TeacherChatRegistry their own lessons for the week after a date, in one pass.
+
+    The calendars are synced once and every teacher's sessions are read with one lookup of the handle
+    index, then the messages are started together and paced by the bot's rate limiter. Teachers without
+    lessons that week are skipped, and a teacher who has blocked the bot is removed from the registry.
+
+    Args:
+        bot (Bot): The bot used to send the messages.
+        input_date_str (str): The starting date of the week, formatted as 'YYYY-MM-DD'. Defaults to today when None.
+        client (AsyncCalendarClient): Google Calendar API client.
+
+    Returns:
+        dict: The number of teachers 'sent', 'skipped' and 'failed'.
+    """
+    registry = get_teacher_chats()
+    teacher_chats = registry.list()
+    counts = {'sent': 0, 'skipped': 0, 'failed': 0}
+    if not teacher_chats:
+        return counts
+
+    time_min, time_max = get_fetch_window(input_date_str)
+    bookings_by_handle, failed_venues = await fetch_teacher_bookings(list(teacher_chats), time_min, time_max, client)
+    note = f"\n\n<i>Could not load {', '.join(failed_venues)}.</i>" if failed_venues else ""
+
+    async def send_one(handle, chat_id):
+        if handle not in bookings_by_handle:
+            counts['skipped'] += 1
+            return
+        try:
+            await send_html_parts(
+                functools.partial(bot.send_message, chat_id, parse_mode='HTML'),
+                format_teacher_schedule(handle, bookings_by_handle[handle], time_min, time_max) + note
+            )
+            counts['sent'] += 1
+        except Forbidden:
+            print(f"{handle} has blocked the bot, removing it from the digest.")
+            registry.remove(handle)
+            counts['failed'] += 1
+        except Exception as e:
+            print(f"Failed to send the digest to {handle}. Error: {str(e)}")
+            counts['failed'] += 1
+
+    await asyncio.gather(*(send_one(handle, chat_id) for handle, chat_id in teacher_chats.items()))
+    return counts
+
+async def send_weekly_digest(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job that sends every registered teacher their lessons for the coming week, see TEACHER_DIGEST_DAY.
+
+    Args:
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the job queue.
+
+    Returns:
+        None
+    """
+    client = await get_calendar_client()
+    counts = await send_teacher_digests(context.bot, None, client)
+    print(f"Weekly digest: {counts['sent']} sent, {counts['skipped']} without lessons, {counts['failed']} failed")
+
+async def send_digest_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Sends the teacher digest now, for the week after a date. Only users in ADMIN_USER_IDS may use it, when it is set.
+
+    Usage: /digest [date]
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    if ADMIN_USER_IDS and update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("This command is only for admins.")
+        return
+
+    input_date_str = context.args[0] if context.args else None
+    if input_date_str and not is_valid_date(input_date_str):
+        await update.message.reply_html("Date format is not valid.")
+        return
+
+    client = await get_calendar_client()
+    counts = await send_teacher_digests(context.bot, input_date_str, client)
+    await update.message.reply_text(
+        f"Digest: {counts['sent']} sent, {counts['skipped']} without lessons, {counts['failed']} failed."
+    )
+#endregion
+
+#region Telegram Bot Functions
+async def send_message(update, context, chat_id, is_reply=False):
+    """
+    Pulls events from Google Calendar and sends the formatted message in the chat with event details
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+        chat_id (int): The chat ID where the message will be sent.
+        is_reply (bool, optional): Whether the message is a reply to a user. Defaults to False.
+
+    Returns:
+        None
+    """
+    calendar_key = context.args[0] if context.args else DEFAULT_CALENDAR_KEY
+    if calendar_key != ALL_KEY and get_calendar_config(calendar_key) is None:
+        calendar_key = DEFAULT_CALENDAR_KEY  # Default to the first venue
+
+    input_date_str = context.args[1] if len(context.args) > 1 else None
+    if input_date_str and not is_valid_date(input_date_str):
+        input_date_str = None
+        await update.message.reply_html("Date format is not valid, sending schedule for next 7 days starting from today instead.")
+    # Pin the window to a date, so refreshing the posted schedule later keeps showing the same week
+    input_date_str = input_date_str or datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    client = await get_calendar_client()
+    final_message = await build_schedule_message(calendar_key, input_date_str, client)
+    # A long schedule goes out as several messages, split between days
+    parts = split_schedule_message(final_message)
+
+    global LAST_SENT_MESSAGE_ID
+    if is_reply:
+        sent_messages = [await update.message.reply_html(part) for part in parts]
+        LAST_SENT_MESSAGE_ID = sent_messages[0].message_id
+        return
+
+    sent_parts = await broadcast_message_parts(context.bot, chat_id, parts)
+    for sent_messages in sent_parts:
+        LAST_SENT_MESSAGE_ID = sent_messages[0].message_id
+        get_message_registry().register(
+            sent_messages[0].chat_id, [sent_message.message_id for sent_message in sent_messages], calendar_key, input_date_str, parts
+        )
+    await report_sent_messages(update, context, [sent_messages[0] for sent_messages in sent_parts])
+
+
+
+async def edit_message_in_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Pulls events from Google Calendar and update the specified message in the chat with updated event details
+
+    The message is looked up in the schedules registered by /send, since message ids are only unique
+    within a chat. A message the bot has no record of is edited in the first group chat.
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    message_id = context.args[0] if context.args else None
+    if message_id is None:
+        await update.message.reply_text("Message Id is empty.")
+        return
+    if not message_id.isdigit():
+        await update.message.reply_text("Message Id is not valid.")
+        return
+
+    message_id = int(message_id)
+    registry = get_message_registry()
+    # The message is edited in every chat it was registered in, or in the first group chat when it was never registered
+    chat_ids = registry.find_chats(message_id)
+    if not chat_ids and not GROUPCHAT_IDS:
+        await update.message.reply_text("No group chat is configured, set GROUPCHAT_ID to edit messages.")
+        return
+
+    client = await get_calendar_client()
+
+    for chat_id in chat_ids or GROUPCHAT_IDS[:1]:
+        try:
+            if isinstance(chat_id, str):
+                # The registry and edits use the numeric id of a chat given by its username
+                chat_id = (await context.bot.get_chat(chat_id)).id
+            # A registered schedule is refreshed with the venue and week it was sent with, unless given
+            tracked = registry.get(chat_id, message_id)
+            calendar_key = context.args[1] if len(context.args) > 1 else tracked['calendar_key'] if tracked else DEFAULT_CALENDAR_KEY
+            if len(context.args) > 2:
+                input_date_str = context.args[2] if is_valid_date(context.args[2]) else None
+            else:
+                input_date_str = tracked['input_date_str'] if tracked else None
+            # Pin the window to a date, as send_message does, so the registered schedule keeps showing the same week
+            input_date_str = input_date_str or datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+            if calendar_key != ALL_KEY and get_calendar_config(calendar_key) is None:
+                await update.message.reply_text("Invalid calendar key provided.")
+                continue
+
+            new_text = await refresh_schedule_message(context.bot, chat_id, message_id, calendar_key, input_date_str, client)
+            if new_text is None:
+                await update.message.reply_text("Schedule has not changed, the message was not edited.")
+                print(f"Message for message id {message_id} is already up to date")
+                continue
+
+            for part in split_schedule_message("Message has been edited successfully\n" + new_text):
+                await update.message.reply_html(part)
+            print(f"Message for message id {message_id} edited successfully")
+        except Exception as e:
+            await update.message.reply_html(f"Failed to edit message for message id {message_id}. Error: {str(e)}")
+            print(f"Failed to edit message for message id {message_id}. Error: {str(e)}")
+
+
+
+async def send_reminder_message(update, context, chat_id, is_reply=False):
+    sent_messages = await broadcast_message(context.bot, chat_id, REMINDER_MSG)
+    await report_sent_messages(update, context, sent_messages)
+
+async def broadcast_message(bot, chat_ids, text):
+    """
+    Sends a message to several chats at once, see broadcast_message_parts.
+
+    Args:
+        bot (Bot): The bot used to send the message.
+        chat_ids (int | list): A chat ID or a list of chat IDs.
+        text (str): The HTML message to send.
+
+    Returns:
+        list: The sent messages, for the chats that did not fail.
+    """
+    return [sent_messages[0] for sent_messages in await broadcast_message_parts(bot, chat_ids, [text])]
+
+async def broadcast_message_parts(bot, chat_ids, parts):
+    """
+    Sends a message made of one or more parts to several chats at once.
+
+    The chats are sent to together and the bot's rate limiter paces them, so they go out as fast
+    as Telegram allows. The parts go to each chat one after another, so they arrive in order.
+    A chat that fails does not stop the others.
+
+    Args:
+        bot (Bot): The bot used to send the message.
+        chat_ids (int | list): A chat ID or a list of chat IDs.
+        parts (list): The HTML parts to send, e.g. from split_schedule_message.
+
+    Returns:
+        list: For each chat that did not fail, its sent messages in part order.
+    """
+    chat_ids = chat_ids if isinstance(chat_ids, list) else [chat_ids]
+
+    async def send_parts(chat_id):
+        return [await bot.send_message(chat_id=chat_id, text=part, parse_mode='HTML') for part in parts]
+
+    results = await asyncio.gather(*(send_parts(chat_id) for chat_id in chat_ids), return_exceptions=True)
+
+    sent_parts = []
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            print(f"Failed to send message to chat id {chat_id}. Error: {str(result)}")
+        else:
+            print(f"Message with message id {', '.join(str(sent_message.message_id) for sent_message in result)} sent to group chat id {chat_id}")
+            sent_parts.append(result)
+    return sent_parts
+
+async def report_sent_messages(update, context, sent_messages):
+    user_chat_id = update.effective_user.id
+    if not sent_messages:
+        await context.bot.send_message(chat_id=user_chat_id, text="The message could not be sent to any group chat.")
+        return
+    report = '\n'.join(f"Message ID: {sent_message.message_id}, Group Chat ID: {sent_message.chat_id}" for sent_message in sent_messages)
+    await context.bot.send_message(chat_id=user_chat_id, text=report)
+
+
+async def warm_up(application) -> None:
+    """
+    Post-init hook that imports the heavy modules and creates the Calendar client in the background,
+    once the bot is already polling. Turned off with WARM_UP_ON_START=false.
+
+    Args:
+        application (Application): The running application.
+
+    Returns:
+        None
+    """
+    if not WARM_UP_ON_START:
+        return
+
+    async def warm_up_in_background():
+        await asyncio.to_thread(warm_up_imports)
+        # Without a token the OAuth flow needs a person, so leave it to the first command
+        if os.path.exists('token.json'):
+            await get_calendar_client()
+        print("Warm up finished")
+
+    run_in_background(warm_up_in_background())
+
+async def on_startup(application) -> None:
+    """
+    Post-init hook that warms up the bot, starts the metrics endpoint and the background calendar sync.
+
+    Args:
+        application (Application): The running application.
+
+    Returns:
+        None
+    """
+    await warm_up(application)
+    await start_metrics_server()
+    await start_calendar_sync_workers()
+
+async def on_shutdown(application) -> None:
+    """
+    Post-shutdown hook that stops the background calendar sync.
+
+    Args:
+        application (Application): The application being stopped.
+
+    Returns:
+        None
+    """
+    global CALENDAR_SYNC_WORKER_POOL
+    if CALENDAR_SYNC_WORKER_POOL is not None:
+        await CALENDAR_SYNC_WORKER_POOL.stop()
+        CALENDAR_SYNC_WORKER_POOL = None
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Replies with the p50 and p95 time of every command and stage, the call counters and the schedule cache stats.
+    Only users in ADMIN_USER_IDS may use it, when it is set.
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    if ADMIN_USER_IDS and update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("This command is only for admins.")
+        return
+
+    lines = [f"Uptime {datetime.timedelta(seconds=int(time.time() - METRICS.started_at))}", ""]
+    for kind, name, count, total, p50, p95 in METRICS.summary():
+        lines.append(f"{kind:<7} {name:<24} n={count:<6} p50 {p50 * 1000:8.1f}ms  p95 {p95 * 1000:8.1f}ms")
+    lines.append("")
+    lines += [f"{name:<32} {value}" for name, value in METRICS.counters().items()]
+    stats = SCHEDULE_CACHE.stats()
+    lines.append(f"schedule cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses, "
+                 f"{stats['evictions']} evictions, {stats['invalidations']} invalidations")
+    stats = DAY_FRAGMENT_CACHE.stats()
+    lines.append(f"day fragment cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+    await update.message.reply_html("<pre>" + html.escape('\n'.join(lines)) + "</pre>")
+
+async def show_cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = SCHEDULE_CACHE.stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = f"{stats['hits'] / lookups:.0%}" if lookups else "n/a"
+    fragment_stats = DAY_FRAGMENT_CACHE.stats()
+    await update.message.reply_text(
+        f"Schedule cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses ({hit_rate} hit rate), "
+        f"{stats['evictions']} evictions, {stats['invalidations']} invalidations. "
+        f"Day fragments: {fragment_stats['entries']} entries, {fragment_stats['hits']} hits, {fragment_stats['misses']} misses"
+    )
+
+async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    help_message = '''
+    *__Bot Commands Help__*\n\n
+        /schedule `<calendar> <date>` \- Sends a schedule to you\. If no date is provided, it sends the upcoming schedule for a week from today\. If a date in YYYY\-MM\-DD format is provided, it sends the schedule for a week from that date\.\n\n
+        /send `<calendar> <date>` \- Sends the schedule to the teacher's chat group\. Without a date, it sends the upcoming schedule for a week from today\. With a date in YYYY\-MM\-DD format, it sends the schedule for a week from that date\. The bot replies with the message\_id for future edits\.\n\n
+        /edit `<message_id> <calendar> <date>` \- Edits a previously sent message in the teacher's chat group\. You need to provide the message\_id\. Optionally, you can provide a date in YYYY\-MM\-DD format to specify the schedule week\.\n\n
+        /editall `<date>` \- Re\-renders and edits every schedule sent for the week of that date, or every schedule whose week has not ended\. Messages are only edited when their schedule changed\.\n\n
+        /paymentforall `<date>` or `<start date> <end date>` `[csv|parquet]` \- Generates an Excel sheet with payment details for all venues, for a week from the date or from the start date to the end date\. Add csv or parquet for a smaller file\. A progress message shows the current stage, and the lessons found at each venue once all venues are fetched together\.\n\n
+        /payrolltotals `<@handle>` \- Shows every teacher's pay for the month, quarter and year to date, or only that teacher's\.\n\n
+        /cancelpayment \- Cancels the payment sheets being prepared for this chat\.\n\n
+        /conflicts `<date>` or `<start date> <end date>` \- Lists teachers booked into overlapping lessons at different venues, or with too little time to travel between them\.\n\n
+        /myschedule `<@handle> <date>` \- Sends one teacher's lessons at every venue for a week\. Without a handle, your own Telegram username is used, and using it in a private chat with the bot signs you up for the weekly digest\.\n\n
+        /digest `<date>` \- Sends every signed up teacher their own lessons for the week now\.\n\n
+        /cachestats \- Shows hit and miss counts of the schedule cache\.\n\n
+        /stats \- Shows the p50 and p95 time of every command and stage, and the Google and Telegram call counts\.\n\n
+        *Note*\: Replace `<calendar>` with {calendar_keys} or 'ALL' for every venue, `<date>` with your desired date in YYYY\-MM\-DD format and `<message_id>` with the actual message ID\.
+    '''.format(calendar_keys=', '.join(f"'{escape_markdown(config[0], version=2)}'" for config in CALENDAR_CONFIGS))
+
+    await update.message.reply_text(help_message, parse_mode='MarkdownV2')
+
+async def reply_with_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_message(update, context, None, is_reply=True)
+
+async def send_schedule_to_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_message(update, context, GROUPCHAT_IDS)
+
+async def send_reminder_message_to_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_reminder_message(update, context, GROUPCHAT_IDS)
+#endregion
+
+#region Schedule Auto Refresh
+DAY_HEADING_PATTERN = re.compile(r'^<b><u>(.+)</u></b>$')
+
+class ScheduleMessageRegistry:
+    """
+    SQLite registry of the schedule messages posted to group chats, so they can be refreshed and
+    bulk edited, also after a restart.
+
+    Each row holds one part of a posted schedule: the chat and message id, the message id of the
+    schedule's first part, the calendar key and window date the schedule was built from, and the
+    content hash and per-day hashes of that part. A schedule that fits in one message has one row.
+    Rows are tiny, so the methods are called directly from the event loop.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS schedule_messages (
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    calendar_key TEXT NOT NULL,
+                    input_date_str TEXT NOT NULL,
+                    window_end TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    day_hashes TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    first_message_id INTEGER,
+                    part INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (chat_id, message_id)
+                )
+            """)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(schedule_messages)")}
+            if 'first_message_id' not in columns:
+                # Registries from before schedules were split; their rows are single part schedules
+                self._conn.execute("ALTER TABLE schedule_messages ADD COLUMN first_message_id INTEGER")
+                self._conn.execute("ALTER TABLE schedule_messages ADD COLUMN part INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS schedule_messages_by_week ON schedule_messages (input_date_str)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS schedule_messages_by_end ON schedule_messages (window_end)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS schedule_messages_by_first ON schedule_messages (chat_id, first_message_id)")
+
+    def register(self, chat_id, message_ids, calendar_key, input_date_str, parts):
+        """
+        Add or replace a posted schedule.
+
+        Args:
+            chat_id (int): The chat the schedule was posted to.
+            message_ids (list): The messages holding the schedule, one per part.
+            calendar_key (str): A key in CALENDAR_CONFIGS or ALL_KEY.
+            input_date_str (str): The date the schedule window was built from, formatted as 'YYYY-MM-DD'.
+            parts (list): The parts as posted, without the update timestamp.
+        """
+        _, time_max = get_fetch_window(input_date_str)
+        updated_at = datetime.datetime.utcnow().isoformat()
+        with self._conn:
+            self._delete(chat_id, message_ids[0])
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO schedule_messages
+                (chat_id, message_id, calendar_key, input_date_str, window_end, content_hash, day_hashes, updated_at, first_message_id, part)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        int(chat_id), int(message_id), calendar_key, input_date_str, time_max.date().isoformat(),
+                        hash_text(part), json.dumps(hash_schedule_days(part)), updated_at, int(message_ids[0]), index
+                    )
+                    for index, (message_id, part) in enumerate(zip(message_ids, parts))
+                ]
+            )
+
+    def find_chats(self, message_id):
+        """
+        Find the chats that have a registered schedule with a message, as message ids are only unique within a chat.
+
+        Args:
+            message_id (int): Any of the schedule's messages.
+
+        Returns:
+            list: Chat ids, in ascending order.
+        """
+        rows = self._conn.execute(
+            "SELECT DISTINCT chat_id FROM schedule_messages WHERE message_id = ? ORDER BY chat_id", (int(message_id),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get(self, chat_id, message_id):
+        """
+        Get the registered schedule that a message is part of.
+
+        Args:
+            chat_id (int): The chat the schedule was posted to.
+            message_id (int): Any of the schedule's messages.
+
+        Returns:
+            dict | None: The schedule, see _to_schedule, or None if the message is not registered.
+        """
+        row = self._conn.execute(
+            "SELECT COALESCE(first_message_id, message_id) FROM schedule_messages WHERE chat_id = ? AND message_id = ?",
+            (int(chat_id), int(message_id))
+        ).fetchone()
+        if row is None:
+            return None
+        rows = self._conn.execute(
+            "SELECT * FROM schedule_messages WHERE chat_id = ? AND (first_message_id = ? OR message_id = ?) ORDER BY part",
+            (int(chat_id), row[0], row[0])
+        ).fetchall()
+        return self._to_schedule(rows)
+
+    def list(self, input_date_str=None, active_on=None):
+        """
+        List registered schedules.
+
+        Args:
+            input_date_str (str, optional): Only schedules built from this date.
+            active_on (datetime.date, optional): Only schedules whose window has not ended by this date.
+
+        Returns:
+            list: Registered schedules as dicts, see _to_schedule.
+        """
+        query = "SELECT * FROM schedule_messages WHERE 1 = 1"
+        params = []
+        if input_date_str is not None:
+            query += " AND input_date_str = ?"
+            params.append(input_date_str)
+        if active_on is not None:
+            query += " AND window_end >= ?"
+            params.append(active_on.isoformat())
+        rows = self._conn.execute(query + " ORDER BY chat_id, COALESCE(first_message_id, message_id), part", params)
+        return [
+            self._to_schedule(list(schedule_rows))
+            for _, schedule_rows in itertools.groupby(rows, key=lambda row: (row['chat_id'], row['first_message_id'] or row['message_id']))
+        ]
+
+    def remove(self, chat_id, message_id):
+        """
+        Remove the registered schedule that a message is part of.
+        """
+        schedule = self.get(chat_id, message_id)
+        if schedule is not None:
+            with self._conn:
+                self._delete(chat_id, schedule['message_id'])
+
+    def _delete(self, chat_id, first_message_id):
+        self._conn.execute(
+            "DELETE FROM schedule_messages WHERE chat_id = ? AND (first_message_id = ? OR message_id = ?)",
+            (int(chat_id), int(first_message_id), int(first_message_id))
+        )
+
+    @staticmethod
+    def _to_schedule(rows):
+        """
+        Returns:
+            dict: chat_id, message_id of the first part, calendar_key, input_date_str, window_end and updated_at,
+                  parts as a list of {'message_id', 'content_hash'} in order, and day_hashes of every part.
+        """
+        schedule = {key: rows[0][key] for key in ('chat_id', 'calendar_key', 'input_date_str', 'window_end', 'updated_at')}
+        schedule['message_id'] = rows[0]['first_message_id'] or rows[0]['message_id']
+        schedule['parts'] = [{'message_id': row['message_id'], 'content_hash': row['content_hash']} for row in rows]
+        schedule['day_hashes'] = {}
+        for row in rows:
+            schedule['day_hashes'].update(json.loads(row['day_hashes']))
+        return schedule
+
+def get_message_registry():
+    """
+    Get the process-wide ScheduleMessageRegistry, opening it on first use.
+
+    Returns:
+        ScheduleMessageRegistry: The registry.
+    """
+    global MESSAGE_REGISTRY
+    if MESSAGE_REGISTRY is None:
+        MESSAGE_REGISTRY = ScheduleMessageRegistry(MESSAGE_REGISTRY_PATH)
+    return MESSAGE_REGISTRY
+
+def hash_text(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def hash_schedule_days(message):
+    """
+    Hash each day of a rendered schedule, so an edit can tell which days changed.
+
+    Args:
+        message (str): A schedule from build_schedule_message.
+
+    Returns:
+        dict: '<branch header>|<day heading>' to the hash of that day's lessons.
+    """
+    day_hashes = {}
+    branch_header, day, lines = '', None, []
+    for line in message.split('\n'):
+        match = DAY_HEADING_PATTERN.match(line)
+        if match or line.startswith('================'):
+            if day is not None:
+                day_hashes[f"{branch_header}|{day}"] = hash_text('\n'.join(lines))
+            lines = []
+            if match:
+                day = match.group(1)
+            else:
+                branch_header, day = line, None
+        else:
+            lines.append(line)
+    if day is not None:
+        day_hashes[f"{branch_header}|{day}"] = hash_text('\n'.join(lines))
+    return day_hashes
+
+def get_changed_days(old_day_hashes, new_day_hashes):
+    """
+    Get the days whose lessons were added, removed or changed at any venue.
+
+    Args:
+        old_day_hashes (dict): Day hashes of the posted schedule.
+        new_day_hashes (dict): Day hashes of the re-rendered schedule.
+
+    Returns:
+        list: Day headings, e.g. 'Friday 02 May 2025', in date order.
+    """
+    changed_keys = {key for key in old_day_hashes.keys() | new_day_hashes.keys() if old_day_hashes.get(key) != new_day_hashes.get(key)}
+    days = {key.split('|', 1)[1] for key in changed_keys}
+    return sorted(days, key=lambda day: datetime.datetime.strptime(day, '%A %d %B %Y'))
+
+async def edit_schedule_message(bot, chat_id, message_id, calendar_key, input_date_str, schedule):
+    """
+    Edit a posted schedule to a newly rendered one, only when its content changed.
+
+    The schedule is split into parts as when it was sent, and only the parts whose content changed are
+    edited. Extra parts are sent as new messages, and parts that are no longer needed are emptied.
+    When anything is edited, a reply naming the changed days is posted under the first part.
+
+    Args:
+        bot (Bot): The bot used to edit the message.
+        chat_id (int): The chat the schedule was posted to.
+        message_id (int): Any of the messages holding the schedule.
+        calendar_key (str): A key in CALENDAR_CONFIGS or ALL_KEY.
+        input_date_str (str): The date the schedule window is built from, formatted as 'YYYY-MM-DD'.
+        schedule (str): The newly rendered schedule from build_schedule_message.
+
+    Returns:
+        str | None: The new message text, or None when the schedule has not changed.
+    """
+    registry = get_message_registry()
+    registered = registry.get(chat_id, message_id)
+    parts = split_schedule_message(schedule)
+    old_parts = registered['parts'] if registered else [{'message_id': message_id, 'content_hash': None}]
+    if registered and [hash_text(part) for part in parts] == [old_part['content_hash'] for old_part in old_parts]:
+        return None
+
+    # Get current date and time for the edit timestamp
+    edit_timestamp = datetime.datetime.now(ZoneInfo("Asia/Singapore")).strftime('%Y-%m-%d %H:%M:%S')
+    timestamp_line = f"<i>Message updated on {edit_timestamp}</i>\n\n"
+
+    message_ids = []
+    for index, part in enumerate(parts):
+        if index >= len(old_parts):
+            sent_message = await bot.send_message(chat_id=chat_id, text=timestamp_line + part, parse_mode='HTML')
+            message_ids.append(sent_message.message_id)
+            continue
+        message_ids.append(old_parts[index]['message_id'])
+        if old_parts[index]['content_hash'] == hash_text(part):
+            continue
+        try:
+            # Editing the original message
+            await bot.edit_message_text(chat_id=chat_id, message_id=old_parts[index]['message_id'], text=timestamp_line + part, parse_mode='HTML')
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+    for old_part in old_parts[len(parts):]:
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id, message_id=old_part['message_id'], text=timestamp_line + "The schedule now fits in fewer messages.", parse_mode='HTML'
+            )
+        except BadRequest as e:
+            print(f"Failed to empty message id {old_part['message_id']}. Error: {str(e)}")
+
+    # Sending a reply to the edited message indicating that it was updated
+    changed_days = get_changed_days(registered['day_hashes'], hash_schedule_days(schedule)) if registered else []
+    if changed_days:
+        notification_message = f"🔄 Schedule updated at {edit_timestamp} for {', '.join(changed_days)}.\n Please review the changes."
+    else:
+        notification_message = f"🔄 Schedule updated at {edit_timestamp}.\n Please review the changes."
+    await bot.send_message(chat_id=chat_id, text=notification_message, reply_to_message_id=message_ids[0], parse_mode='HTML')
+
+    registry.register(chat_id, message_ids, calendar_key, input_date_str, parts)
+    return timestamp_line + schedule
+
+async def refresh_schedule_message(bot, chat_id, message_id, calendar_key, input_date_str, client, use_cache=False):
+    """
+    Re-render a posted schedule and edit the message only when its content changed.
+
+    Args:
+        bot (Bot): The bot used to edit the message.
+        chat_id (int): The chat the schedule was posted to.
+        message_id (int): The message holding the schedule.
+        calendar_key (str): A key in CALENDAR_CONFIGS or ALL_KEY.
+        input_date_str (str): The date the schedule window is built from, formatted as 'YYYY-MM-DD'.
+        client (AsyncCalendarClient): Google Calendar API client.
+        use_cache (bool, optional): Whether a cached schedule may be used. Defaults to False.
+
+    Returns:
+        str | None: The new message text, or None when the schedule has not changed.
+    """
+    schedule = await build_schedule_message(calendar_key, input_date_str, client, use_cache=use_cache)
+    return await edit_schedule_message(bot, chat_id, message_id, calendar_key, input_date_str, schedule)
+
+async def refresh_registered_schedules(bot, schedules, client):
+    """
+    Re-render and edit many registered schedules at once.
+
+    Each calendar involved gets a single incremental sync, or without the event store, the calendars of
+    each week are fetched together once. Each venue and week is rendered once and the messages are
+    put together from those, so a calendar shared by several messages is not fetched again for each of them.
+    The edits then run concurrently, at most EDIT_ALL_MAX_CONCURRENT at a time.
+
+    Args:
+        bot (Bot): The bot used to edit the messages.
+        schedules (list): Registered schedules from ScheduleMessageRegistry.list.
+        client (AsyncCalendarClient): Google Calendar API client.
+
+    Returns:
+        dict: Counts of 'edited', 'unchanged' and 'failed' messages.
+    """
+    store = get_event_store()
+    if store is not None:
+        keys = {schedule['calendar_key'] for schedule in schedules}
+        calendar_ids = {config[1] for config in CALENDAR_CONFIGS if ALL_KEY in keys or config[0] in keys}
+        for calendar_id, result in (await sync_calendars(calendar_ids, client)).items():
+            if isinstance(result, Exception):
+                print(f"Failed to sync calendar {calendar_id}. Error: {result!r}")
+
+    keys_by_date = collections.defaultdict(set)
+    for schedule in schedules:
+        keys_by_date[schedule['input_date_str']].add(schedule['calendar_key'])
+    rendered = {}
+    for input_date_str, calendar_keys in keys_by_date.items():
+        time_min, time_max = get_fetch_window(input_date_str)
+        calendar_configs = list(dict.fromkeys(config for calendar_key in calendar_keys for config in get_calendar_configs(calendar_key)))
+        venue_messages = await render_venue_schedules(calendar_configs, time_min, time_max, client, use_cache=store is not None)
+        for calendar_key in calendar_keys:
+            rendered[(calendar_key, input_date_str)] = "".join(config[3] + venue_messages[config[0]] for config in get_calendar_configs(calendar_key))
+
+    counts = {'edited': 0, 'unchanged': 0, 'failed': 0}
+    semaphore = asyncio.Semaphore(EDIT_ALL_MAX_CONCURRENT)
+
+    async def edit_one(schedule):
+        chat_id, message_id = schedule['chat_id'], schedule['message_id']
+        async with semaphore:
+            try:
+                new_text = await edit_schedule_message(
+                    bot, chat_id, message_id, schedule['calendar_key'], schedule['input_date_str'],
+                    rendered[(schedule['calendar_key'], schedule['input_date_str'])]
+                )
+                counts['edited' if new_text is not None else 'unchanged'] += 1
+            except BadRequest as e:
+                # The message was deleted or can no longer be edited
+                print(f"Stopped refreshing message id {message_id}. Error: {str(e)}")
+                get_message_registry().remove(chat_id, message_id)
+                counts['failed'] += 1
+            except Exception as e:
+                print(f"Failed to refresh message id {message_id}. Error: {str(e)}")
+                counts['failed'] += 1
+
+    await asyncio.gather(*(edit_one(schedule) for schedule in schedules))
+    return counts
+
+async def refresh_tracked_schedules(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job that refreshes every registered schedule whose week has not ended yet.
+
+    Args:
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the job queue.
+
+    Returns:
+        None
+    """
+    schedules = get_message_registry().list(active_on=datetime.datetime.utcnow().date())
+    if not schedules:
+        return
+
+    client = await get_calendar_client()
+    counts = await refresh_registered_schedules(context.bot, schedules, client)
+    if counts['edited'] or counts['failed']:
+        print(f"Automatic refresh: {counts['edited']} edited, {counts['unchanged']} unchanged, {counts['failed']} failed")
+
+async def edit_all_messages_in_groupchat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Re-render and edit every registered schedule of a week, or every schedule whose week has not ended.
+
+    Usage: /editall [date], where date is the date the schedules were sent for.
+
+    Args:
+        update (Update): The Telegram Update object.
+        context (ContextTypes.DEFAULT_TYPE): The context object passed by the Telegram handler.
+
+    Returns:
+        None
+    """
+    input_date_str = context.args[0] if context.args else None
+    if input_date_str and not is_valid_date(input_date_str):
+        await update.message.reply_html("Date format is not valid.")
+        return
+
+    registry = get_message_registry()
+    if input_date_str:
+        schedules = registry.list(input_date_str=input_date_str)
+    else:
+        schedules = registry.list(active_on=datetime.datetime.utcnow().date())
+    if not schedules:
+        await update.message.reply_text("No sent schedules found for that week.")
+        return
+
+    client = await get_calendar_client()
+    counts = await refresh_registered_schedules(context.bot, schedules, client)
+    await update.message.reply_text(
+        f"{len(schedules)} schedules checked: {counts['edited']} edited, {counts['unchanged']} unchanged, {counts['failed']} failed."
+    )
+#endregion
+
+def build_application():
+    """
+    Builds the bot application, with a pooled HTTP client shared by every handler and an outgoing
+    rate limiter that retries flood waits.
+
+    Returns:
+        Application: The application, without handlers.
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE))
+        .get_updates_request(HTTPXRequest())
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    if TELEGRAM_RATE_LIMITED:
+        try:
+            builder = builder.rate_limiter(AIORateLimiter(max_retries=TELEGRAM_MAX_RETRIES))
+        except RuntimeError:
+            print("Install python-telegram-bot[rate-limiter] to throttle outgoing messages to Telegram's limits")
+    return builder.build()
+
+def register_handlers(app):
+    """
+    Adds the command handlers, the automatic refresh job and the weekly teacher digest job to the application.
+
+    Args:
+        app (Application): The application from build_application.
+    """
+    app.add_handler(CommandHandler("schedule", timed_command("schedule", reply_with_schedule)))
+    app.add_handler(CommandHandler("send", timed_command("send", send_schedule_to_groupchat)))
+    app.add_handler(CommandHandler("sendrm", timed_command("sendrm", send_reminder_message_to_groupchat)))
+    app.add_handler(CommandHandler("edit", timed_command("edit", edit_message_in_groupchat)))
+    app.add_handler(CommandHandler("editall", timed_command("editall", edit_all_messages_in_groupchat)))
+    app.add_handler(CommandHandler("helpme", timed_command("helpme", show_help)))
+    app.add_handler(CommandHandler("cachestats", timed_command("cachestats", show_cache_stats)))
+    app.add_handler(CommandHandler("stats", show_stats))
+    app.add_handler(CommandHandler("paymentforall", timed_command("paymentforall", generate_payment_sheet_for_all_calendars)))
+    app.add_handler(CommandHandler("conflicts", timed_command("conflicts", show_teacher_conflicts)))
+    app.add_handler(CommandHandler("cancelpayment", timed_command("cancelpayment", cancel_payment_sheets)))
+    app.add_handler(CommandHandler("payrolltotals", timed_command("payrolltotals", show_payroll_totals)))
+    app.add_handler(CommandHandler("myschedule", timed_command("myschedule", show_my_schedule)))
+    app.add_handler(CommandHandler("digest", timed_command("digest", send_digest_now)))
+    if AUTO_REFRESH_INTERVAL_SECONDS > 0:
+        if app.job_queue is None:
+            print("Install python-telegram-bot[job-queue] to refresh posted schedules automatically")
+        else:
+            app.job_queue.run_repeating(refresh_tracked_schedules, interval=AUTO_REFRESH_INTERVAL_SECONDS, first=AUTO_REFRESH_INTERVAL_SECONDS)
+    if TEACHER_DIGEST_DAY:
+        if app.job_queue is None:
+            print("Install python-telegram-bot[job-queue] to send the weekly teacher digest")
+        else:
+            hour, minute = (int(part) for part in TEACHER_DIGEST_TIME.split(':'))
+            app.job_queue.run_daily(send_weekly_digest, datetime.time(hour, minute), days=(WEEKDAY_NAMES.index(TEACHER_DIGEST_DAY),))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Google Calendar Telegram bot")
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=BOT_MODE, help="How updates are received")
+    parser.add_argument('--listen', default=WEBHOOK_LISTEN, help="Address the webhook server listens on")
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT, help="Port the webhook server listens on")
+    parser.add_argument('--url-path', default=WEBHOOK_PATH, help="Path the webhook server accepts updates on")
+    parser.add_argument('--webhook-url', default=WEBHOOK_URL, help="Public URL registered with Telegram")
+    return parser.parse_args()
+
+def run_webhook(app, args):
+    """
+    Serves updates with the built-in webhook server, so each update is handled as soon as Telegram
+    posts it instead of waiting for the next poll.
+
+    Telegram only posts to public https URLs, so a webhook URL is required. Only against another Bot API
+    server (TELEGRAM_BASE_URL), e.g. a local fake one, is it built from the listen address, port and path
+    when missing. Requests without the secret token are rejected.
+
+    Args:
+        app (Application): The bot application.
+        args (argparse.Namespace): The parsed command line arguments.
+    """
+    if not args.webhook_url and not TELEGRAM_BASE_URL:
+        raise SystemExit("Webhook mode needs the public https URL Telegram posts updates to, set --webhook-url or WEBHOOK_URL")
+    secret_token = WEBHOOK_SECRET_TOKEN
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        print("WEBHOOK_SECRET_TOKEN is not set, using a random secret token for this run")
+    webhook_url = args.webhook_url or f"http://{args.listen}:{args.port}/{args.url_path}"
+    print(f"listening for updates on {args.listen}:{args.port}/{args.url_path}")
+    app.run_webhook(
+        listen=args.listen,
+        port=args.port,
+        url_path=args.url_path,
+        webhook_url=webhook_url,
+        secret_token=secret_token,
+    )
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    print('starting bot')
+    app = build_application()
+    register_handlers(app)
+    if args.mode == 'webhook':
+        run_webhook(app, args)
+    else:
+        print("polling")
+        app.run_polling(poll_interval=3)
 
@@ -0,0 +1,84 @@
+"""
+Fixtures that load the bot against the fake Calendar API in benchmarks/fake_calendar.py.
+
+The bot reads its settings from the environment when it is loaded, so every test gets a fresh copy
+of the module, with its own event store and registries in a temporary directory.
+"""
+import os
+import sys
+import time
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import load_bot  # noqa: E402
+from fake_calendar import FakeCalendarServer  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+from bench_calendar_service import write_fake_token  # noqa: E402
+
+CALENDAR_IDS = ['sok-c', 'sok-r', 'll']
+USER_ID = 4242
+
+
+@pytest.fixture
+def calendar():
+    server = FakeCalendarServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def telegram():
+    server = FakeTelegramServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def bot(calendar, telegram, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_fake_token(str(tmp_path))
+    environment = {
+        'BOT_TOKEN': '123456:fake-token',
+        'TEST_GROUPCHAT_ID': '-1001000',
+        'SOK_C_CALENDAR_ID': 'sok-c',
+        'SOK_R_CALENDAR_ID': 'sok-r',
+        'LL_CALENDAR_ID': 'll',
+        'CALENDAR_API_ROOT_URL': calendar.root_url,
+        'TELEGRAM_BASE_URL': telegram.base_url,
+        'TELEGRAM_RATE_LIMITED': 'false',
+        'AUTO_REFRESH_INTERVAL_SECONDS': '0',
+        'CALENDAR_CONFIG_PATH': str(tmp_path / 'calendars.json'),
+        'EVENT_STORE_PATH': str(tmp_path / 'events.db'),
+        # The synthetic events are in 2025, so the store has to reach back that far
+        'EVENT_SYNC_LOOKBACK_DAYS': str((datetime.date.today() - datetime.date(2025, 1, 1)).days),
+        'MESSAGE_REGISTRY_PATH': str(tmp_path / 'bot_state.db'),
+        'PAYROLL_LEDGER_PATH': str(tmp_path / 'payroll.db'),
+        'WARM_UP_ON_START': 'false',
+    }
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    return load_bot()
+
+
+async def send_command(application, text, chat_id=USER_ID):
+    """
+    Process a command sent by USER_ID, as if it came from Telegram.
+    """
+    from telegram import Update
+
+    update_id = int(time.monotonic() * 1000)
+    command = text.split()[0]
+    await application.process_update(Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Admin', 'username': 'admin'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }, application.bot))
@@ -0,0 +1,121 @@
+"""
+Incremental sync, 410 recovery and batch failure isolation, against the fake Calendar API.
+"""
+import asyncio
+import datetime
+
+from conftest import CALENDAR_IDS
+from synthetic import TEACHERS, generate_events
+
+WINDOW = (datetime.datetime(2025, 5, 1), datetime.datetime(2025, 6, 1))
+
+
+def add_events(calendar, calendar_id, count):
+    return [calendar.add_event(calendar_id, event) for event in generate_events(count)]
+
+
+def stored_summaries(bot, calendar_id):
+    events, _ = bot.get_event_store().query_page(calendar_id, *WINDOW)
+    return {event['id']: event['summary'] for event in events}
+
+
+def test_incremental_sync_only_receives_changes(bot, calendar):
+    events = add_events(calendar, 'sok-c', 40)
+
+    async def run():
+        client = await bot.get_calendar_client()
+        first = await bot.sync_calendar('sok-c', client)
+        calendar.add_event('sok-c', dict(events[0], summary='Renamed lesson'))
+        calendar.cancel_event('sok-c', events[1]['id'])
+        calendar.reset_counters()
+        second = await bot.sync_calendar('sok-c', client)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == 40
+    assert second == 2
+    assert calendar.requests[0][1].get('syncToken')
+    summaries = stored_summaries(bot, 'sok-c')
+    assert summaries[events[0]['id']] == 'Renamed lesson'
+    assert events[1]['id'] not in summaries
+    assert len(summaries) == 39
+
+
+def test_expired_sync_token_falls_back_to_full_sync(bot, calendar):
+    events = add_events(calendar, 'sok-c', 20)
+
+    async def run():
+        client = await bot.get_calendar_client()
+        await bot.sync_calendar('sok-c', client)
+        calendar.expire_sync_tokens()
+        calendar.add_event('sok-c', dict(events[0], id='added-after-expiry'))
+        calendar.reset_counters()
+        return await bot.sync_calendar('sok-c', client)
+
+    assert asyncio.run(run()) == 21
+    # The expired token is answered with 410, then the calendar is listed again from the horizon
+    assert [bool(params.get('syncToken')) for _, params in calendar.requests] == [True, False]
+    assert len(stored_summaries(bot, 'sok-c')) == 21
+
+
+def test_failing_calendar_does_not_affect_the_others_in_a_batch(bot, calendar):
+    for calendar_id in CALENDAR_IDS:
+        add_events(calendar, calendar_id, 10)
+    calendar.failing_calendars.add('sok-r')
+
+    async def run():
+        client = await bot.get_calendar_client()
+        calendar.reset_counters()
+        return await bot.fetch_all_calendar_events(bot.CALENDAR_CONFIGS, *WINDOW, client)
+
+    results = asyncio.run(run())
+    errors = {config[1]: error for config, _, error in results}
+    sessions = {config[1]: sessions for config, sessions, _ in results}
+    assert errors['sok-r'] is not None
+    assert errors['sok-c'] is None and errors['ll'] is None
+    assert len(sessions['sok-c']) == 10 and len(sessions['ll']) == 10
+    assert calendar.round_trips == 1
+
+
+def test_calendar_dropped_from_config_is_ignored_and_pruned(bot, calendar):
+    for calendar_id in CALENDAR_IDS:
+        add_events(calendar, calendar_id, 10)
+    store = bot.get_event_store()
+    # Events left in the store by a venue since removed from the calendar config
+    store.apply_changes('removed-calendar', generate_events(10))
+    store.save_sync_token('removed-calendar', 'token', bot.get_sync_horizon())
+    handles = [handle for _, handle in TEACHERS]
+
+    async def run():
+        client = await bot.get_calendar_client()
+        return await bot.fetch_teacher_bookings(handles, *WINDOW, client)
+
+    bookings_by_handle, failed_venues = asyncio.run(run())
+    assert failed_venues == []
+    assert bookings_by_handle
+    venues = {booking.venue_name for bookings in bookings_by_handle.values() for booking in bookings}
+    assert venues <= set(bot.CALENDAR_VENUE_NAMES.values())
+
+    store.retain(list(bot.CALENDAR_VENUE_NAMES))
+    assert store.query_page('removed-calendar', *WINDOW) == ([], None)
+    assert store.get_sync_token('removed-calendar') is None
+
+
+def test_concurrent_fetches_of_the_default_window_share_one_request(bot, calendar, monkeypatch):
+    # Without the event store, so the calendars are listed rather than synced
+    monkeypatch.setattr(bot, 'EVENT_STORE_PATH', '')
+    for calendar_id in CALENDAR_IDS:
+        add_events(calendar, calendar_id, 10)
+
+    async def run():
+        client = await bot.get_calendar_client()
+        calendar.reset_counters()
+        # Each caller computes its own default window, a moment after the previous one
+        return await asyncio.gather(*(
+            bot.fetch_all_calendar_events(bot.CALENDAR_CONFIGS, *bot.get_fetch_window(None), client)
+            for _ in range(3)
+        ))
+
+    first, second, third = asyncio.run(run())
+    assert first == second == third
+    assert calendar.round_trips == 1
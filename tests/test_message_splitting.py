@@ -0,0 +1,65 @@
+"""
+Splitting of schedules and other long replies into Telegram-sized messages.
+"""
+import re
+import datetime
+
+from synthetic import generate_events
+
+
+def test_short_schedule_is_one_part(bot):
+    sessions = [bot.normalize_event(event) for event in generate_events(5)]
+    schedule = bot.format_schedule(bot.CALENDAR_CONFIGS[0][3], sessions)
+    assert bot.split_schedule_message(schedule) == [schedule]
+
+
+def test_long_schedule_is_split_at_day_boundaries(bot):
+    header = bot.CALENDAR_CONFIGS[0][3]
+    sessions = [bot.normalize_event(event) for event in generate_events(400)]
+    schedule = bot.format_schedule(header, sessions)
+    parts = bot.split_schedule_message(schedule)
+
+    assert len(parts) > 1
+    assert all(len(part) <= bot.SCHEDULE_MESSAGE_LIMIT for part in parts)
+    for part in parts[1:]:
+        # Continuation parts repeat the branch header and start at a day heading
+        assert part.startswith(header)
+        assert bot.DAY_HEADING_PATTERN.match(part[len(header):].split('\n', 1)[0])
+    assert parts[0] + "".join(part[len(header):] for part in parts[1:]) == schedule
+
+
+def test_long_reply_without_days_is_split_between_lines(bot):
+    bookings = [
+        bot.Booking(session.start, session.end, 'SOK-C', session)
+        for session in (bot.normalize_event(event) for event in generate_events(300))
+    ]
+    conflicts = [('overlap', f"@teacher{index}", bookings[index], bookings[index + 1], -30) for index in range(299)]
+    message = bot.format_conflicts(conflicts, datetime.datetime(2025, 5, 1), datetime.datetime(2025, 6, 1))
+    parts = bot.split_schedule_message(message)
+
+    assert len(parts) > 1
+    assert all(len(part) <= bot.SCHEDULE_MESSAGE_LIMIT for part in parts)
+    assert "".join(parts) == message
+    assert sum(part.count('❗') for part in parts) == 299
+
+
+def test_line_longer_than_a_message_is_not_cut_inside_tags_or_entities(bot):
+    line = " ".join(f"<b>Lesson {index}</b> with <i>Tom &amp; <u>Jerry</u></i> &#128512;" for index in range(200))
+    message = "<b>Notes</b>\n" + line + "\n"
+    parts = bot.split_schedule_message(message, limit=500)
+
+    assert len(parts) > 1
+    for part in parts:
+        assert len(part) <= 500
+        open_tags = []
+        for token in re.findall(r'<[^>]*>?|&#?\w*;?|[^<&]+', part):
+            assert not token.startswith('<') or token.endswith('>')
+            if token.startswith('</'):
+                assert open_tags.pop() == token[2:-1]
+            elif token.startswith('<'):
+                open_tags.append(token[1:-1].split()[0])
+            elif token.startswith('&'):
+                assert token.endswith(';')
+        assert open_tags == []
+    # Only tags are added at the cuts, the text itself is unchanged
+    assert "".join(re.sub(r'<[^>]*>', '', part) for part in parts) == re.sub(r'<[^>]*>', '', message)
@@ -0,0 +1,96 @@
+"""
+Payment sheet jobs, against the fake Calendar and Telegram APIs.
+"""
+import io
+import json
+import asyncio
+import zipfile
+import datetime
+
+from telegram import Bot
+
+from _bot import load_bot
+from conftest import CALENDAR_IDS
+from synthetic import generate_events
+
+
+def add_upcoming_events(calendar, count):
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    for calendar_id in CALENDAR_IDS:
+        for event in generate_events(count, start_date=tomorrow):
+            calendar.add_event(calendar_id, event)
+
+
+def test_requests_for_the_default_period_join_one_job(bot, calendar, telegram):
+    add_upcoming_events(calendar, 20)
+
+    async def run():
+        async with Bot('123456:fake-token', base_url=telegram.base_url) as telegram_client:
+            # Each request computes its own default period, a moment after the previous one
+            first = await bot.REPORT_JOBS.submit(telegram_client, 1, *bot.get_payment_period(), bot.XLSX_FORMAT)
+            second = await bot.REPORT_JOBS.submit(telegram_client, 2, *bot.get_payment_period(), bot.XLSX_FORMAT)
+            await first.task
+            third = await bot.REPORT_JOBS.submit(telegram_client, 3, *bot.get_payment_period(), bot.XLSX_FORMAT)
+            return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert first is second is third
+    assert first.status == 'done'
+    documents = [params for method, params in telegram.calls if method == 'sendDocument']
+    assert sorted(int(params['chat_id']) for params in documents) == [1, 2, 3]
+
+
+def test_calendar_shared_by_two_venues_is_paid_once(bot, calendar, telegram, tmp_path):
+    (tmp_path / 'calendars.json').write_text(json.dumps([
+        {'key': 'SOKC', 'calendar_id': 'sok-c', 'venue': 'SOK-C'},
+        {'key': 'SOKR', 'calendar_id': 'sok-c', 'venue': 'SOK-R'},
+    ]))
+    bot = load_bot()
+    add_upcoming_events(calendar, 20)
+
+    async def run():
+        async with Bot('123456:fake-token', base_url=telegram.base_url) as telegram_client:
+            job = await bot.REPORT_JOBS.submit(telegram_client, 1, *bot.get_payment_period(), bot.XLSX_FORMAT)
+            await job.task
+            return job
+
+    job = asyncio.run(run())
+    assert job.status == 'done'
+    # Only the first venue of the shared calendar is paid
+    assert list(job.venues) == ['SOK-C']
+    assert job.venues['SOK-C'] > 0
+
+
+def test_sheet_from_the_ledger_matches_a_live_build(bot):
+    week_start = datetime.date(2025, 4, 28)
+    ledger_end = week_start + datetime.timedelta(days=7)
+    venue_sessions = [
+        (venue_name, [bot.normalize_event(event) for event in generate_events(60, seed=seed)])
+        for seed, venue_name in enumerate(['SOK-C', 'SOK-R'])
+    ]
+    finalized = [(venue_name, [session for session in sessions if session.start.date() < ledger_end]) for venue_name, sessions in venue_sessions]
+    live = [(venue_name, [session for session in sessions if session.start.date() >= ledger_end]) for venue_name, sessions in venue_sessions]
+    ledger = bot.get_payroll_ledger()
+    for venue_name, sessions in finalized:
+        ledger.append_week(week_start, venue_name, bot.build_payroll_frame([(venue_name, sessions)]))
+    ledger_payroll = ledger.read_payroll(datetime.date(2025, 5, 1), ledger_end)
+    no_sessions = [(venue_name, []) for venue_name, _ in venue_sessions]
+
+    for report_format in bot.REPORT_FORMATS:
+        assert report_content(bot.build_report(live, report_format, ledger_payroll), report_format) == report_content(
+            bot.build_report(venue_sessions, report_format), report_format
+        )
+        # A period that ends with the finalized weeks has no live sessions at all
+        assert report_content(bot.build_report(no_sessions, report_format, ledger_payroll), report_format) == report_content(
+            bot.build_report(finalized, report_format), report_format
+        )
+
+
+def report_content(report, report_format):
+    """
+    The bytes of a report, or for xlsx, the files inside it except the properties holding the time it was written.
+    """
+    if report_format != 'xlsx':
+        return report
+    with zipfile.ZipFile(io.BytesIO(report)) as archive:
+        return {name: archive.read(name) for name in archive.namelist() if name != 'docProps/core.xml'}
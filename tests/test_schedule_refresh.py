@@ -0,0 +1,87 @@
+"""
+Refreshing the schedules posted to group chats, against the fake Calendar and Telegram APIs.
+"""
+import asyncio
+
+from telegram import Bot
+
+from _bot import load_bot
+from conftest import CALENDAR_IDS, USER_ID, send_command
+from synthetic import generate_events
+
+INPUT_DATE = '2025-04-30'
+CHAT_ID = -1001000
+OTHER_CHAT_ID = -1002000
+
+
+def test_refresh_without_event_store_fetches_each_week_once(bot, calendar, telegram, monkeypatch):
+    monkeypatch.setattr(bot, 'EVENT_STORE_PATH', '')
+    for calendar_id in CALENDAR_IDS:
+        for event in generate_events(30):
+            calendar.add_event(calendar_id, event)
+    calendar_keys = [config[0] for config in bot.CALENDAR_CONFIGS] + [bot.ALL_KEY]
+
+    async def run():
+        async with Bot('123456:fake-token', base_url=telegram.base_url) as telegram_client:
+            registry = bot.get_message_registry()
+            for calendar_key in calendar_keys:
+                message = await telegram_client.send_message(chat_id=CHAT_ID, text=f"Old {calendar_key} schedule")
+                registry.register(CHAT_ID, [message.message_id], calendar_key, INPUT_DATE, [message.text])
+            client = await bot.get_calendar_client()
+            calendar.reset_counters()
+            return await bot.refresh_registered_schedules(telegram_client, registry.list(), client)
+
+    counts = asyncio.run(run())
+    assert counts == {'edited': len(calendar_keys), 'unchanged': 0, 'failed': 0}
+    assert calendar.round_trips == 1
+    assert sorted({calendar_id for calendar_id, _ in calendar.requests}) == sorted(CALENDAR_IDS)
+
+
+def start_application(bot):
+    application = bot.build_application()
+    bot.register_handlers(application)
+    return application
+
+
+def replies(telegram):
+    return [params.get('text') for method, params in telegram.calls if method == 'sendMessage' and int(params['chat_id']) == USER_ID]
+
+
+def test_group_chat_ids_keep_usernames(monkeypatch):
+    monkeypatch.setenv('TEST_GROUPCHAT_ID', ' -1001000 , @schedules ,')
+    bot = load_bot()
+    assert bot.GROUPCHAT_IDS == [-1001000, '@schedules']
+
+
+def test_edit_finds_the_chat_a_schedule_was_sent_to(bot, calendar, telegram, monkeypatch):
+    monkeypatch.setattr(bot, 'GROUPCHAT_IDS', [CHAT_ID, OTHER_CHAT_ID])
+    for event in generate_events(30):
+        calendar.add_event('sok-c', event)
+    key = bot.CALENDAR_CONFIGS[0][0]
+
+    async def run():
+        application = start_application(bot)
+        async with application:
+            await send_command(application, f"/send {key} {INPUT_DATE}")
+            # Not in the first group chat
+            schedule = next(schedule for schedule in bot.get_message_registry().list() if schedule['chat_id'] == OTHER_CHAT_ID)
+            calendar.add_event('sok-c', dict(generate_events(1)[0], id='new-lesson', summary='New lesson'))
+            telegram.reset_counters()
+            await send_command(application, f"/edit {schedule['message_id']}")
+
+    asyncio.run(run())
+    edits = [params for method, params in telegram.calls if method == 'editMessageText']
+    assert [int(params['chat_id']) for params in edits] == [OTHER_CHAT_ID]
+    assert replies(telegram)[0].startswith("Message has been edited successfully")
+
+
+def test_edit_without_a_group_chat_replies_with_an_error(bot, telegram, monkeypatch):
+    monkeypatch.setattr(bot, 'GROUPCHAT_IDS', [])
+
+    async def run():
+        application = start_application(bot)
+        async with application:
+            await send_command(application, "/edit 12")
+
+    asyncio.run(run())
+    assert replies(telegram) == ["No group chat is configured, set GROUPCHAT_ID to edit messages."]